@@ -1,5 +1,6 @@
-__all__ = ["curves", "der", "ecdsa", "ellipticcurve", "keys", "numbertheory",
-           "test_pyecdsa", "util", "six"]
+__all__ = ["batch", "bench", "curves", "der", "ecdsa", "ellipticcurve",
+           "keys", "numbertheory", "opcount", "tables", "test_pyecdsa",
+           "util", "six"]
 from .keys import SigningKey, VerifyingKey, BadSignatureError, BadDigestError
 from .curves import NIST192p, NIST224p, NIST256p, NIST384p, NIST521p, SECP256k1
 
@@ -0,0 +1,322 @@
+"""
+Bulk signature verification (experimental).
+
+verify() and verify_digests() check many signatures at once and return one
+boolean per signature instead of raising BadSignatureError:
+
+  from ecdsa import batch
+  results = batch.verify(verifying_keys, signatures, messages)
+
+Two engines are available. The "numpy" engine runs the signatures of one
+curve in lock step: every field element of the batch is a NumPy array of
+fixed-width limbs, and the field multiplications (Montgomery reduction),
+additions and subtractions of u1*G + u2*Q are vectorized across all of
+the signatures, in Jacobian coordinates so that no lane needs a field
+inversion. The "scalar" engine verifies the signatures one at a time with
+ecdsa.Public_key.verifies(). NumPy is optional; without it (or for small
+batches) the scalar engine is used.
+
+Lanes that hit an exceptional case of the point formulas (the point at
+infinity, or adding a point to itself) are verified again with the scalar
+engine, so both engines always give the same answers. Neither engine runs
+in constant time.
+"""
+
+from . import ecdsa
+from . import numbertheory
+from .util import sigdecode_string, string_to_number
+from .keys import BadDigestError
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+ENGINES = ("numpy", "scalar")
+
+# below this many signatures of one curve the default engine is "scalar":
+# the NumPy engine has a fixed cost per bit of the curve order
+MIN_NUMPY_BATCH = 32
+
+# bits per limb; with at most 21 limbs (NIST521p) a product accumulated over
+# a whole Montgomery multiplication stays below 2**58, clear of the int64
+# limit
+LIMB_BITS = 26
+
+class LimbField(object):
+    """Arithmetic modulo the prime p on batches of field elements.
+
+    A batch of N elements is an int64 array of shape (limbs, N), holding
+    the Montgomery forms x*R mod p of the elements in LIMB_BITS-bit limbs,
+    least significant limb first. Values are kept below 2*p and every
+    operation takes and returns values in that range.
+    """
+
+    def __init__(self, p, width=LIMB_BITS):
+        if numpy is None:
+            raise ImportError("LimbField needs numpy")
+        self.p = p
+        self.width = width
+        self.mask = (1 << width) - 1
+        # R = 2**(width*limbs) > 4*p keeps Montgomery products below 2*p
+        self.limbs = -(-(p.bit_length() + 2) // width)
+        self.R = 1 << (width * self.limbs)
+        self.R_inverse = numbertheory.inverse_mod(self.R % p, p)
+        self.p_inverse = (-numbertheory.inverse_mod(p, 1 << width)) & self.mask
+        self.p_limbs = self.split([p])
+        self.two_p_limbs = self.split([2 * p])
+
+    def split(self, values):
+        # raw limbs of the integers in values, no Montgomery conversion
+        return numpy.array([[(v >> (self.width * j)) & self.mask
+                             for v in values]
+                            for j in range(self.limbs)], dtype=numpy.int64)
+
+    def to_field(self, values):
+        """Convert a sequence of integers to a batch."""
+        return self.split([(v * self.R) % self.p for v in values])
+
+    def from_field(self, a):
+        """Convert a batch back to a list of integers in [0, p)."""
+        rows = a.tolist()
+        values = [0] * len(rows[0])
+        for j in reversed(range(self.limbs)):
+            values = [(v << self.width) + limb
+                      for v, limb in zip(values, rows[j])]
+        return [(v * self.R_inverse) % self.p for v in values]
+
+    def constant(self, value, count):
+        return numpy.repeat(self.to_field([value]), count, axis=1)
+
+    def _carry(self, a):
+        # propagate (possibly negative) carries up to the top limb, which is
+        # left unmasked and so holds the sign of the value
+        w, mask = self.width, self.mask
+        for j in range(self.limbs - 1):
+            a[j + 1] += a[j] >> w
+            a[j] &= mask
+        return a
+
+    def _reduce(self, a):
+        # a is carried and below 4*p; subtract 2*p where that stays >= 0
+        b = self._carry(a - self.two_p_limbs)
+        return numpy.where(b[-1] < 0, a, b)
+
+    def add(self, a, b):
+        return self._reduce(self._carry(a + b))
+
+    def sub(self, a, b):
+        return self._reduce(self._carry(a - b + self.two_p_limbs))
+
+    def mul(self, a, b):
+        """Montgomery product a*b/R mod p."""
+        n, w, mask = self.limbs, self.width, self.mask
+        p_limbs, p_inverse = self.p_limbs, self.p_inverse
+        t = numpy.zeros((2 * n, a.shape[1]), dtype=numpy.int64)
+        for i in range(n):
+            window = t[i:i + n]
+            window += a[i] * b
+            # the product may wrap around, only its low limb bits matter
+            m = (t[i] * p_inverse) & mask
+            window += m * p_limbs
+            t[i + 1] += t[i] >> w
+        return self._carry(t[n:])
+
+    def sqr(self, a):
+        return self.mul(a, a)
+
+class _Curve(object):
+    # the formulas for one curve, on batches of Jacobian points (X, Y, Z)
+    def __init__(self, curve):
+        self.field = f = LimbField(curve.p())
+        a = curve.a() % curve.p()
+        if a == 0:
+            self.a = 0
+        elif a == curve.p() - 3:
+            self.a = -3
+        else:
+            self.a = a
+            self.a_field = f.to_field([a])
+
+    def double(self, X, Y, Z):
+        f = self.field
+        XX = f.sqr(X)
+        YY = f.sqr(Y)
+        ZZ = f.sqr(Z)
+        if self.a == 0:
+            M = f.add(f.add(XX, XX), XX)
+        elif self.a == -3:
+            M = f.mul(f.sub(X, ZZ), f.add(X, ZZ))
+            M = f.add(f.add(M, M), M)
+        else:
+            M = f.add(f.add(f.add(XX, XX), XX),
+                      f.mul(f.sqr(ZZ), self.a_field))
+        S = f.mul(X, YY)
+        S = f.add(S, S)
+        S = f.add(S, S)
+        X3 = f.sub(f.sqr(M), f.add(S, S))
+        YYYY = f.sqr(YY)
+        YYYY = f.add(YYYY, YYYY)
+        YYYY = f.add(YYYY, YYYY)
+        YYYY = f.add(YYYY, YYYY)
+        Y3 = f.sub(f.mul(M, f.sub(S, X3)), YYYY)
+        Z3 = f.mul(Y, Z)
+        Z3 = f.add(Z3, Z3)
+        return X3, Y3, Z3
+
+    def add_affine(self, X1, Y1, Z1, X2, Y2):
+        # (X1, Y1, Z1) + (X2, Y2, 1); a lane adding a point to itself or to
+        # its negation gets Z3 = 0, which no later step can undo
+        f = self.field
+        Z1Z1 = f.sqr(Z1)
+        U2 = f.mul(X2, Z1Z1)
+        S2 = f.mul(Y2, f.mul(Z1, Z1Z1))
+        H = f.sub(U2, X1)
+        r = f.sub(S2, Y1)
+        HH = f.sqr(H)
+        HHH = f.mul(H, HH)
+        V = f.mul(X1, HH)
+        X3 = f.sub(f.sub(f.sqr(r), HHH), f.add(V, V))
+        Y3 = f.sub(f.mul(r, f.sub(V, X3)), f.mul(Y1, HHH))
+        Z3 = f.mul(Z1, H)
+        return X3, Y3, Z3
+
+def _bits(values, count):
+    # bits[i][k] is bit count-1-i of values[k], most significant first
+    words = numpy.array([[(v >> (62 * j)) & ((1 << 62) - 1) for v in values]
+                         for j in range(-(-count // 62))], dtype=numpy.int64)
+    return [(words[b // 62] >> (b % 62)) & 1
+            for b in reversed(range(count))]
+
+def _mul_add_many(generator, u1s, points, u2s):
+    """Compute u1s[k]*generator + u2s[k]*points[k] for every k.
+
+    Returns a list of Jacobian (X, Z) integer pairs, with None for the
+    lanes that hit an exceptional case and need the scalar engine.
+    """
+    count = len(points)
+    curve = _Curve(generator.curve())
+    f = curve.field
+    # affine addends per lane: G, Q and G+Q, selected by the bit pairs
+    sums = [generator + Q for Q in points]
+    usable = numpy.array([S.x() is not None for S in sums])
+    sums = [S if S.x() is not None else generator for S in sums]
+    TX = [f.constant(generator.x(), count), f.to_field([Q.x() for Q in points]),
+          f.to_field([S.x() for S in sums])]
+    TY = [f.constant(generator.y(), count), f.to_field([Q.y() for Q in points]),
+          f.to_field([S.y() for S in sums])]
+    one = f.constant(1, count)
+
+    bit_count = max(generator.order().bit_length(),
+                    max(u.bit_length() for u in u1s + u2s))
+    X, Y, Z = one, one, one
+    infinity = numpy.ones(count, dtype=bool)
+    for bit1, bit2 in zip(_bits(u1s, bit_count), _bits(u2s, bit_count)):
+        X, Y, Z = curve.double(X, Y, Z)
+        digit = bit1 + 2 * bit2
+        if not digit.any():
+            continue
+        AX = numpy.where(digit == 1, TX[0], numpy.where(digit == 2, TX[1],
+                                                         TX[2]))
+        AY = numpy.where(digit == 1, TY[0], numpy.where(digit == 2, TY[1],
+                                                         TY[2]))
+        X3, Y3, Z3 = curve.add_affine(X, Y, Z, AX, AY)
+        add = digit != 0
+        start = add & infinity
+        X = numpy.where(start, AX, numpy.where(add, X3, X))
+        Y = numpy.where(start, AY, numpy.where(add, Y3, Y))
+        Z = numpy.where(start, one, numpy.where(add, Z3, Z))
+        infinity &= ~add
+
+    results = []
+    for k, (x, z) in enumerate(zip(f.from_field(X), f.from_field(Z))):
+        if infinity[k] or not usable[k] or z == 0:
+            results.append(None)
+        else:
+            results.append((x, z))
+    return results
+
+def _verify_numpy(pubkeys, numbers, sigs):
+    # all the public keys share one curve and generator
+    generator = pubkeys[0].generator
+    n = generator.order()
+    p = generator.curve().p()
+    results = [False] * len(sigs)
+    lanes = [k for k, sig in enumerate(sigs)
+             if 0 < sig.r < n and 0 < sig.s < n]
+    if not lanes:
+        return results
+    inverses = numbertheory.inverse_mod_many([sigs[k].s for k in lanes], n)
+    u1s = [(numbers[k] * c) % n for k, c in zip(lanes, inverses)]
+    u2s = [(sigs[k].r * c) % n for k, c in zip(lanes, inverses)]
+    points = [pubkeys[k].point for k in lanes]
+    for k, xz in zip(lanes, _mul_add_many(generator, u1s, points, u2s)):
+        if xz is None:
+            results[k] = pubkeys[k].verifies(numbers[k], sigs[k])
+            continue
+        # x = X/Z**2 and the signature is valid if x mod n == r, so compare
+        # X with candidate*Z**2 for every candidate x below p
+        X, Z = xz
+        ZZ = (Z * Z) % p
+        candidate = sigs[k].r
+        while candidate < p and not results[k]:
+            results[k] = (candidate * ZZ - X) % p == 0
+            candidate += n
+    return results
+
+def _verify_scalar(pubkeys, numbers, sigs):
+    return [pubkey.verifies(number, sig)
+            for pubkey, number, sig in zip(pubkeys, numbers, sigs)]
+
+def verify_digests(verifying_keys, signatures, digests,
+                   sigdecode=sigdecode_string, engine=None):
+    """Verify signatures[k] of digests[k] with verifying_keys[k], for all k.
+
+    Returns a list of booleans. The keys may be on different curves; the
+    signatures are grouped by curve. engine is "numpy", "scalar" or None to
+    pick NumPy when it is available and the batch is large enough.
+    Raises BadDigestError for a digest too long for its curve.
+    """
+    if engine not in ENGINES + (None,):
+        raise ValueError("unknown engine %r, known engines: %s"
+                         % (engine, ", ".join(ENGINES)))
+    if engine == "numpy" and numpy is None:
+        raise ImportError("the numpy engine needs numpy")
+    if not len(verifying_keys) == len(signatures) == len(digests):
+        raise ValueError("need one key and one digest per signature")
+
+    groups = {}
+    for k, (vk, signature, digest) in enumerate(zip(verifying_keys,
+                                                    signatures, digests)):
+        if len(digest) > vk.curve.baselen:
+            raise BadDigestError("this curve (%s) is too short "
+                                 "for your digest (%d)" % (vk.curve.name,
+                                                           8*len(digest)))
+        r, s = sigdecode(signature, vk.pubkey.order)
+        groups.setdefault(vk.curve.name, []).append(
+            (k, vk.pubkey, string_to_number(digest), ecdsa.Signature(r, s)))
+
+    results = [False] * len(signatures)
+    for group in groups.values():
+        indices, pubkeys, numbers, sigs = [list(c) for c in zip(*group)]
+        use_numpy = engine == "numpy" or (engine is None and
+                                          numpy is not None and
+                                          len(group) >= MIN_NUMPY_BATCH)
+        if use_numpy:
+            verified = _verify_numpy(pubkeys, numbers, sigs)
+        else:
+            verified = _verify_scalar(pubkeys, numbers, sigs)
+        for k, ok in zip(indices, verified):
+            results[k] = ok
+    return results
+
+def verify(verifying_keys, signatures, data, hashfunc=None,
+           sigdecode=sigdecode_string, engine=None):
+    """Like verify_digests(), hashing each of data with hashfunc (by default
+    the default_hashfunc of its key) first."""
+    if len(verifying_keys) != len(data):
+        raise ValueError("need one key and one message per signature")
+    digests = [(hashfunc or vk.default_hashfunc)(d).digest()
+               for vk, d in zip(verifying_keys, data)]
+    return verify_digests(verifying_keys, signatures, digests, sigdecode,
+                          engine)
@@ -0,0 +1,248 @@
+"""
+Benchmarks for the ECDSA operations on every curve in curves.curves.
+
+Each operation (key generation, random and deterministic signing,
+verification, DER/PEM loading and public point validation) is timed
+individually; the report gives the throughput and latency percentiles for
+every (curve, operation) pair.
+
+Run it as a module:
+
+  python -m ecdsa.bench --iterations 50 --output results.json
+
+Results can be written as JSON and a previous JSON result can be used as a
+baseline: every operation whose throughput dropped by more than the
+tolerance (25% by default) is reported as a regression and the exit status
+is non-zero, so the benchmark can guard a CI job:
+
+  python -m ecdsa.bench --baseline results.json --tolerance 0.25
+
+The bulk verification engines of the batch module are not timed by
+default; ask for them explicitly to compare the NumPy engine with the
+scalar one (each run verifies --batch-size signatures):
+
+  python -m ecdsa.bench --operations batch_verify_scalar,batch_verify_numpy
+"""
+
+from __future__ import division
+
+import sys
+import json
+import argparse
+import platform
+from timeit import default_timer
+
+from six import b, print_
+from . import ecdsa
+from . import batch
+from .curves import curves
+from .keys import SigningKey, VerifyingKey
+from . import __version__
+
+OPERATIONS = ["keygen", "sign", "sign_deterministic", "verify",
+              "load_der", "load_pem", "point_validation"]
+
+# timed only on request, each run verifying a batch of signatures
+BATCH_OPERATIONS = ["batch_verify_scalar", "batch_verify_numpy"]
+
+PERCENTILES = (50, 90, 99)
+
+class BenchmarkError(Exception):
+    pass
+
+def _batch_operations(curve, batch_size):
+    # batch_size signatures by a few keys, verified by each engine
+    sks = [SigningKey.generate(curve) for i in range(min(batch_size, 8))]
+    vks = [sks[i % len(sks)].get_verifying_key() for i in range(batch_size)]
+    data = [b("benchmark data %d" % i) for i in range(batch_size)]
+    sigs = [sks[i % len(sks)].sign(d) for i, d in enumerate(data)]
+    def verify(engine):
+        return lambda: batch.verify(vks, sigs, data, engine=engine)
+    return {
+        "batch_verify_scalar": verify("scalar"),
+        "batch_verify_numpy": verify("numpy"),
+        }
+
+def _operations(curve):
+    # returns a dict of operation name -> zero-argument callable, all working
+    # on one key pair and one signature prepared up front
+    data = b("benchmark data")
+    sk = SigningKey.generate(curve)
+    vk = sk.get_verifying_key()
+    sig = sk.sign(data)
+    vk_der = vk.to_der()
+    sk_pem = sk.to_pem()
+    point = vk.pubkey.point
+    x, y = point.x(), point.y()
+    return {
+        "keygen": lambda: SigningKey.generate(curve),
+        "sign": lambda: sk.sign(data),
+        "sign_deterministic": lambda: sk.sign_deterministic(data),
+        "verify": lambda: vk.verify(sig, data),
+        "load_der": lambda: VerifyingKey.from_der(vk_der),
+        "load_pem": lambda: SigningKey.from_pem(sk_pem),
+        "point_validation": lambda: ecdsa.point_is_valid(curve.generator,
+                                                         x, y),
+        }
+
+def percentile(sorted_samples, pct):
+    """Nearest-rank percentile of an already sorted, non-empty list."""
+    rank = max(1, -(-pct * len(sorted_samples) // 100))
+    return sorted_samples[int(rank) - 1]
+
+def summarize(samples):
+    """Turn a list of latencies (in seconds) into the reported statistics."""
+    samples = sorted(samples)
+    total = sum(samples)
+    summary = {"iterations": len(samples),
+               "ops_per_sec": len(samples) / total if total else 0.0,
+               "mean": total / len(samples),
+               "min": samples[0],
+               "max": samples[-1]}
+    for pct in PERCENTILES:
+        summary["p%d" % pct] = percentile(samples, pct)
+    return summary
+
+def time_operation(func, iterations, warmup=1):
+    for i in range(warmup):
+        func()
+    samples = []
+    for i in range(iterations):
+        start = default_timer()
+        func()
+        samples.append(default_timer() - start)
+    return samples
+
+def run(curve_list=None, operations=None, iterations=20, warmup=1,
+        batch_size=256):
+    """Benchmark the operations on each curve.
+
+    Returns a JSON-serializable dict; results[curve name][operation] holds
+    the summarize() statistics. The statistics of the BATCH_OPERATIONS are
+    per batch of batch_size signatures, with the throughput in signatures
+    per second added as "signatures_per_sec".
+    """
+    if curve_list is None:
+        curve_list = curves
+    if operations is None:
+        operations = OPERATIONS
+    if iterations < 1:
+        raise BenchmarkError("need at least one iteration, got %d"
+                             % iterations)
+    for name in operations:
+        if name not in OPERATIONS + BATCH_OPERATIONS:
+            raise BenchmarkError("unknown operation %r, known operations: %s"
+                                 % (name, ", ".join(OPERATIONS +
+                                                    BATCH_OPERATIONS)))
+    if "batch_verify_numpy" in operations and batch.numpy is None:
+        raise BenchmarkError("batch_verify_numpy needs numpy")
+    results = {}
+    for curve in curve_list:
+        funcs = _operations(curve)
+        if set(operations) & set(BATCH_OPERATIONS):
+            funcs.update(_batch_operations(curve, batch_size))
+        results[curve.name] = {}
+        for name in operations:
+            stats = summarize(time_operation(funcs[name], iterations, warmup))
+            if name in BATCH_OPERATIONS:
+                stats["signatures_per_sec"] = stats["ops_per_sec"] * batch_size
+            results[curve.name][name] = stats
+    return {"version": __version__,
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "iterations": iterations,
+            "batch_size": batch_size,
+            "results": results}
+
+def compare(report, baseline, tolerance=0.25):
+    """Compare a run() report against a baseline report.
+
+    Returns a list of (curve, operation, baseline ops/sec, current ops/sec)
+    for every operation present in both reports whose throughput fell by
+    more than tolerance (a fraction of the baseline throughput).
+    """
+    regressions = []
+    for curve_name, ops in sorted(report["results"].items()):
+        base_ops = baseline.get("results", {}).get(curve_name, {})
+        for name, stats in sorted(ops.items()):
+            if name not in base_ops:
+                continue
+            expected = base_ops[name]["ops_per_sec"]
+            if stats["ops_per_sec"] < expected * (1 - tolerance):
+                regressions.append((curve_name, name, expected,
+                                    stats["ops_per_sec"]))
+    return regressions
+
+def format_report(report):
+    lines = ["%-10s %-19s %12s %11s %11s %11s" %
+             ("curve", "operation", "ops/sec", "p50 (ms)", "p90 (ms)",
+              "p99 (ms)")]
+    for curve_name, ops in sorted(report["results"].items()):
+        for name in OPERATIONS + BATCH_OPERATIONS:
+            if name not in ops:
+                continue
+            stats = ops[name]
+            lines.append("%-10s %-19s %12.1f %11.3f %11.3f %11.3f" %
+                         (curve_name, name, stats["ops_per_sec"],
+                          1000 * stats["p50"], 1000 * stats["p90"],
+                          1000 * stats["p99"]))
+            if "signatures_per_sec" in stats:
+                lines.append("%-10s %-19s %12.1f signatures/sec" %
+                             ("", "", stats["signatures_per_sec"]))
+    return "\n".join(lines)
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(prog="python -m ecdsa.bench",
+                                     description="Benchmark ECDSA operations.")
+    parser.add_argument("--curves", default=None,
+                        help="comma separated curve names (default: all)")
+    parser.add_argument("--operations", default=None,
+                        help="comma separated operations (default: %s)"
+                        % ",".join(OPERATIONS))
+    parser.add_argument("--iterations", type=int, default=20,
+                        help="timed runs per operation (default: 20)")
+    parser.add_argument("--batch-size", type=int, default=256,
+                        help="signatures per batch of the batch_verify"
+                        " operations (default: 256)")
+    parser.add_argument("--output", default=None,
+                        help="write the JSON results to this file")
+    parser.add_argument("--baseline", default=None,
+                        help="JSON results of an earlier run to compare to")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed throughput drop against the baseline,"
+                        " as a fraction (default: 0.25)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = _parse_args(argv)
+    curve_list = curves
+    if args.curves:
+        by_name = dict((c.name, c) for c in curves)
+        try:
+            curve_list = [by_name[name] for name in args.curves.split(",")]
+        except KeyError as e:
+            raise BenchmarkError("unknown curve %s, known curves: %s" %
+                                 (e, ", ".join(c.name for c in curves)))
+    operations = None
+    if args.operations:
+        operations = args.operations.split(",")
+
+    report = run(curve_list, operations, args.iterations,
+                 batch_size=args.batch_size)
+    print_(format_report(report))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        for curve_name, name, expected, got in regressions:
+            print_("REGRESSION: %s %s: %.1f ops/sec, baseline %.1f ops/sec"
+                   % (curve_name, name, got, expected), file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
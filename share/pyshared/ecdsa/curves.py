@@ -1,6 +1,6 @@
 from __future__ import division
 
-from . import der, ecdsa
+from . import der, ecdsa, ellipticcurve
 
 class UnknownCurveError(Exception):
     pass
@@ -20,6 +20,18 @@ class Curve:
         self.signature_length = 2*self.baselen
         self.oid = oid
         self.encoded_oid = der.encode_oid(*oid)
+        self._generator_table = None
+
+    def generator_table(self):
+        # the FixedBaseTable for the generator, built on first use unless
+        # one was installed with set_generator_table()
+        if self._generator_table is None:
+            self._generator_table = ellipticcurve.FixedBaseTable(self.generator)
+        return self._generator_table
+
+    def set_generator_table(self, table):
+        assert table.point() == self.generator
+        self._generator_table = table
 
 NIST192p = Curve("NIST192p", ecdsa.curve_192, ecdsa.generator_192,
                  (1, 2, 840, 10045, 3, 1, 1))
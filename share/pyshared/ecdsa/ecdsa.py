@@ -56,6 +56,7 @@ Written in 2005 by Peter Pearson and placed in the public domain.
 from six import int2byte, b, print_
 from . import ellipticcurve
 from . import numbertheory
+from . import opcount
 import random
 
 
@@ -67,24 +68,74 @@ class Signature( object ):
     self.r = r
     self.s = s
 
+  def recover_public_points( self, hash, generator ):
+    """Return the points that, used as public keys, would make this
+    signature valid for hash under the given generator.
+
+    Each x coordinate r + j*n below the field prime yields two candidate
+    points, so there are usually two results.  This relies on the curve
+    having cofactor 1, as all the curves defined here do."""
+
+    curve = generator.curve()
+    p = curve.p()
+    n = generator.order()
+    r = self.r
+    s = self.s
+    if r < 1 or r > n-1: return []
+    if s < 1 or s > n-1: return []
+
+    # Q = r^-1 * ( s*R - hash*G ), computed as one double multiplication.
+    r_inverse = numbertheory.inverse_mod( r, n )
+    u1 = ( -hash * r_inverse ) % n
+    u2 = ( s * r_inverse ) % n
+
+    points = []
+    x = r
+    while x < p:
+      alpha = ( pow( x, 3, p ) + curve.a() * x + curve.b() ) % p
+      try:
+        beta = numbertheory.square_root_mod_prime( alpha, p )
+      except numbertheory.SquareRootError:
+        beta = None
+      if beta is not None:
+        for y in sorted( set( ( beta, ( p - beta ) % p ) ) ):
+          R = ellipticcurve.Point( curve, x, y )
+          Q = R.mul_add( u2, generator, u1 )
+          if not Q == ellipticcurve.INFINITY:
+            points.append( Q )
+      x += n
+    return points
+
+  def recover_public_keys( self, hash, generator ):
+    """Return the Public_keys for which this signature is valid for hash."""
+
+    return [ Public_key( generator, point )
+             for point in self.recover_public_points( hash, generator ) ]
+
 
 
 class Public_key( object ):
   """Public key for ECDSA.
   """
 
-  def __init__( self, generator, point ):
+  def __init__( self, generator, point, verify = True ):
     """generator is the Point that generates the group,
     point is the Point that defines the public key.
+    verify=False skips the (expensive) check that point has the order
+    of the generator, for points known to have been derived from it.
     """
 
     self.curve = generator.curve()
     self.generator = generator
     self.point = point
+    # Optional ellipticcurve.FixedBaseTables for generator and point; when
+    # both are set, verification uses them instead of doublings.
+    self.generator_table = None
+    self.point_table = None
     n = generator.order()
     if not n:
       raise RuntimeError("Generator point must have order.")
-    if not n * point == ellipticcurve.INFINITY:
+    if verify and not n * point == ellipticcurve.INFINITY:
       raise RuntimeError("Generator point order is bad.")
     if point.x() < 0 or n <= point.x() or point.y() < 0 or n <= point.y():
       raise RuntimeError("Generator point has x or y out of range.")
@@ -97,18 +148,23 @@ class Public_key( object ):
 
     # From X9.62 J.3.1.
 
-    G = self.generator
-    n = G.order()
-    r = signature.r
-    s = signature.s
-    if r < 1 or r > n-1: return False
-    if s < 1 or s > n-1: return False
-    c = numbertheory.inverse_mod( s, n )
-    u1 = ( hash * c ) % n
-    u2 = ( r * c ) % n
-    xy = u1 * G + u2 * self.point
-    v = xy.x() % n
-    return v == r
+    with opcount.operation( "verify" ):
+      G = self.generator
+      n = G.order()
+      r = signature.r
+      s = signature.s
+      if r < 1 or r > n-1: return False
+      if s < 1 or s > n-1: return False
+      c = numbertheory.inverse_mod( s, n )
+      u1 = ( hash * c ) % n
+      u2 = ( r * c ) % n
+      if self.generator_table is not None and self.point_table is not None:
+        xy = self.generator_table.multiply( u1 ) + \
+             self.point_table.multiply( u2 )
+      else:
+        xy = G.mul_add( u1, self.point, u2 )
+      v = xy.x() % n
+      return v == r
 
 
 
@@ -123,6 +179,8 @@ class Private_key( object ):
 
     self.public_key = public_key
     self.secret_multiplier = secret_multiplier
+    # Optional ellipticcurve.FixedBaseTable for the generator, used by sign.
+    self.generator_table = None
 
   def sign( self, hash, random_k ):
     """Return a signature for the provided hash, using the provided
@@ -139,16 +197,20 @@ class Private_key( object ):
     random value k is in order.
     """
 
-    G = self.public_key.generator
-    n = G.order()
-    k = random_k % n
-    p1 = k * G
-    r = p1.x()
-    if r == 0: raise RuntimeError("amazingly unlucky random number r")
-    s = ( numbertheory.inverse_mod( k, n ) * \
-          ( hash + ( self.secret_multiplier * r ) % n ) ) % n
-    if s == 0: raise RuntimeError("amazingly unlucky random number s")
-    return Signature( r, s )
+    with opcount.operation( "sign" ):
+      G = self.public_key.generator
+      n = G.order()
+      k = random_k % n
+      if self.generator_table is not None:
+        p1 = self.generator_table.multiply( k )
+      else:
+        p1 = k * G
+      r = p1.x()
+      if r == 0: raise RuntimeError("amazingly unlucky random number r")
+      s = ( numbertheory.inverse_mod( k, n ) * \
+            ( hash + ( self.secret_multiplier * r ) % n ) ) % n
+      if s == 0: raise RuntimeError("amazingly unlucky random number s")
+      return Signature( r, s )
 
 
 
@@ -274,7 +336,18 @@ _Gx = 0x79be667ef9dcbbac55a06295ce870b07029bfcdb2dce28d959f2815b16f81798
 _Gy = 0x483ada7726a3c4655da4fbfc0e1108a8fd17b448a68554199c47d08ffb10d4b8
 _r  = 0xfffffffffffffffffffffffffffffffebaaedce6af48a03bbfd25e8cd0364141
 
-curve_secp256k1 = ellipticcurve.CurveFp( _p, _a, _b)
+# secp256k1 has a = 0 and p = 1 mod 3, which gives it the endomorphism
+# ( x, y ) -> ( beta*x, y ) = lambda*( x, y ) used to speed up multiplication.
+_beta = 0x7ae96a2b657c07106e64479eac3434e99cf0497512f58995c1396c28719501ee
+_lambda = 0x5363ad4cc05c30e0a5261c028812645a122e22ea20816678df02967c1b23bd72
+_a1 = 0x3086d221a7d46bcde86c90e49284eb15
+_b1 = -0xe4437ed6010e88286f547fa90abfe4c3
+_a2 = 0x114ca50f7a8e2f3f657c1108d9d44cfd8
+_b2 = 0x3086d221a7d46bcde86c90e49284eb15
+
+curve_secp256k1 = ellipticcurve.CurveFp(
+  _p, _a, _b,
+  ellipticcurve.GLVEndomorphism( _beta, _lambda, _r, _a1, _b1, _a2, _b2 ) )
 generator_secp256k1 = ellipticcurve.Point( curve_secp256k1, _Gx, _Gy, _r)
 
 
@@ -36,14 +36,19 @@ from __future__ import division
 
 from six import print_
 from . import numbertheory
+from . import opcount
 
 class CurveFp( object ):
   """Elliptic Curve over the field of integers modulo a prime."""
-  def __init__( self, p, a, b ):
-    """The curve of points satisfying y^2 = x^3 + a*x + b (mod p)."""
+  def __init__( self, p, a, b, endomorphism = None ):
+    """The curve of points satisfying y^2 = x^3 + a*x + b (mod p).
+
+    endomorphism (optional) is a GLVEndomorphism of the curve; when given,
+    point multiplications on this curve use it automatically."""
     self.__p = p
     self.__a = a
     self.__b = b
+    self.__endomorphism = endomorphism
 
   def p( self ):
     return self.__p
@@ -54,6 +59,9 @@ class CurveFp( object ):
   def b( self ):
     return self.__b
 
+  def endomorphism( self ):
+    return self.__endomorphism
+
   def contains_point( self, x, y ):
     """Is the point (x,y) on this curve?"""
     return ( y * y - ( x * x * x + self.__a * x + self.__b ) ) % self.__p == 0
@@ -96,6 +104,11 @@ class Point( object ):
       else:
         return self.double()
 
+    counts = opcount.active
+    if counts is not None:
+      counts.record( "additions" )
+      counts.record( "multiplications", 3 )
+
     p = self.__curve.p()
 
     l = ( ( other.__y - self.__y ) * \
@@ -121,6 +134,12 @@ class Point( object ):
     if self == INFINITY: return INFINITY
     assert e > 0
 
+    counts = opcount.active
+    if counts is not None: counts.record( "scalar_multiplications" )
+
+    if self.__curve.endomorphism():
+      return multi_mul( self.__terms( e ) )
+
     # From X9.62 D.3.2:
 
     e3 = 3 * e
@@ -142,6 +161,37 @@ class Point( object ):
 
     return self * other
 
+  def mul_add( self, self_mul, other, other_mul ):
+    """Return self * self_mul + other * other_mul.
+
+    Both products share a single chain of doublings (Shamir's trick), which
+    is noticeably cheaper than two separate multiplications and an
+    addition."""
+
+    if self.__order: self_mul = self_mul % self.__order
+    if other.__order: other_mul = other_mul % other.__order
+    if self_mul == 0 or self == INFINITY: return other * other_mul
+    if other_mul == 0 or other == INFINITY: return self * self_mul
+    assert self_mul > 0 and other_mul > 0
+
+    counts = opcount.active
+    if counts is not None: counts.record( "scalar_multiplications" )
+
+    return multi_mul( self.__terms( self_mul ) + other.__terms( other_mul ) )
+
+  def __terms( self, e ):
+    """Return ( point, multiplier ) pairs that sum to self * e, splitting
+    e in two half-length multipliers when the curve has an endomorphism."""
+
+    endomorphism = self.__curve.endomorphism()
+    if endomorphism is None: return [ ( self, e ) ]
+    k1, k2 = endomorphism.split( e )
+    return [ ( self, k1 ), ( endomorphism.apply( self ), k2 ) ]
+
+  def __neg__( self ):
+    if self == INFINITY: return INFINITY
+    return Point( self.__curve, self.__x, ( -self.__y ) % self.__curve.p() )
+
   def __str__( self ):
     if self == INFINITY: return "infinity"
     return "(%d,%d)" % ( self.__x, self.__y )
@@ -152,6 +202,11 @@ class Point( object ):
     if self == INFINITY:
       return INFINITY
 
+    counts = opcount.active
+    if counts is not None:
+      counts.record( "doublings" )
+      counts.record( "multiplications", 4 )
+
     # X9.62 B.3:
 
     p = self.__curve.p()
@@ -181,6 +236,202 @@ class Point( object ):
 # This one point is the Point At Infinity for all purposes:
 INFINITY = Point( None, None, None )
 
+
+def multi_mul( terms ):
+  """Return the sum of point * multiplier over the ( point, multiplier )
+  pairs in terms.
+
+  All the products share one chain of doublings (Shamir's trick, with a
+  table of the sums of every subset of the points), so the cost is set by
+  the longest multiplier rather than by the number of terms.  Multipliers
+  may be negative."""
+
+  points = []
+  multipliers = []
+  for point, e in terms:
+    if e < 0: point, e = -point, -e
+    if e == 0 or point == INFINITY: continue
+    points.append( point )
+    multipliers.append( e )
+  if not points: return INFINITY
+
+  # table[i] is the sum of the points whose bit is set in i:
+  table = [ INFINITY ]
+  for point in points:
+    table.extend( [ partial + point for partial in table ] )
+
+  result = INFINITY
+  for i in range( max( [ e.bit_length() for e in multipliers ] ) - 1, -1, -1 ):
+    result = result.double()
+    index = 0
+    for j, e in enumerate( multipliers ):
+      index |= ( ( e >> i ) & 1 ) << j
+    if index: result = result + table[index]
+
+  return result
+
+
+class GLVEndomorphism( object ):
+  """The endomorphism ( x, y ) -> ( beta*x, y ) of a curve with a = 0,
+  which maps every point P of the order-n group to lambda*P.
+
+  It lets a multiplier k be split as k = k1 + k2*lambda (mod n) with k1 and
+  k2 about half as long as n (Gallant, Lambert and Vanstone), so that
+  k*P = k1*P + k2*phi(P) takes half the doublings. ( a1, b1 ) and
+  ( a2, b2 ) are a short basis of the lattice of ( x, y ) with
+  x + y*lambda = 0 (mod n)."""
+
+  def __init__( self, beta, lam, order, a1, b1, a2, b2 ):
+    self.__beta = beta
+    self.__lambda = lam
+    self.__order = order
+    self.__a1 = a1
+    self.__b1 = b1
+    self.__a2 = a2
+    self.__b2 = b2
+
+  def beta( self ):
+    return self.__beta
+
+  def lam( self ):
+    return self.__lambda
+
+  def split( self, k ):
+    """Return ( k1, k2 ), possibly negative, with k = k1 + k2*lambda mod n."""
+
+    n = self.__order
+    k = k % n
+    c1 = ( self.__b2 * k + n // 2 ) // n
+    c2 = ( -self.__b1 * k + n // 2 ) // n
+    k1 = k - c1 * self.__a1 - c2 * self.__a2
+    k2 = -c1 * self.__b1 - c2 * self.__b2
+    return k1, k2
+
+  def apply( self, point ):
+    """Return phi( point ), which equals lambda * point."""
+
+    if point == INFINITY: return INFINITY
+    counts = opcount.active
+    if counts is not None: counts.record( "multiplications" )
+    curve = point.curve()
+    return Point( curve, ( self.__beta * point.x() ) % curve.p(), point.y() )
+
+
+def add_many( points, others ):
+  """Return [ p + q for p, q in zip( points, others ) ].
+
+  All the points must be on the same curve. The regular additions share a
+  single field inversion (see numbertheory.inverse_mod_many); the special
+  cases (infinity, doubling, opposite points) go through Point.__add__."""
+
+  results = list( points )
+  pending = []
+  for i, ( p1, p2 ) in enumerate( zip( points, others ) ):
+    if p2 == INFINITY: continue
+    if p1 == INFINITY or p1.x() == p2.x():
+      results[i] = p1 + p2
+    else:
+      pending.append( i )
+  if not pending: return results
+
+  curve = points[pending[0]].curve()
+  p = curve.p()
+  inverses = numbertheory.inverse_mod_many(
+    [ ( others[i].x() - points[i].x() ) % p for i in pending ], p )
+
+  counts = opcount.active
+  if counts is not None:
+    counts.record( "additions", len( pending ) )
+    counts.record( "multiplications", 3 * len( pending ) )
+
+  for i, inverse in zip( pending, inverses ):
+    x1, y1 = points[i].x(), points[i].y()
+    x2, y2 = others[i].x(), others[i].y()
+    assert others[i].curve() == curve
+    l = ( ( y2 - y1 ) * inverse ) % p
+    x3 = ( l * l - x1 - x2 ) % p
+    y3 = ( l * ( x1 - x3 ) - y1 ) % p
+    results[i] = Point( curve, x3, y3 )
+  return results
+
+
+class FixedBaseTable( object ):
+  """Precomputed multiples of one point of known order, for multiplying
+  that point by many different integers.
+
+  The multiplier is split in windows of `width' bits; row i of the table
+  holds d * 2**(width*i) * point for every window value d, so a
+  multiplication takes one addition per window and no doublings.
+
+  order defaults to the order of point.  rows, if given, are used instead
+  of computing the table; any sequence of rows indexable by window value
+  will do (see the tables module for rows read from a file)."""
+
+  def __init__( self, point, width = 4, order = None, rows = None ):
+    if order is None: order = point.order()
+    if not order:
+      raise ValueError( "FixedBaseTable needs a point with a known order" )
+    self.__point = point
+    self.__order = order
+    self.__width = width
+    if rows is None:
+      rows = []
+      base = point
+      for i in range( self.row_count( order, width ) ):
+        row = [ INFINITY, base ]
+        for d in range( 2, 1 << width ):
+          row.append( row[-1] + base )
+        rows.append( row )
+        base = row[-1] + base
+    self.__rows = rows
+
+  @staticmethod
+  def row_count( order, width ):
+    return ( order.bit_length() + width - 1 ) // width
+
+  def point( self ):
+    return self.__point
+
+  def order( self ):
+    return self.__order
+
+  def width( self ):
+    return self.__width
+
+  def rows( self ):
+    return self.__rows
+
+  def multiply( self, e ):
+    """Return point * e."""
+
+    counts = opcount.active
+    if counts is not None: counts.record( "scalar_multiplications" )
+
+    e = e % self.__order
+    mask = ( 1 << self.__width ) - 1
+    result = INFINITY
+    for row in self.__rows:
+      digit = e & mask
+      if digit: result = result + row[digit]
+      e >>= self.__width
+    return result
+
+  def multiply_many( self, multipliers ):
+    """Return [ point * e for e in multipliers ], with the additions of all
+    the products batched through add_many()."""
+
+    counts = opcount.active
+    if counts is not None:
+      counts.record( "scalar_multiplications", len( multipliers ) )
+
+    multipliers = [ e % self.__order for e in multipliers ]
+    mask = ( 1 << self.__width ) - 1
+    results = [ INFINITY ] * len( multipliers )
+    for row in self.__rows:
+      results = add_many( results, [ row[e & mask] for e in multipliers ] )
+      multipliers = [ e >> self.__width for e in multipliers ]
+    return results
+
 def __main__():
 
   class FailedTest(Exception): pass
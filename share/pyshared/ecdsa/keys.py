@@ -1,10 +1,13 @@
 import binascii
 
 from . import ecdsa
+from . import ellipticcurve
 from . import der
 from . import rfc6979
+from . import opcount
 from .curves import NIST192p, find_curve
 from .util import string_to_number, number_to_string, randrange
+from .util import randrange_many
 from .util import sigencode_string, sigdecode_string
 from .util import oid_ecPublicKey, encoded_oid_ecPublicKey
 from six import PY3, b
@@ -21,11 +24,12 @@ class VerifyingKey:
             raise TypeError("Please use SigningKey.generate() to construct me")
 
     @classmethod
-    def from_public_point(klass, point, curve=NIST192p, hashfunc=sha1):
+    def from_public_point(klass, point, curve=NIST192p, hashfunc=sha1,
+                          validate_point=True):
         self = klass(_error__please_use_generate=True)
         self.curve = curve
         self.default_hashfunc = hashfunc
-        self.pubkey = ecdsa.Public_key(curve.generator, point)
+        self.pubkey = ecdsa.Public_key(curve.generator, point, validate_point)
         self.pubkey.order = curve.order
         return self
 
@@ -43,7 +47,6 @@ class VerifyingKey:
         y = string_to_number(ys)
         if validate_point:
             assert ecdsa.point_is_valid(curve.generator, x, y)
-        from . import ellipticcurve
         point = ellipticcurve.Point(curve.curve, x, y, order)
         return klass.from_public_point(point, curve, hashfunc)
 
@@ -74,6 +77,42 @@ class VerifyingKey:
         assert point_str.startswith(b("\x00\x04"))
         return klass.from_string(point_str[2:], curve)
 
+    @classmethod
+    def from_public_key_recovery(klass, signature, data, curve, hashfunc=sha1,
+                                 sigdecode=sigdecode_string):
+        # returns the list of verifying keys (usually two) for which
+        # signature is a valid signature of data
+        digest = hashfunc(data).digest()
+        return klass.from_public_key_recovery_with_digest(signature, digest,
+                                                          curve, hashfunc,
+                                                          sigdecode)
+
+    @classmethod
+    def from_public_key_recovery_with_digest(klass, signature, digest, curve,
+                                             hashfunc=sha1,
+                                             sigdecode=sigdecode_string):
+        if len(digest) > curve.baselen:
+            raise BadDigestError("this curve (%s) is too short "
+                                 "for your digest (%d)" % (curve.name,
+                                                           8*len(digest)))
+        number = string_to_number(digest)
+        r, s = sigdecode(signature, curve.order)
+        sig = ecdsa.Signature(r, s)
+        return [klass.from_public_point(point, curve, hashfunc)
+                for point in sig.recover_public_points(number, curve.generator)]
+
+    def precompute(self, table=None):
+        # Speed up verify() with precomputed multiples of the generator (the
+        # curve's generator table) and of this key's point. table is an
+        # ellipticcurve.FixedBaseTable for the point, e.g. one read with
+        # tables.load_key_table(); by default it is computed here.
+        if table is None:
+            table = ellipticcurve.FixedBaseTable(self.pubkey.point,
+                                                 order=self.curve.order)
+        assert table.point() == self.pubkey.point
+        self.pubkey.generator_table = self.curve.generator_table()
+        self.pubkey.point_table = table
+
     def to_string(self):
         # VerifyingKey.from_string(vk.to_string()) == vk as long as the
         # curves are the same: the curve itself is not included in the
@@ -122,6 +161,22 @@ class SigningKey:
         secexp = randrange(curve.order, entropy)
         return klass.from_secret_exponent(secexp, curve, hashfunc)
 
+    @classmethod
+    def generate_many(klass, count, curve=NIST192p, entropy=None,
+                      hashfunc=sha1):
+        # Like [generate() for i in range(count)], for bulk provisioning:
+        # the entropy for all the keys is drawn at once and the public
+        # points come out of one batched pass over the curve's precomputed
+        # generator table. Those points are multiples of the generator by
+        # construction (and Point still checks that they are on the curve),
+        # so the order check of from_secret_exponent() is skipped.
+        secexps = randrange_many(curve.order, count, entropy)
+        with opcount.operation("keygen"):
+            points = curve.generator_table().multiply_many(secexps)
+            return [klass._from_key_pair(secexp, point, curve, hashfunc,
+                                         validate_point=False)
+                    for secexp, point in zip(secexps, points)]
+
     # to create a signing key from a short (arbitrary-length) seed, convert
     # that seed into an integer with something like
     # secexp=util.randrange_from_seed__X(seed, curve.order), and then pass
@@ -129,17 +184,24 @@ class SigningKey:
 
     @classmethod
     def from_secret_exponent(klass, secexp, curve=NIST192p, hashfunc=sha1):
+        assert 1 <= secexp < curve.order
+        with opcount.operation("keygen"):
+            pubkey_point = curve.generator*secexp
+            return klass._from_key_pair(secexp, pubkey_point, curve, hashfunc)
+
+    @classmethod
+    def _from_key_pair(klass, secexp, pubkey_point, curve, hashfunc,
+                       validate_point=True):
         self = klass(_error__please_use_generate=True)
         self.curve = curve
         self.default_hashfunc = hashfunc
         self.baselen = curve.baselen
         n = curve.order
-        assert 1 <= secexp < n
-        pubkey_point = curve.generator*secexp
-        pubkey = ecdsa.Public_key(curve.generator, pubkey_point)
+        pubkey = ecdsa.Public_key(curve.generator, pubkey_point, validate_point)
         pubkey.order = n
         self.verifying_key = VerifyingKey.from_public_point(pubkey_point, curve,
-                                                            hashfunc)
+                                                            hashfunc,
+                                                            validate_point)
         self.privkey = ecdsa.Private_key(pubkey, secexp)
         self.privkey.order = n
         return self
@@ -219,6 +281,12 @@ class SigningKey:
     def get_verifying_key(self):
         return self.verifying_key
 
+    def precompute(self):
+        # use the curve's generator table for signing, and precompute the
+        # verifying key as well
+        self.privkey.generator_table = self.curve.generator_table()
+        self.verifying_key.precompute()
+
     def sign_deterministic(self, data, hashfunc=None, sigencode=sigencode_string):
         hashfunc = hashfunc or self.default_hashfunc
         digest = hashfunc(data).digest()
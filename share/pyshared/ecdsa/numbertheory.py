@@ -13,6 +13,7 @@ from __future__ import division
 
 from six import print_, integer_types
 from six.moves import reduce
+from . import opcount
 
 import math
 import types
@@ -173,12 +174,15 @@ def square_root_mod_prime( a, p ):
     if d == p-1: return ( 2 * a * modular_exp( 4*a, (p-5)//8, p ) ) % p
     raise RuntimeError("Shouldn't get here.")
 
-  for b in range( 2, p ):
+  # A counter rather than range(), which cannot span a large p on Python 2.
+  b = 2
+  while b < p:
     if jacobi( b*b-4*a, p ) == -1:
       f = ( a, -b, 1 )
       ff = polynomial_exp_mod( ( 0, 1 ), (p+1)//2, f, p )
       assert ff[1] == 0
       return ff[0]
+    b += 1
   raise RuntimeError("No b found.")
 
 
@@ -186,6 +190,9 @@ def square_root_mod_prime( a, p ):
 def inverse_mod( a, m ):
   """Inverse of a mod m."""
 
+  counts = opcount.active
+  if counts is not None: counts.record( "inversions" )
+
   if a < 0 or m <= a: a = a % m
 
   # From Ferguson and Schneier, roughly:
@@ -204,6 +211,30 @@ def inverse_mod( a, m ):
   else: return ud + m
 
 
+def inverse_mod_many( values, m ):
+  """Inverses of all the values mod m, at the cost of a single inverse_mod
+  and three multiplications per value (Montgomery's trick)."""
+
+  if not values: return []
+
+  counts = opcount.active
+  if counts is not None:
+    counts.record( "multiplications", 3 * ( len( values ) - 1 ) )
+
+  prefix = []
+  acc = 1
+  for v in values:
+    acc = ( acc * v ) % m
+    prefix.append( acc )
+  inverse = inverse_mod( acc, m )
+  result = [ None ] * len( values )
+  for i in range( len( values ) - 1, 0, -1 ):
+    result[i] = ( inverse * prefix[i-1] ) % m
+    inverse = ( inverse * values[i] ) % m
+  result[0] = inverse
+  return result
+
+
 def gcd2(a, b):
   """Greatest common divisor using Euclid's algorithm."""
   while a:
@@ -0,0 +1,92 @@
+"""
+Optional operation counters for the elliptic curve arithmetic.
+
+Counting is off by default. Inside a counting() block every field inversion
+(numbertheory.inverse_mod), field multiplication, point doubling, point
+addition and scalar multiplication is recorded against the high-level
+operation being performed ("keygen", "sign" or "verify"; work done outside
+of those is recorded under None):
+
+  from ecdsa import opcount
+  with opcount.counting() as counts:
+      sig = sk.sign(data)
+      vk.verify(sig, data)
+  print_(counts["verify"]["inversions"])
+
+Field multiplications are counted per point formula (squarings included,
+multiplications by small constants excluded), not per Python
+multiplication.
+
+The counters are global to the process and not thread-safe; count one
+thing at a time. When counting is disabled the arithmetic only pays for a
+single module attribute lookup per point operation.
+"""
+
+from contextlib import contextmanager
+
+EVENTS = ("inversions", "multiplications", "doublings", "additions",
+          "scalar_multiplications")
+
+# The OperationCounts instance collecting events, or None when counting is
+# disabled. The instrumented code reads this before recording anything.
+active = None
+
+class OperationCounts(object):
+    def __init__(self):
+        self.current = None
+        self.counts = {}
+
+    def record(self, event, n=1):
+        ops = self.counts.get(self.current)
+        if ops is None:
+            ops = self.counts[self.current] = dict((e, 0) for e in EVENTS)
+        ops[event] += n
+
+    def __getitem__(self, operation):
+        """Return the event counts of one high-level operation."""
+        return dict(self.counts.get(operation, dict((e, 0) for e in EVENTS)))
+
+    def operations(self):
+        return list(self.counts.keys())
+
+    def total(self):
+        """Return the event counts summed over all operations."""
+        totals = dict((e, 0) for e in EVENTS)
+        for ops in self.counts.values():
+            for event, n in ops.items():
+                totals[event] += n
+        return totals
+
+    def __repr__(self):
+        return "OperationCounts(%r)" % (self.counts,)
+
+@contextmanager
+def counting():
+    """Count the arithmetic done inside the block.
+
+    Yields the OperationCounts collecting the events. Nested counting()
+    blocks collect independently; the outer one does not see the events of
+    the inner one.
+    """
+    global active
+    previous = active
+    counts = OperationCounts()
+    active = counts
+    try:
+        yield counts
+    finally:
+        active = previous
+
+@contextmanager
+def operation(name):
+    """Record the arithmetic done inside the block against operation name."""
+    counts = active
+    if counts is None:
+        yield
+        return
+    previous = counts.current
+    counts.current = name
+    try:
+        yield
+    finally:
+        counts.current = previous
@@ -0,0 +1,175 @@
+"""
+Precomputation tables saved to disk and memory-mapped at startup.
+
+Building a FixedBaseTable (see ellipticcurve) costs about as much as a few
+scalar multiplications, which is significant for short-lived processes.
+The functions here write a table once and later map the file read-only:
+
+  tables.save_generator_table(NIST256p, "nist256p.tbl")  # once
+  tables.load_generator_table(NIST256p, "nist256p.tbl")  # at startup
+
+  tables.save_key_table(vk, "key.tbl")
+  tables.load_key_table(vk, "key.tbl")   # calls vk.precompute(table)
+
+The mapping is shared (and read-only), so workers forked after loading a
+table use the same physical pages; points are decoded from the mapping
+when a multiplication needs them, which is cheap next to the point
+additions they save.
+
+Each file starts with a header holding the format version and a
+fingerprint of the curve parameters, the base point and the window width.
+A file written for another curve, key, width or format version raises
+StaleTableError instead of producing wrong results.
+
+File layout (all integers big-endian):
+
+  header   magic "ECDSATBL", format version (2 bytes), window width
+           (1 byte), padding (1 byte), coordinate length (2 bytes),
+           padding (2 bytes), number of rows (4 bytes), fingerprint
+           (32 bytes, SHA-256)
+  entries  for every row i and window value d in 1..2**width-1, the x and
+           y coordinates of d * 2**(width*i) * point, each padded to the
+           coordinate length
+"""
+
+import os
+import mmap
+import struct
+import tempfile
+from hashlib import sha256
+
+from six import b
+from . import ellipticcurve
+from .util import number_to_string, string_to_number
+
+FORMAT_VERSION = 1
+MAGIC = b("ECDSATBL")
+_HEADER = struct.Struct(">8sHBBHHI32s")
+
+class StaleTableError(Exception):
+    pass
+
+def fingerprint(curve, point, width):
+    """Identify the table of point on curve with the given window width."""
+    parts = ["ecdsa-table-v%d" % FORMAT_VERSION, curve.name, width,
+             curve.curve.p(), curve.curve.a(), curve.curve.b(), curve.order,
+             curve.generator.x(), curve.generator.y(), point.x(), point.y()]
+    return sha256(":".join(str(part) for part in parts).encode()).digest()
+
+class _MappedRow(object):
+    # one row of a table, decoding points from the mapping on access
+    def __init__(self, data, offset, coord_len, curve):
+        self.data = data
+        self.offset = offset
+        self.coord_len = coord_len
+        self.curve = curve
+
+    def __getitem__(self, digit):
+        if digit == 0:
+            return ellipticcurve.INFINITY
+        start = self.offset + (digit-1) * 2 * self.coord_len
+        middle = start + self.coord_len
+        x = string_to_number(self.data[start:middle])
+        y = string_to_number(self.data[middle:middle+self.coord_len])
+        # Point() checks that the decoded coordinates are on the curve
+        return ellipticcurve.Point(self.curve, x, y)
+
+class _MappedRows(object):
+    def __init__(self, data, row_count, width, coord_len, curve):
+        self.data = data
+        self.row_len = ((1 << width) - 1) * 2 * coord_len
+        self.rows = [_MappedRow(data, _HEADER.size + i * self.row_len,
+                                coord_len, curve)
+                     for i in range(row_count)]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        return self.rows[i]
+
+    def __iter__(self):
+        return iter(self.rows)
+
+def save_table(table, curve, path):
+    """Write table (a FixedBaseTable of a point on curve) to path.
+
+    The file is written next to path and renamed into place, so processes
+    loading the table never see a partial file.
+    """
+    width = table.width()
+    coord_len = len(number_to_string(0, curve.curve.p()))
+    header = _HEADER.pack(MAGIC, FORMAT_VERSION, width, 0, coord_len, 0,
+                          len(table.rows()),
+                          fingerprint(curve, table.point(), width))
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(header)
+            for row in table.rows():
+                for digit in range(1, 1 << width):
+                    point = row[digit]
+                    assert not point == ellipticcurve.INFINITY
+                    f.write(number_to_string(point.x(), curve.curve.p()))
+                    f.write(number_to_string(point.y(), curve.curve.p()))
+        os.rename(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+def load_table(path, curve, point):
+    """Map the table of point on curve written by save_table().
+
+    Returns an ellipticcurve.FixedBaseTable reading its rows from the file.
+    Raises StaleTableError if the file was written for another curve,
+    point, or format version, or is truncated.
+    """
+    with open(path, "rb") as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # mmap refuses empty files
+            raise StaleTableError("%s: empty table file" % path)
+    if len(data) < _HEADER.size:
+        raise StaleTableError("%s: truncated table header" % path)
+    (magic, version, width, _, coord_len, _, row_count,
+     stored_fingerprint) = _HEADER.unpack(data[:_HEADER.size])
+    if magic != MAGIC:
+        raise StaleTableError("%s is not a precomputation table" % path)
+    if version != FORMAT_VERSION:
+        raise StaleTableError("%s: table format version %d, expected %d"
+                              % (path, version, FORMAT_VERSION))
+    if stored_fingerprint != fingerprint(curve, point, width):
+        raise StaleTableError("%s was not written for this %s point"
+                              % (path, curve.name))
+    if row_count != ellipticcurve.FixedBaseTable.row_count(curve.order, width):
+        raise StaleTableError("%s: bad row count %d" % (path, row_count))
+    rows = _MappedRows(data, row_count, width, coord_len, curve.curve)
+    if len(data) != _HEADER.size + row_count * rows.row_len:
+        raise StaleTableError("%s: table size %d does not match its header"
+                              % (path, len(data)))
+    return ellipticcurve.FixedBaseTable(point, width, curve.order, rows)
+
+def save_generator_table(curve, path):
+    save_table(curve.generator_table(), curve, path)
+
+def load_generator_table(curve, path):
+    """Map the generator table at path and install it on curve."""
+    table = load_table(path, curve, curve.generator)
+    curve.set_generator_table(table)
+    return table
+
+def save_key_table(verifying_key, path, width=4):
+    point = verifying_key.pubkey.point
+    if verifying_key.pubkey.point_table is not None:
+        table = verifying_key.pubkey.point_table
+    else:
+        table = ellipticcurve.FixedBaseTable(point, width,
+                                             verifying_key.curve.order)
+    save_table(table, verifying_key.curve, path)
+
+def load_key_table(verifying_key, path):
+    """Map the table of verifying_key at path and precompute the key with it."""
+    table = load_table(path, verifying_key.curve, verifying_key.pubkey.point)
+    verifying_key.precompute(table)
+    return table
@@ -4,21 +4,28 @@ import unittest
 import os
 import time
 import shutil
+import tempfile
 import subprocess
 from binascii import hexlify, unhexlify
 from hashlib import sha1, sha256, sha512
 
 from six import b, print_, binary_type
 from .keys import SigningKey, VerifyingKey
-from .keys import BadSignatureError
+from .keys import BadSignatureError, BadDigestError
 from . import util
 from .util import sigencode_der, sigencode_strings
 from .util import sigdecode_der, sigdecode_strings
 from .curves import Curve, UnknownCurveError
 from .curves import NIST192p, NIST224p, NIST256p, NIST384p, NIST521p, SECP256k1
-from .ellipticcurve import Point
+from .ellipticcurve import Point, INFINITY, FixedBaseTable, add_many, CurveFp
+from . import ecdsa
+from . import numbertheory
 from . import der
 from . import rfc6979
+from . import bench
+from . import opcount
+from . import tables
+from . import batch
 
 class SubprocessError(Exception):
     pass
@@ -298,6 +305,97 @@ class ECDSA(unittest.TestCase):
                                        curve=NIST256p)
         self.assertTrue(vk3.verify(sig, data, hashfunc=sha256))
 
+    def test_mul_add(self):
+        G = NIST192p.generator
+        n = NIST192p.order
+        Q = G * 12345
+        for a, b_ in ((1, 1), (2, 3), (n-1, 5), (0, 7), (7, 0), (n+3, 2*n+9),
+                      (util.randrange(n), util.randrange(n))):
+            expected = G * a + Q * b_
+            self.assertEqual(G.mul_add(a, Q, b_), expected)
+        # the intermediate sum may be the point at infinity
+        minus_G = G * (n-1)
+        self.assertEqual(G.mul_add(3, minus_G, 1), G * 2)
+        self.assertEqual(G.mul_add(1, minus_G, 1), INFINITY)
+
+    def test_inverse_mod_many(self):
+        p = NIST192p.curve.p()
+        values = [1, 2, 3, p-1, 12345678901234567890]
+        self.assertEqual(numbertheory.inverse_mod_many(values, p),
+                         [numbertheory.inverse_mod(v, p) for v in values])
+        self.assertEqual(numbertheory.inverse_mod_many([], p), [])
+
+    def test_add_many(self):
+        G = NIST192p.generator
+        points = [G, G * 2, INFINITY, G * 5, G * 7, G]
+        others = [G * 3, G * 2, G * 4, INFINITY, G * (NIST192p.order-7),
+                  G * 9]
+        self.assertEqual(add_many(points, others),
+                         [p1 + p2 for p1, p2 in zip(points, others)])
+
+    def test_fixed_base_table(self):
+        G = NIST224p.generator
+        n = NIST224p.order
+        table = FixedBaseTable(G, width=3)
+        multipliers = [1, 2, 7, 8, n-1, n, n+5, 2**200+1,
+                       util.randrange(n)]
+        for e in multipliers:
+            self.assertEqual(table.multiply(e), G * e)
+        self.assertEqual(table.multiply_many(multipliers),
+                         [G * e for e in multipliers])
+        self.assertRaises(ValueError, FixedBaseTable,
+                          Point(NIST224p.curve, G.x(), G.y()))
+
+    def test_generate_many(self):
+        s = b("all the entropy in the entire world, compressed into one line")
+        def not_much_entropy(numbytes):
+            return (s * (numbytes // len(s) + 1))[:numbytes]
+        keys = SigningKey.generate_many(4, NIST256p, entropy=not_much_entropy,
+                                        hashfunc=sha256)
+        self.assertEqual(len(keys), 4)
+        secexps = util.randrange_many(NIST256p.order, 4, not_much_entropy)
+        for secexp, sk in zip(secexps, keys):
+            expected = SigningKey.from_secret_exponent(secexp, NIST256p,
+                                                       sha256)
+            self.assertEqual(sk.to_string(), expected.to_string())
+            self.assertEqual(sk.get_verifying_key().to_string(),
+                             expected.get_verifying_key().to_string())
+            sig = sk.sign(b("data"))
+            self.assertTrue(expected.get_verifying_key().verify(sig,
+                                                                b("data")))
+        self.assertEqual(SigningKey.generate_many(0), [])
+
+    def test_public_key_recovery(self):
+        data = b("data to sign")
+        for curve in (NIST192p, NIST224p, SECP256k1):
+            sk = SigningKey.generate(curve=curve)
+            vk = sk.get_verifying_key()
+            sig = sk.sign(data)
+            recovered = VerifyingKey.from_public_key_recovery(sig, data, curve)
+            self.assertTrue(len(recovered) >= 2)
+            self.assertTrue(vk.to_string() in
+                            [key.to_string() for key in recovered])
+            for key in recovered:
+                self.assertTrue(key.verify(sig, data))
+
+    def test_public_key_recovery_with_digest(self):
+        sk = SigningKey.generate(curve=NIST256p, hashfunc=sha256)
+        vk = sk.get_verifying_key()
+        digest = sha256(b("data")).digest()
+        sig = sk.sign_digest(digest, sigencode=sigencode_der)
+        recovered = VerifyingKey.from_public_key_recovery_with_digest(
+            sig, digest, NIST256p, hashfunc=sha256, sigdecode=sigdecode_der)
+        self.assertTrue(vk.to_string() in
+                        [key.to_string() for key in recovered])
+        for key in recovered:
+            self.assertEqual(key.default_hashfunc, sha256)
+            self.assertTrue(key.verify_digest(sig, digest,
+                                              sigdecode=sigdecode_der))
+        self.assertRaises(BadDigestError,
+                          VerifyingKey.from_public_key_recovery_with_digest,
+                          sig, sha512(b("data")).digest(), NIST256p,
+                          sigdecode=sigdecode_der)
+
 
 class OpenSSL(unittest.TestCase):
     # test interoperability with OpenSSL tools. Note that openssl's ECDSA
@@ -493,6 +591,72 @@ class Util(unittest.TestCase):
                 n = util.randrange(order, entropy=entropy)
                 self.assertTrue(1 <= n < order, (1, n, order))
 
+    def test_randrange_many(self):
+        entropy = util.PRNG("seed")
+        for order in (2, 3, 2**8-1, 2**8, 2**8+1, 2**16+1, 256**20+1,
+                      NIST521p.order):
+            numbers = util.randrange_many(order, 50, entropy=entropy)
+            self.assertEqual(len(numbers), 50)
+            for n in numbers:
+                self.assertTrue(1 <= n < order, (1, n, order))
+        self.assertEqual(util.randrange_many(NIST192p.order, 0), [])
+
+    def test_randrange_single_entropy_call(self):
+        calls = []
+        def entropy(numbytes):
+            calls.append(numbytes)
+            return os.urandom(numbytes)
+        # the order of NIST256p is just below 2**256, so only about one
+        # candidate in 2**32 is rejected: all 20 numbers come from the
+        # first call, and a second call is only needed if one is rejected
+        order = NIST256p.order
+        util.randrange_many(order, 20, entropy=entropy)
+        self.assertEqual(calls[0], 20 * 32)
+        self.assertTrue(len(calls) <= 2)
+
+    def test_randrange_broken_entropy(self):
+        self.assertRaises(RuntimeError, util.randrange, NIST192p.order,
+                          lambda numbytes: b(""))
+
+    def test_sigencode_string_batch(self):
+        order = NIST256p.order
+        sigs = [(1, 2), (order-1, order-2), (2**255, 0x7f),
+                (util.randrange(order), util.randrange(order))]
+        buf = util.sigencode_string_batch(sigs, order)
+        self.assertTrue(isinstance(buf, bytearray))
+        self.assertEqual(bytes(buf), b("").join(
+            [util.sigencode_string(r, s, order) for r, s in sigs]))
+        self.assertEqual(util.sigdecode_string_batch(buf, order), sigs)
+        self.assertEqual(util.sigdecode_string_batch(memoryview(buf), order),
+                         sigs)
+        self.assertEqual(util.sigdecode_string_batch(b(""), order), [])
+        self.assertRaises(AssertionError, util.sigdecode_string_batch,
+                          bytes(buf[:-1]), order)
+
+    def test_sigencode_der_batch(self):
+        order = NIST521p.order
+        sigs = [(0, 1), (127, 128), (order-1, 2**519),
+                (util.randrange(order), util.randrange(order))]
+        buf = util.sigencode_der_batch(sigs, order)
+        self.assertTrue(isinstance(buf, bytearray))
+        self.assertEqual(bytes(buf), b("").join(
+            [sigencode_der(r, s, order) for r, s in sigs]))
+        self.assertEqual(util.sigdecode_der_batch(buf, order), sigs)
+        self.assertEqual(util.sigdecode_der_batch(memoryview(buf), order),
+                         sigs)
+
+    def test_sigdecode_der_batch_errors(self):
+        order = NIST192p.order
+        good = bytes(util.sigencode_der_batch([(5, 6)], order))
+        self.assertRaises(der.UnexpectedDER, util.sigdecode_der_batch,
+                          good[:-1], order)
+        self.assertRaises(der.UnexpectedDER, util.sigdecode_der_batch,
+                          good + b("junk"), order)
+        junk_inside = der.encode_sequence(der.encode_integer(5),
+                                          der.encode_integer(6), b("\x00"))
+        self.assertRaises(der.UnexpectedDER, util.sigdecode_der_batch,
+                          junk_inside, order)
+
     def OFF_test_prove_uniformity(self):
         order = 2**8-2
         counts = dict([(i, 0) for i in range(1, order)])
@@ -507,6 +671,277 @@ class Util(unittest.TestCase):
         for i in range(1, order):
             print_("%3d: %s" % (i, "*"*(counts[i]//100)))
 
+class Bench(unittest.TestCase):
+    def test_run(self):
+        report = bench.run([NIST192p], iterations=3, warmup=0)
+        self.assertEqual(sorted(report["results"]), ["NIST192p"])
+        ops = report["results"]["NIST192p"]
+        self.assertEqual(sorted(ops), sorted(bench.OPERATIONS))
+        for stats in ops.values():
+            self.assertEqual(stats["iterations"], 3)
+            self.assertTrue(stats["ops_per_sec"] > 0)
+            self.assertTrue(stats["min"] <= stats["p50"] <= stats["p99"]
+                            <= stats["max"])
+        self.assertTrue(bench.format_report(report))
+        self.assertRaises(bench.BenchmarkError, bench.run, [NIST192p],
+                          ["no_such_operation"], 1)
+
+    def test_percentile(self):
+        samples = list(range(1, 101))
+        self.assertEqual(bench.percentile(samples, 50), 50)
+        self.assertEqual(bench.percentile(samples, 99), 99)
+        self.assertEqual(bench.percentile([7], 90), 7)
+
+    def test_compare(self):
+        def report(ops_per_sec):
+            return {"results": {"NIST192p": {"sign":
+                                             {"ops_per_sec": ops_per_sec}}}}
+        self.assertEqual(bench.compare(report(80.0), report(100.0), 0.25), [])
+        self.assertEqual(bench.compare(report(70.0), report(100.0), 0.25),
+                         [("NIST192p", "sign", 100.0, 70.0)])
+        self.assertEqual(bench.compare(report(1.0), {"results": {}}), [])
+
+class GLV(unittest.TestCase):
+    # the same curve without the endomorphism, as a reference
+    curve = ecdsa.curve_secp256k1
+    reference = CurveFp(curve.p(), curve.a(), curve.b())
+    G = SECP256k1.generator
+    n = SECP256k1.order
+
+    def to_reference(self, point):
+        return Point(self.reference, point.x(), point.y())
+
+    def test_split(self):
+        endomorphism = self.curve.endomorphism()
+        lam = endomorphism.lam()
+        for k in (0, 1, 2, lam, lam+1, self.n-1, self.n, 2**128, 2**255,
+                  util.randrange(self.n)):
+            k1, k2 = endomorphism.split(k)
+            self.assertEqual((k1 + k2*lam - k) % self.n, 0)
+            self.assertTrue(abs(k1) < 2**129 and abs(k2) < 2**129, (k1, k2))
+
+    def test_endomorphism(self):
+        endomorphism = self.curve.endomorphism()
+        self.assertEqual(endomorphism.apply(self.G),
+                         self.G * endomorphism.lam())
+        self.assertEqual(self.to_reference(endomorphism.apply(self.G)),
+                         self.to_reference(self.G) * endomorphism.lam())
+
+    def test_known_multiples(self):
+        two = self.G * 2
+        self.assertEqual(two.x(), int("c6047f9441ed7d6d3045406e95c07cd85c778e4b8cef3ca7abac09b95c709ee5", 16))
+        self.assertEqual(two.y(), int("1ae168fea63dc339a3c58419466ceaeef7f632653266d0e1236431a950cfe52a", 16))
+        three = self.G * 3
+        self.assertEqual(three.x(), int("f9308a019258c31049344f85f89d5229b531c845836f99b08601f113bce036f9", 16))
+        self.assertEqual(three.y(), int("388f7b0f632de8140fe337e62a37f3566500a99934c2231b6cb9fd7584b8e672", 16))
+        minus_one = self.G * (self.n - 1)
+        self.assertEqual((minus_one.x(), minus_one.y()),
+                         (self.G.x(), self.curve.p() - self.G.y()))
+        self.assertEqual(self.G * self.n, INFINITY)
+
+    def test_same_results_as_generic(self):
+        G_ref = self.to_reference(self.G)
+        Q = self.G * 0xdeadbeef
+        Q_ref = self.to_reference(Q)
+        lam = self.curve.endomorphism().lam()
+        for k in (1, 7, lam, self.n-lam, 2**128-1, 2**255+12345,
+                  util.randrange(self.n), util.randrange(self.n)):
+            self.assertEqual(self.to_reference(self.G * k), G_ref * k)
+            self.assertEqual(self.to_reference(Q * k), Q_ref * k)
+            self.assertEqual(self.to_reference(self.G.mul_add(k, Q, k+1)),
+                             G_ref * k + Q_ref * (k+1))
+
+    def test_signature_vector(self):
+        # RFC 6979 signature of "Satoshi Nakamoto" with the private key 1
+        sk = SigningKey.from_secret_exponent(1, SECP256k1, sha256)
+        sig = sk.sign_deterministic(b("Satoshi Nakamoto"))
+        r, s = util.sigdecode_string(sig, self.n)
+        self.assertEqual(r, int("934b1ea10a4b3c1757e2b0c017d0b6143ce3c9a7e6a4a49860d7a6ab210ee3d8", 16))
+        self.assertEqual(self.n - s, int("2442ce9d2b916064108014783e923ec36b49743e2ffa1c4496f01a512aafd9e5", 16))
+        self.assertTrue(sk.get_verifying_key().verify(sig,
+                                                      b("Satoshi Nakamoto")))
+
+class OpCount(unittest.TestCase):
+    def test_disabled(self):
+        self.assertEqual(opcount.active, None)
+        SigningKey.generate()
+        self.assertEqual(opcount.active, None)
+
+    def test_counting(self):
+        with opcount.counting() as counts:
+            sk = SigningKey.generate(NIST192p)
+            vk = sk.get_verifying_key()
+            sig = sk.sign(b("data"))
+            self.assertTrue(vk.verify(sig, b("data")))
+        self.assertEqual(opcount.active, None)
+        self.assertEqual(sorted(counts.operations(), key=str),
+                         sorted(["keygen", "sign", "verify"], key=str))
+        keygen = counts["keygen"]
+        sign = counts["sign"]
+        verify = counts["verify"]
+        # key generation multiplies the generator and checks the order of
+        # the public point
+        self.assertTrue(keygen["scalar_multiplications"] >= 2)
+        self.assertEqual(sign["scalar_multiplications"], 1)
+        self.assertEqual(verify["scalar_multiplications"], 1)
+        # every affine point operation costs one inversion, and sign and
+        # verify each invert one scalar mod n on top of that
+        for ops, scalar_inversions in ((keygen, 0), (sign, 1), (verify, 1)):
+            self.assertTrue(ops["doublings"] > 0)
+            self.assertTrue(ops["additions"] > 0)
+            self.assertEqual(ops["inversions"],
+                             ops["doublings"] + ops["additions"] +
+                             scalar_inversions)
+            self.assertEqual(ops["multiplications"],
+                             4*ops["doublings"] + 3*ops["additions"])
+        total = counts.total()
+        self.assertEqual(total["scalar_multiplications"],
+                         keygen["scalar_multiplications"] + 2)
+        self.assertEqual(counts["no such operation"]["additions"], 0)
+
+    def test_nested(self):
+        with opcount.counting() as outer:
+            with opcount.counting() as inner:
+                SigningKey.from_secret_exponent(3, NIST192p)
+            self.assertTrue(opcount.active is outer)
+        self.assertTrue(inner["keygen"]["doublings"] > 0)
+        self.assertEqual(outer.operations(), [])
+
+class Tables(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.saved_table = NIST192p._generator_table
+
+    def tearDown(self):
+        NIST192p._generator_table = self.saved_table
+        shutil.rmtree(self.dir)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def test_generator_table(self):
+        path = self.path("nist192p.tbl")
+        tables.save_generator_table(NIST192p, path)
+        table = tables.load_generator_table(NIST192p, path)
+        self.assertTrue(NIST192p.generator_table() is table)
+        G = NIST192p.generator
+        for k in (1, 2, 15, 16, 2**100+3, NIST192p.order-1,
+                  util.randrange(NIST192p.order)):
+            self.assertEqual(table.multiply(k), G * k)
+        self.assertEqual(table.multiply(NIST192p.order), INFINITY)
+        self.assertEqual(table.multiply_many([5, 6]), [G * 5, G * 6])
+
+    def test_key_table(self):
+        sk = SigningKey.generate(NIST192p)
+        vk = sk.get_verifying_key()
+        path = self.path("key.tbl")
+        tables.save_key_table(vk, path)
+        vk2 = VerifyingKey.from_string(vk.to_string(), NIST192p)
+        tables.load_key_table(vk2, path)
+        self.assertEqual(vk2.pubkey.point_table.multiply(12345),
+                         vk.pubkey.point * 12345)
+        sig = sk.sign(b("data"))
+        self.assertTrue(vk2.verify(sig, b("data")))
+        self.assertRaises(BadSignatureError, vk2.verify, sig, b("other"))
+        sk.precompute()
+        self.assertTrue(vk2.verify(sk.sign(b("data")), b("data")))
+
+    def test_stale(self):
+        path = self.path("nist192p.tbl")
+        tables.save_generator_table(NIST192p, path)
+        # another curve, or another point on the same curve
+        self.assertRaises(tables.StaleTableError, tables.load_generator_table,
+                          NIST224p, path)
+        self.assertRaises(tables.StaleTableError, tables.load_table, path,
+                          NIST192p, NIST192p.generator * 2)
+        with open(path, "rb") as f:
+            data = f.read()
+        def load(contents):
+            with open(path, "wb") as f:
+                f.write(contents)
+            return tables.load_table(path, NIST192p, NIST192p.generator)
+        load(data)
+        for contents in (b(""), data[:20], data[:-1], data + b("\0"),
+                         b("X") + data[1:],
+                         data[:8] + b("\0\2") + data[10:]):
+            self.assertRaises(tables.StaleTableError, load, contents)
+        # a corrupted fingerprint
+        fingerprint_at = tables._HEADER.size - 32
+        self.assertRaises(tables.StaleTableError, load,
+                          data[:fingerprint_at] + b("\0")*32 +
+                          data[tables._HEADER.size:])
+
+class Batch(unittest.TestCase):
+    def signatures(self, curve, count):
+        sks = [SigningKey.generate(curve) for i in range(3)]
+        vks = [sks[i % 3].get_verifying_key() for i in range(count)]
+        data = [b("message %d" % i) for i in range(count)]
+        sigs = [sks[i % 3].sign(d) for i, d in enumerate(data)]
+        # a signature of another message, and a corrupted one
+        sigs[1] = sigs[0]
+        sigs[2] = sigs[2][:-1] + b("\0") if sigs[2][-1:] != b("\0") \
+                  else sigs[2][:-1] + b("\1")
+        return vks, sigs, data
+
+    def test_scalar(self):
+        vks, sigs, data = self.signatures(NIST192p, 6)
+        self.assertEqual(batch.verify(vks, sigs, data, engine="scalar"),
+                         [True, False, False, True, True, True])
+        self.assertEqual(batch.verify([], [], []), [])
+        self.assertRaises(ValueError, batch.verify, vks, sigs, data,
+                          engine="no such engine")
+        self.assertRaises(ValueError, batch.verify, vks, sigs[:-1], data)
+        self.assertRaises(BadDigestError, batch.verify_digests, vks[:1],
+                          sigs[:1], [b("\0")*100])
+
+    @unittest.skipIf(batch.numpy is None, "needs numpy")
+    def test_limb_field(self):
+        for curve in (NIST192p, NIST521p):
+            p = curve.curve.p()
+            field = batch.LimbField(p)
+            xs = [0, 1, 2, p-1, p-2, 2**100, util.randrange(p)]
+            ys = [p-1, 0, p-1, p-1, 3, 2**130+1, util.randrange(p)]
+            a, c = field.to_field(xs), field.to_field(ys)
+            self.assertEqual(field.from_field(a), xs)
+            self.assertEqual(field.from_field(field.mul(a, c)),
+                             [(x*y) % p for x, y in zip(xs, ys)])
+            self.assertEqual(field.from_field(field.add(a, c)),
+                             [(x+y) % p for x, y in zip(xs, ys)])
+            self.assertEqual(field.from_field(field.sub(a, c)),
+                             [(x-y) % p for x, y in zip(xs, ys)])
+
+    @unittest.skipIf(batch.numpy is None, "needs numpy")
+    def test_numpy(self):
+        for curve in (NIST192p, SECP256k1):
+            vks, sigs, data = self.signatures(curve, 6)
+            self.assertEqual(batch.verify(vks, sigs, data, engine="numpy"),
+                             [True, False, False, True, True, True])
+        # keys on two curves, with the default engine
+        vks, sigs, data = self.signatures(NIST224p, batch.MIN_NUMPY_BATCH)
+        vks2, sigs2, data2 = self.signatures(NIST192p, 3)
+        results = batch.verify(vks + vks2, sigs + sigs2, data + data2)
+        self.assertEqual(results, batch.verify(vks + vks2, sigs + sigs2,
+                                               data + data2, engine="scalar"))
+        self.assertEqual(results.count(False), 4)
+
+    @unittest.skipIf(batch.numpy is None, "needs numpy")
+    def test_exceptional_lanes(self):
+        G = NIST192p.generator
+        p = NIST192p.curve.p()
+        minus_G = Point(NIST192p.curve, G.x(), p - G.y(), NIST192p.order)
+        cases = [(1, G, 1), (1, minus_G, 1), (0, G * 7, 0), (5, G, 3),
+                 (3, G * 2, 1)]
+        results = batch._mul_add_many(G, [c[0] for c in cases],
+                                      [c[1] for c in cases],
+                                      [c[2] for c in cases])
+        # the point at infinity is left to the scalar engine
+        self.assertEqual(results[1:3], [None, None])
+        for (u1, Q, u2), xz in zip(cases, results):
+            if xz is not None:
+                X, Z = xz
+                expected = G * u1 + Q * u2
+                self.assertEqual(X % p, expected.x() * Z * Z % p)
+
 class RFC6979(unittest.TestCase):
     # https://tools.ietf.org/html/rfc6979#appendix-A.1
     def _do(self, generator, secexp, hsh, hash_func, expected):
@@ -6,7 +6,7 @@ import binascii
 from hashlib import sha256
 from . import der
 from .curves import orderlen
-from six import PY3, int2byte, b, next
+from six import PY3, int2byte, b, next, integer_types
 
 # RFC5480:
 #   The "unrestricted" algorithm identifier is:
@@ -18,13 +18,12 @@ encoded_oid_ecPublicKey = der.encode_oid(*oid_ecPublicKey)
 
 def randrange(order, entropy=None):
     """Return a random integer k such that 1 <= k < order, uniformly
-    distributed across that range. For simplicity, this only behaves well if
-    'order' is fairly close (but below) a power of 256. The try-try-again
-    algorithm we use takes longer and longer time (on average) to complete as
-    'order' falls, rising to a maximum of avg=512 loops for the worst-case
-    (256**k)+1 . All of the standard curves behave well. There is a cutoff at
-    10k loops (which raises RuntimeError) to prevent an infinite loop when
-    something is really broken like the entropy function not working.
+    distributed across that range. Candidates are drawn with exactly as many
+    bits as order-1 needs (the unneeded high bits of the first entropy byte
+    are masked off) and rejected when out of range, so on average it takes
+    at most 2 loops, whatever the order. There is a cutoff at 10k loops
+    (which raises RuntimeError) to prevent an infinite loop when something
+    is really broken like the entropy function not working.
 
     Note that this function is not declared to be forwards-compatible: we may
     change the behavior in future releases. The entropy= argument (which
@@ -32,29 +31,38 @@ def randrange(order, entropy=None):
     achieve stability within a given release (for repeatable unit tests), but
     should not be used as a long-term-compatible key generation algorithm.
     """
-    # we could handle arbitrary orders (even 256**k+1) better if we created
-    # candidates bit-wise instead of byte-wise, which would reduce the
-    # worst-case behavior to avg=2 loops, but that would be more complex. The
-    # change would be to round the order up to a power of 256, subtract one
-    # (to get 0xffff..), use that to get a byte-long mask for the top byte,
-    # generate the len-1 entropy bytes, generate one extra byte and mask off
-    # the top bits, then combine it with the rest. Requires jumping back and
-    # forth between strings and integers a lot.
+    return randrange_many(order, 1, entropy)[0]
 
+def randrange_many(order, count, entropy=None):
+    """Return a list of count integers, each distributed like randrange().
+
+    The entropy for all of them is requested in a single call (plus,
+    rarely, another call for the candidates that got rejected), which is
+    much cheaper than one os.urandom() call per number when provisioning
+    keys in bulk.
+    """
     if entropy is None:
         entropy = os.urandom
     assert order > 1
-    bytes = orderlen(order)
-    dont_try_forever = 10000 # gives about 2**-60 failures for worst case
-    while dont_try_forever > 0:
+    bits = (order-1).bit_length()
+    mask = lsb_of_ones(bits)
+    nbytes = (bits+7) // 8
+    results = []
+    dont_try_forever = 10000 # gives about 2**-10000 failures for worst case
+    while len(results) < count and dont_try_forever > 0:
         dont_try_forever -= 1
-        candidate = string_to_number(entropy(bytes)) + 1
-        if 1 <= candidate < order:
-            return candidate
-        continue
-    raise RuntimeError("randrange() tried hard but gave up, either something"
-                       " is very wrong or you got realllly unlucky. Order was"
-                       " %x" % order)
+        data = entropy(nbytes * (count - len(results)))
+        for offset in range(0, len(data) - nbytes + 1, nbytes):
+            candidate = (_bytes_to_int(data[offset:offset+nbytes]) & mask) + 1
+            if candidate < order:
+                results.append(candidate)
+                if len(results) == count:
+                    break
+    if len(results) < count:
+        raise RuntimeError("randrange() tried hard but gave up, either"
+                           " something is very wrong or you got realllly"
+                           " unlucky. Order was %x" % order)
+    return results
 
 class PRNG:
     # this returns a callable which, when invoked with an integer N, will
@@ -245,3 +253,124 @@ def sigdecode_der(sig_der, order):
                                 binascii.hexlify(empty))
     return r, s
 
+
+
+# The batch codecs below pack or unpack many signatures through a single
+# contiguous buffer (anything supporting the buffer protocol: bytes,
+# bytearray, memoryview, mmap), which is handy for pipelines that store or
+# ship signatures in bulk. The numbers are moved in and out of the buffer
+# directly, without going through the hex strings used by number_to_string()
+# and string_to_number().
+
+if PY3:
+    def _int_to_bytes(num, length):
+        return num.to_bytes(length, "big")
+
+    def _bytes_to_int(data):
+        return int.from_bytes(data, "big")
+else:
+    def _int_to_bytes(num, length):
+        return binascii.unhexlify("%0*x" % (2*length, num))
+
+    def _bytes_to_int(data):
+        return int(binascii.hexlify(data), 16)
+
+def _byte_at(data, offset):
+    n = data[offset]
+    return n if isinstance(n, integer_types) else ord(n)
+
+def sigencode_string_batch(sigs, order):
+    # sigs is an iterable of (r, s) pairs; returns a bytearray holding the
+    # sigencode_string() form of every signature back to back
+    l = orderlen(order)
+    sigs = list(sigs)
+    buf = bytearray(2*l*len(sigs))
+    offset = 0
+    for r, s in sigs:
+        buf[offset:offset+l] = _int_to_bytes(r, l)
+        buf[offset+l:offset+2*l] = _int_to_bytes(s, l)
+        offset += 2*l
+    return buf
+
+def sigdecode_string_batch(signatures, order):
+    l = orderlen(order)
+    data = memoryview(signatures)
+    assert len(data) % (2*l) == 0, (len(data), 2*l)
+    return [(_bytes_to_int(data[offset:offset+l]),
+             _bytes_to_int(data[offset+l:offset+2*l]))
+            for offset in range(0, len(data), 2*l)]
+
+def _der_integer_len(num):
+    # the extra byte covers both the sign bit and num == 0
+    return num.bit_length() // 8 + 1
+
+def sigencode_der_batch(sigs, order):
+    # returns a bytearray with the sigencode_der() form of every signature
+    # back to back; DER sequences are self-delimiting, so no index is needed
+    sigs = list(sigs)
+    lengths = []
+    total = 0
+    for r, s in sigs:
+        assert r >= 0 and s >= 0 # can't support negative numbers yet
+        r_len = _der_integer_len(r)
+        s_len = _der_integer_len(s)
+        seq_len = 2 + r_len + 2 + s_len
+        header = der.encode_length(seq_len)
+        lengths.append((r_len, s_len, header))
+        total += 1 + len(header) + seq_len
+    buf = bytearray(total)
+    offset = 0
+    for (r, s), (r_len, s_len, header) in zip(sigs, lengths):
+        buf[offset] = 0x30
+        buf[offset+1:offset+1+len(header)] = header
+        offset += 1 + len(header)
+        for num, num_len in ((r, r_len), (s, s_len)):
+            buf[offset] = 0x02
+            buf[offset+1] = num_len
+            buf[offset+2:offset+2+num_len] = _int_to_bytes(num, num_len)
+            offset += 2 + num_len
+    return buf
+
+def _remove_der_length(data, offset, end):
+    if offset >= end:
+        raise der.UnexpectedDER("ran out of length bytes")
+    num = _byte_at(data, offset)
+    if not (num & 0x80):
+        return num, offset+1
+    llen = num & 0x7f
+    if offset+1+llen > end:
+        raise der.UnexpectedDER("ran out of length bytes")
+    return _bytes_to_int(data[offset+1:offset+1+llen]), offset+1+llen
+
+def _remove_der_integer(data, offset, end):
+    if offset >= end or _byte_at(data, offset) != 0x02:
+        raise der.UnexpectedDER("wanted integer (0x02) at offset %d" % offset)
+    length, offset = _remove_der_length(data, offset+1, end)
+    if length < 1 or offset+length > end:
+        raise der.UnexpectedDER("truncated integer at offset %d" % offset)
+    assert _byte_at(data, offset) < 0x80 # can't support negative numbers yet
+    return _bytes_to_int(data[offset:offset+length]), offset+length
+
+def sigdecode_der_batch(signatures, order):
+    # parses consecutive sigencode_der() signatures out of one buffer and
+    # returns a list of (r, s) pairs
+    data = memoryview(signatures)
+    end = len(data)
+    sigs = []
+    offset = 0
+    while offset < end:
+        if _byte_at(data, offset) != 0x30:
+            raise der.UnexpectedDER("wanted sequence (0x30), got 0x%02x at "
+                                    "offset %d" % (_byte_at(data, offset),
+                                                   offset))
+        length, offset = _remove_der_length(data, offset+1, end)
+        seq_end = offset + length
+        if seq_end > end:
+            raise der.UnexpectedDER("truncated DER sig at offset %d" % offset)
+        r, offset = _remove_der_integer(data, offset, seq_end)
+        s, offset = _remove_der_integer(data, offset, seq_end)
+        if offset != seq_end:
+            raise der.UnexpectedDER("trailing junk after DER numbers: %s" %
+                                    binascii.hexlify(data[offset:seq_end]))
+        sigs.append((r, s))
+    return sigs
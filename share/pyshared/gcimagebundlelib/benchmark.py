@@ -0,0 +1,372 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Benchmarks the bundling stages on synthetic trees.
+
+Trees shaped like the hard cases of real images are generated in a scratch
+directory: many small files, large sparse files, a deep hierarchy and a farm
+of hard links. The stages which do not need root are run on each of them,
+on plain files: matching the files against exclude specs, copying the tree
+with tree_copy and with rsync, archiving the copy and hashing the archive.
+The throughput of every stage is printed so that changes to the copy, the
+exclude matching and the archive can be compared.
+
+The files hold a seeded mix of text and random bytes, which compresses about
+as well as the files of an image, so that the archive stage is not measured
+on incompressible data.
+
+Run as python -m gcimagebundlelib.benchmark, see --help for the options.
+"""
+
+
+
+from distutils import spawn
+import hashlib
+import json
+import logging
+from optparse import OptionParser
+import os
+import random
+import shutil
+import stat
+import string
+import tempfile
+
+from gcimagebundlelib import exclude_spec
+from gcimagebundlelib import timing
+from gcimagebundlelib import tree_copy
+from gcimagebundlelib import utils
+
+_KILOBYTE = 1024
+_MEGABYTE = 1024 * 1024
+
+# Paths images exclude, none of which is in the synthetic trees, so that the
+# index is as large as a real one. They are taken under the tree, which may
+# itself be under /tmp.
+_SYSTEM_EXCLUDES = ['/dev', '/proc', '/sys', '/run', '/tmp', '/var/tmp',
+                    '/mnt', '/media', '/lost+found', '/etc/ssh/ssh_host_key',
+                    '/etc/udev/rules.d/70-persistent-net.rules',
+                    '/var/lib/dhcp', '/root/.ssh', '/home/user/.ssh']
+
+# Every EXCLUDE_EVERY-th directory at the top of a tree is excluded.
+EXCLUDE_EVERY = 10
+
+# Size of the data the contents of the files are cut from, and of its blocks.
+_POOL_SIZE = 8 * _MEGABYTE
+_POOL_BLOCK_SIZE = 4 * _KILOBYTE
+
+
+def _Scaled(count, scale):
+  return max(1, int(count * scale))
+
+
+class Content(object):
+  """Compressible contents of the synthetic files.
+
+  A pool is generated from a seeded random number generator, in blocks of
+  which three in four are lines of words and one is random bytes, like the
+  mix of text and binaries of an image. The contents of the files are cut
+  from it at random offsets, so that the trees are the same for a seed.
+  """
+
+  def __init__(self, seed=0):
+    self._random = random.Random(seed)
+    words = [''.join(self._random.choice(string.ascii_lowercase)
+                     for _ in xrange(self._random.randint(2, 10)))
+             for _ in xrange(1000)]
+    blocks = []
+    for block_number in xrange(_POOL_SIZE // _POOL_BLOCK_SIZE):
+      if block_number % 4 == 3:
+        bits = self._random.getrandbits(_POOL_BLOCK_SIZE * 8)
+        blocks.append(('%0*x' % (_POOL_BLOCK_SIZE * 2, bits)).decode('hex'))
+      else:
+        text = []
+        size = 0
+        while size < _POOL_BLOCK_SIZE:
+          line = ' '.join(self._random.choice(words)
+                          for _ in xrange(self._random.randint(1, 12)))
+          text.append(line)
+          size += len(line) + 1
+        blocks.append('\n'.join(text)[:_POOL_BLOCK_SIZE])
+    self._pool = ''.join(blocks)
+
+  def Get(self, size):
+    """Returns size bytes of contents."""
+    chunks = []
+    while size > 0:
+      offset = self._random.randint(0, len(self._pool) - 1)
+      chunk = self._pool[offset:offset + size]
+      chunks.append(chunk)
+      size -= len(chunk)
+    return ''.join(chunks)
+
+
+def MakeSmallFiles(root, scale=1.0, content=None):
+  """Makes many small files of a few KB in a hundred directories."""
+  content = content or Content()
+  for file_number in xrange(_Scaled(20000, scale)):
+    directory = os.path.join(root, 'dir%03d' % (file_number % 100))
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    with open(os.path.join(directory, 'file%06d' % file_number), 'wb') as f:
+      f.write(content.Get(file_number % 8 * _KILOBYTE + 100))
+
+
+def MakeSparseFiles(root, scale=1.0, content=None):
+  """Makes large sparse files, with 1MB of data every 64MB."""
+  content = content or Content()
+  size = _Scaled(1024, scale) * _MEGABYTE
+  for file_number in xrange(4):
+    directory = os.path.join(root, 'dir%d' % file_number)
+    os.makedirs(directory)
+    with open(os.path.join(directory, 'sparse%d.img' % file_number),
+              'wb') as f:
+      for offset in xrange(0, size, 64 * _MEGABYTE):
+        f.seek(offset)
+        f.write(content.Get(_MEGABYTE))
+      f.truncate(size)
+
+
+def MakeDeepHierarchy(root, scale=1.0, content=None):
+  """Makes chains of directories 64 deep with a few files at every level."""
+  content = content or Content()
+  for chain in xrange(_Scaled(20, scale)):
+    directory = os.path.join(root, 'chain%03d' % chain)
+    for depth in xrange(64):
+      directory = os.path.join(directory, 'level%02d' % depth)
+      os.makedirs(directory)
+      for file_number in xrange(10):
+        with open(os.path.join(directory, 'file%d' % file_number), 'wb') as f:
+          f.write(content.Get(_KILOBYTE))
+
+
+def MakeHardLinkFarm(root, scale=1.0, content=None):
+  """Makes files of 16KB with 10 hard links each, spread over directories."""
+  content = content or Content()
+  for link_number in xrange(10):
+    os.makedirs(os.path.join(root, 'links%d' % link_number))
+  for file_number in xrange(_Scaled(1000, scale)):
+    first_path = os.path.join(root, 'links0', 'file%05d' % file_number)
+    with open(first_path, 'wb') as f:
+      f.write(content.Get(16 * _KILOBYTE))
+    for link_number in xrange(1, 10):
+      os.link(first_path, os.path.join(root, 'links%d' % link_number,
+                                       'file%05d' % file_number))
+
+
+TREES = [('small_files', MakeSmallFiles),
+         ('sparse_files', MakeSparseFiles),
+         ('deep_hierarchy', MakeDeepHierarchy),
+         ('hard_link_farm', MakeHardLinkFarm)]
+
+
+def _ExcludeSpecs(root):
+  """Returns the exclude specs used for a tree."""
+  specs = [exclude_spec.ExcludeSpec(root + path) for path in _SYSTEM_EXCLUDES]
+  for name in sorted(os.listdir(root))[::EXCLUDE_EVERY]:
+    specs.append(exclude_spec.ExcludeSpec(os.path.join(root, name)))
+  return specs
+
+
+def _MatchExcludes(root, exclude_index):
+  """Matches every path of a tree against the excludes.
+
+  Returns:
+    The number of paths matched.
+  """
+  paths = 0
+  for dir_path, dir_names, file_names in os.walk(root):
+    for name in dir_names + file_names:
+      path = os.path.join(dir_path, name)
+      exclude_index.ShouldExclude(path, os.lstat(path))
+      paths += 1
+  return paths
+
+
+def _HashFile(file_path, digest):
+  """Hashes a file the way the archive digest is computed.
+
+  Returns:
+    The size of the file.
+  """
+  size = 0
+  with open(file_path, 'rb') as f:
+    for chunk in iter(lambda: f.read(utils.ARCHIVE_CHUNK_SIZE), ''):
+      digest.update(chunk)
+      size += len(chunk)
+  return size
+
+
+def _DataSize(root):
+  """Returns the bytes of data of a tree, hard links counted once."""
+  inodes = set()
+  size = 0
+  for dir_path, _, file_names in os.walk(root):
+    for name in file_names:
+      file_stat = os.lstat(os.path.join(dir_path, name))
+      if stat.S_ISREG(file_stat.st_mode) and file_stat.st_ino not in inodes:
+        inodes.add(file_stat.st_ino)
+        size += min(file_stat.st_size, file_stat.st_blocks * 512)
+  return size
+
+
+def _CountFiles(root):
+  """Returns the number of files of a tree, hard links counted once."""
+  inodes = set()
+  for dir_path, _, file_names in os.walk(root):
+    for name in file_names:
+      inodes.add(os.lstat(os.path.join(dir_path, name)).st_ino)
+  return len(inodes)
+
+
+def RunStages(source, work_dir, report, compress_threads=1):
+  """Runs the bundling stages on a tree and records them in a report.
+
+  Args:
+    source: The directory of the tree.
+    work_dir: An empty directory for the copy and the archive.
+    report: The timing.Report the stages are recorded in.
+    compress_threads: The number of threads gzipping the archive.
+  """
+  exclude_index = exclude_spec.ExcludeIndex(_ExcludeSpecs(source))
+
+  with report.Stage('exclude') as stage:
+    stage.files = _MatchExcludes(source, exclude_index)
+
+  copy_dir = os.path.join(work_dir, 'copy')
+  os.mkdir(copy_dir)
+  with report.Stage('copy') as stage:
+    # The synthetic trees have no extended attributes.
+    with tree_copy.TreeCopier(exclude_index.ShouldExclude,
+                              xattrs=False) as copier:
+      copier.Copy(source, copy_dir, recursive=True)
+    stage.bytes = copier.bytes
+    stage.files = copier.files
+
+  if spawn.find_executable('rsync'):
+    rsync_dir = os.path.join(work_dir, 'rsync')
+    os.mkdir(rsync_dir)
+    exclude_file = os.path.join(work_dir, 'rsync_excludes')
+    with open(exclude_file, 'w') as f:
+      for spec in _ExcludeSpecs(source):
+        f.write(spec.GetRsyncSpec(source))
+    with report.Stage('rsync') as stage:
+      # The trailing slash copies the contents of source, as block_disk does.
+      utils.Rsync(source.rstrip('/') + '/', rsync_dir, exclude_file, False,
+                  recursive=True, xattrs=False)
+    # Counted after the stage, so that the walk is not timed.
+    stage.bytes = _DataSize(rsync_dir)
+    stage.files = _CountFiles(rsync_dir)
+    shutil.rmtree(rsync_dir)
+  else:
+    logging.warning('rsync is not installed, skipping the rsync stage.')
+
+  archive_path = os.path.join(work_dir, 'archive.tar.gz')
+  with report.Stage('archive') as stage:
+    stage.bytes = utils.TarAndGzipFile([copy_dir], archive_path,
+                                       compress_threads=compress_threads)
+
+  with report.Stage('hash') as stage:
+    stage.bytes = _HashFile(archive_path, hashlib.sha1())
+
+
+def Run(tree_names, scratch_dir, scale=1.0, compress_threads=1):
+  """Generates trees and runs the stages on each of them.
+
+  Args:
+    tree_names: The names of the trees, from TREES.
+    scratch_dir: The directory the trees are generated in.
+    scale: A factor applied to the number of files of the trees.
+    compress_threads: The number of threads gzipping the archives.
+
+  Returns:
+    A dict of the timing.Report of every tree by name.
+  """
+  makers = dict(TREES)
+  content = Content()
+  reports = {}
+  for name in tree_names:
+    tree_dir = tempfile.mkdtemp(dir=scratch_dir, prefix=name + '_')
+    try:
+      source = os.path.join(tree_dir, 'source')
+      os.mkdir(source)
+      logging.info('Generating %s', name)
+      makers[name](source, scale, content)
+      logging.info('Generated %d MB of data',
+                   _DataSize(source) // _MEGABYTE)
+      work_dir = os.path.join(tree_dir, 'work')
+      os.mkdir(work_dir)
+      reports[name] = timing.Report()
+      RunStages(source, work_dir, reports[name], compress_threads)
+    finally:
+      shutil.rmtree(tree_dir)
+  return reports
+
+
+def FormatReports(reports):
+  """Returns a table of the throughput of every stage of every tree."""
+  lines = ['%-16s %-8s %9s %9s %9s %11s' % ('tree', 'stage', 'seconds',
+                                             'MB', 'MB/s', 'files/s')]
+  for name in sorted(reports):
+    for stage in reports[name].stages:
+      seconds = stage.seconds or 1e-6
+      megabytes = mb_rate = files_rate = '-'
+      if stage.bytes is not None:
+        megabytes = '%.1f' % (stage.bytes / float(_MEGABYTE))
+        mb_rate = '%.1f' % (stage.bytes / float(_MEGABYTE) / seconds)
+      if stage.files is not None:
+        files_rate = '%.0f' % (stage.files / seconds)
+      lines.append('%-16s %-8s %9.2f %9s %9s %11s' % (
+          name, stage.name, stage.seconds, megabytes, mb_rate, files_rate))
+  return '\n'.join(lines)
+
+
+def main():
+  parser = OptionParser()
+  parser.add_option('-t', '--trees', dest='trees',
+                    default=','.join(name for name, _ in TREES),
+                    help='Comma separated trees to benchmark, among %s.'
+                    % ', '.join(name for name, _ in TREES))
+  parser.add_option('-s', '--scale', dest='scale', type='float', default=1.0,
+                    help='Factor applied to the number of files and to the '
+                    'size of the sparse files.')
+  parser.add_option('--scratch_dir', dest='scratch_dir', default=None,
+                    help='Directory the trees are generated in. It needs a '
+                    'few GB of apparent space and a few hundred MB of '
+                    'real space.')
+  parser.add_option('--compress_threads', dest='compress_threads',
+                    type='int', default=1,
+                    help='Number of threads gzipping the archives.')
+  parser.add_option('-o', '--output', dest='output', default=None,
+                    help='File the reports are saved to as JSON.')
+  (options, _) = parser.parse_args()
+  tree_names = options.trees.split(',')
+  unknown = set(tree_names) - set(name for name, _ in TREES)
+  if unknown:
+    parser.error('Unknown trees: %s' % ', '.join(sorted(unknown)))
+  logging.basicConfig(level=logging.INFO)
+
+  reports = Run(tree_names, options.scratch_dir, options.scale,
+                options.compress_threads)
+  print FormatReports(reports)
+  if options.output:
+    with open(options.output, 'w') as output_file:
+      json.dump(dict((name, report.ToDict())
+                     for name, report in reports.iteritems()),
+                output_file, indent=2)
+
+
+if __name__ == '__main__':
+  main()
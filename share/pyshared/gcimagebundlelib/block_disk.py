@@ -24,10 +24,19 @@ import hashlib
 import logging
 import os
 import re
+import shutil
+import subprocess
 import tempfile
 
+from gcimagebundlelib import block_store
+from gcimagebundlelib import compression
+from gcimagebundlelib import disk_usage
 from gcimagebundlelib import exclude_spec
 from gcimagebundlelib import fs_copy
+from gcimagebundlelib import incremental
+from gcimagebundlelib import partition_table
+from gcimagebundlelib import timing
+from gcimagebundlelib import tree_copy
 from gcimagebundlelib import utils
 
 
@@ -51,6 +60,11 @@ class FsRawDisk(fs_copy.FsCopy):
     super(FsRawDisk, self).__init__()
     self._fs_size = fs_size
     self._fs_type = fs_type
+    self._file_manifest = None
+
+  def SetFsSize(self, fs_size):
+    """Sets the size of the raw disk."""
+    self._fs_size = fs_size
 
   def _ResizeFile(self, file_path, file_size):
     logging.debug('Resizing %s to %s', file_path, file_size)
@@ -88,15 +102,15 @@ class FsRawDisk(fs_copy.FsCopy):
     # first partition
     utils.CopyBytes(self._disk, file_path, partition_start)
     # Verify there is only 1 partition on the disk
-    with utils.LoadDiskImage(file_path) as devices:
-      # For now we only support disks with a single partition.
-      if len(devices) == 0:
-        raise RawDiskError(
-            'Device %s should be a disk not a partition.' % self._disk)
-      elif len(devices) != 1:
-        raise RawDiskError(
-            'Device %s has more than 1 partition. Only devices '
-            'with a single partition are supported.' % self._disk)
+    partitions = partition_table.PartitionTable(file_path).Partitions()
+    # For now we only support disks with a single partition.
+    if len(partitions) == 0:
+      raise RawDiskError(
+          'Device %s should be a disk not a partition.' % self._disk)
+    elif len(partitions) != 1:
+      raise RawDiskError(
+          'Device %s has more than 1 partition. Only devices '
+          'with a single partition are supported.' % self._disk)
     # Remove the first partition from the file we are creating. We will
     # recreate a partition that will fit inside _fs_size later.
     utils.RemovePartition(file_path, 1)
@@ -110,6 +124,40 @@ class FsRawDisk(fs_copy.FsCopy):
     uuid = utils.GetUUID(self._disk + '1')
     return partition_start, uuid
 
+  def _LoadIncrementalBase(self, disk_file_path):
+    """Loads the manifest of the previous image in the incremental directory.
+
+    The manifest is removed as it no longer describes the image once the
+    image is modified. A new one is saved when the image is complete.
+
+    Args:
+      disk_file_path: The path of the previous disk file.
+
+    Returns:
+      A tuple with the file records and the file system UUID of the previous
+      image, or (None, None) if it cannot be used as a base.
+    """
+    manifest_path = os.path.join(self._incremental_dir,
+                                 incremental.MANIFEST_FILE_NAME)
+    if not (os.path.exists(manifest_path) and
+            os.path.exists(disk_file_path)):
+      logging.info('No previous image in %s, making a full image',
+                   self._incremental_dir)
+      return None, None
+    try:
+      records, uuid, fs_size = incremental.FileManifest.Load(manifest_path)
+    except incremental.ManifestError as e:
+      logging.warning('%s, making a full image', e)
+      return None, None
+    finally:
+      os.remove(manifest_path)
+    if fs_size != self._fs_size or os.path.getsize(disk_file_path) != fs_size:
+      logging.info('Previous image is %s bytes instead of %s, making a full '
+                   'image', fs_size, self._fs_size)
+      return None, None
+    logging.info('Updating previous image %s', disk_file_path)
+    return records, uuid
+
   def Bundleup(self):
     """Creates a raw disk copy of OS image and bundles it into gzipped tar.
 
@@ -121,76 +169,184 @@ class FsRawDisk(fs_copy.FsCopy):
                     expected count.
     """
 
-    # Create sparse file with specified size
-    disk_file_path = os.path.join(self._scratch_dir, 'disk.raw')
-    with open(disk_file_path, 'wb') as _:
-      pass
+    # In incremental mode the disk file is kept with its manifest between
+    # runs, and updated in place when it can be.
+    disk_dir = self._incremental_dir or self._scratch_dir
+    disk_file_path = os.path.join(disk_dir, incremental.DISK_FILE_NAME)
+    previous_files = None
+    uuid = None
+    if self._incremental_dir:
+      if self._staging_tree:
+        raise RawDiskError('An incremental image cannot be made from a '
+                           'staging tree')
+      previous_files, uuid = self._LoadIncrementalBase(disk_file_path)
+    if previous_files is None:
+      # Create sparse file with specified size
+      with open(disk_file_path, 'wb') as _:
+        pass
     self._excludes.append(exclude_spec.ExcludeSpec(disk_file_path))
 
+    report = timing.GetReport()
     logging.info('Initializing disk file')
-    partition_start = None
-    uuid = None
-    if self._disk:
-      # If a disk device has been provided then preserve whatever is there on
-      # the disk before the first partition in case there is an MBR present.
-      partition_start, uuid = self._InitializeDiskFileFromDevice(disk_file_path)
+    with report.Stage('disk init'):
+      partition_start = None
+      if previous_files is not None:
+        # The previous image already has its partition and file system.
+        logging.info('Reusing the partition table of the previous image')
+      elif self._disk:
+        # If a disk device has been provided then preserve whatever is there
+        # on the disk before the first partition in case there is an MBR
+        # present.
+        partition_start, uuid = self._InitializeDiskFileFromDevice(
+            disk_file_path)
+      else:
+        # User didn't specify a disk device. Initialize a device with a simple
+        # partition table.
+        self._ResizeFile(disk_file_path, self._fs_size)
+        # User didn't specify a disk to copy. Create a new partition table
+        utils.MakePartitionTable(disk_file_path)
+        # Start at 1MB so the partition is aligned for best performance.
+        partition_start = 1024 * 1024
+
+      if partition_start is not None:
+        # Create a new partition starting at partition_start of size
+        # self._fs_size - partition_start
+        utils.MakePartition(disk_file_path, 'primary', 'ext2', partition_start,
+                            self._fs_size - partition_start)
+    if self._staging_tree:
+      uuid = self._MakeFileSystemFromStagingTree(disk_file_path, uuid)
     else:
-      # User didn't specify a disk device. Initialize a device with a simple
-      # partition table.
-      self._ResizeFile(disk_file_path, self._fs_size)
-      # User didn't specify a disk to copy. Create a new partition table
-      utils.MakePartitionTable(disk_file_path)
-      # Pass 1MB as start to avoid 'Warning: The resulting partition is not
-      # properly aligned for best performance.' from parted.
-      partition_start = 1024 * 1024
-
-    # Create a new partition starting at partition_start of size
-    # self._fs_size - partition_start
-    utils.MakePartition(disk_file_path, 'primary', 'ext2', partition_start,
-                        self._fs_size - partition_start)
-    with utils.LoadDiskImage(disk_file_path) as devices:
-      # For now we only support disks with a single partition.
-      if len(devices) != 1:
-        raise RawDiskError(devices)
-      # List contents of /dev/mapper to help with debugging. Contents will
-      # be listed in debug log only
-      utils.RunCommand(['ls', '/dev/mapper'])
-      logging.info('Making filesystem')
-      uuid = utils.MakeFileSystem(devices[0], self._fs_type, uuid)
-    with utils.LoadDiskImage(disk_file_path) as devices:
-      if uuid is None:
-        raise Exception('Could not get uuid from MakeFileSystem')
-      mount_point = tempfile.mkdtemp(dir=self._scratch_dir)
-      with utils.MountFileSystem(devices[0], mount_point, self._fs_type):
-        logging.info('Copying contents')
-        self._CopySourceFiles(mount_point)
-        self._CopyPlatformSpecialFiles(mount_point)
-        self._ProcessOverwriteList(mount_point)
-        self._CleanupNetwork(mount_point)
-        self._UpdateFstab(mount_point, uuid)
+      with utils.LoadDiskImage(disk_file_path) as devices:
+        # For now we only support disks with a single partition.
+        if len(devices) != 1:
+          raise RawDiskError(devices)
+        # List contents of /dev/mapper to help with debugging. Contents will
+        # be listed in debug log only
+        utils.RunCommand(['ls', '/dev/mapper'])
+        if previous_files is None:
+          logging.info('Making filesystem')
+          with report.Stage('mkfs'):
+            uuid = utils.MakeFileSystem(devices[0], self._fs_type, uuid)
+        # The same mapping is used to populate the file system.
+        if uuid is None:
+          raise Exception('Could not get uuid from MakeFileSystem')
+        mount_point = tempfile.mkdtemp(dir=self._scratch_dir)
+        with utils.MountFileSystem(devices[0], mount_point, self._fs_type):
+          logging.info('Copying contents')
+          self._PopulateFileSystem(mount_point, uuid, previous_files)
+          if previous_files is not None:
+            # Punch the blocks freed by replaced and removed files out of the
+            # disk file so that they are not archived.
+            try:
+              utils.RunCommand(['fstrim', mount_point])
+            except (OSError, subprocess.CalledProcessError):
+              logging.warning('Could not trim %s, freed blocks will be '
+                              'archived', mount_point)
 
     tar_entries = []
 
-    manifest_file_path = os.path.join(self._scratch_dir, 'manifest.json')
+    manifest_file_path = os.path.join(disk_dir, 'manifest.json')
     manifest_created = self._manifest.CreateIfNeeded(manifest_file_path)
     if manifest_created:
       tar_entries.append(manifest_file_path)
 
     tar_entries.append(disk_file_path)
-    logging.info('Creating tar.gz archive')
-    utils.TarAndGzipFile(tar_entries,
-                         self._output_tarfile)
-    for tar_entry in tar_entries:
-      os.remove(tar_entry)
-
-    # TODO(user): It would be better to compute tar.gz file hash during
-    # archiving.
+    if self._benchmark_codecs:
+      logging.info('Benchmarking compression of %s', disk_file_path)
+      compression.Benchmark(
+          lambda codec, archive_file: utils.TarAndGzipFile(
+              tar_entries, archive_file.name, None, self._compress_threads,
+              self._builtin_tar, archive_file, codec),
+          self._benchmark_codecs, self._scratch_dir, self._compress_threads)
+    # The archive, or the block store index, is hashed as it is written, so
+    # the archive stage includes hashing and, when streaming, uploading.
     h = hashlib.sha1()
-    with open(self._output_tarfile, 'rb') as tar_file:
-      for chunk in iter(lambda: tar_file.read(8192), ''):
-        h.update(chunk)
+    with report.Stage('archive') as stage:
+      if self._block_store_dir:
+        logging.info('Storing blocks in %s', self._block_store_dir)
+        block_store.BlockStore(self._block_store_dir).WriteIndex(
+            tar_entries, self._output_tarfile, h)
+      elif self._uploader:
+        archive_name = os.path.basename(self._output_tarfile)
+        logging.info('Creating archive at %s',
+                     self._uploader.Url(archive_name))
+        # The archive is uploaded while it is written.
+        with self._uploader.Open(archive_name) as upload_stream:
+          stage.bytes = utils.TarAndGzipFile(
+              tar_entries, self._output_tarfile, h, self._compress_threads,
+              self._builtin_tar, upload_stream, self._codec)
+      else:
+        logging.info('Creating archive')
+        stage.bytes = utils.TarAndGzipFile(
+            tar_entries, self._output_tarfile, h, self._compress_threads,
+            self._builtin_tar, codec=self._codec)
+    logging.info('SHA1 digest of %s is %s', self._output_tarfile,
+                 h.hexdigest())
+    if manifest_created:
+      os.remove(manifest_file_path)
+    if self._file_manifest:
+      self._file_manifest.Save(os.path.join(self._incremental_dir,
+                                            incremental.MANIFEST_FILE_NAME))
+    else:
+      os.remove(disk_file_path)
     return (self._fs_size, h.hexdigest())
 
+  def _MakeFileSystemFromStagingTree(self, disk_file_path, uuid):
+    """Creates the file system of the first partition from a staging tree.
+
+    The files are copied to a directory in the scratch directory, which is
+    then written into the partition by mke2fs, so neither device-mapper nor
+    a mount is needed.
+
+    Args:
+      disk_file_path: The path of the disk file.
+      uuid: The UUID of the file system, or None to generate one.
+
+    Returns:
+      The UUID of the file system.
+
+    Raises:
+      RawDiskError: If the file system type cannot be made from a directory.
+    """
+    if self._fs_type not in ('ext2', 'ext3', 'ext4'):
+      raise RawDiskError('A staging tree cannot be used for a %s file system'
+                         % self._fs_type)
+    partition = partition_table.PartitionTable(disk_file_path).GetPartition(1)
+    if uuid is None:
+      uuid = utils.RunCommand(['uuidgen']).strip()
+    staging_dir = tempfile.mkdtemp(dir=self._scratch_dir)
+    try:
+      logging.info('Copying contents to %s', staging_dir)
+      self._PopulateFileSystem(staging_dir, uuid)
+      logging.info('Making filesystem')
+      with timing.GetReport().Stage('mkfs'):
+        return utils.MakeFileSystemFromDirectory(
+            disk_file_path, partition.start, partition.size, self._fs_type,
+            staging_dir, uuid)
+    finally:
+      shutil.rmtree(staging_dir)
+
+  def _PopulateFileSystem(self, root, uuid, previous_files=None):
+    """Copies the image contents under root and adjusts them for GCE.
+
+    Args:
+      root: A path to a mounted raw disk or a staging directory.
+      uuid: The UUID of the root file system.
+      previous_files: The file records of the previous image when root
+        already holds it.
+    """
+    if self._incremental_dir:
+      self._file_manifest = incremental.FileManifest(
+          root, previous_files, uuid, self._fs_size)
+    report = timing.GetReport()
+    with report.Stage('copy') as stage:
+      stage.bytes = self._CopySourceFiles(root)
+    with report.Stage('special files'):
+      self._CopyPlatformSpecialFiles(root)
+      self._ProcessOverwriteList(root)
+      self._CleanupNetwork(root)
+      self._UpdateFstab(root, uuid)
+
   def _CopySourceFiles(self, mount_point):
     """Copies all source files/directories to a mounted raw disk.
 
@@ -205,7 +361,28 @@ class FsRawDisk(fs_copy.FsCopy):
 
     Args:
       mount_point: A path to a mounted raw disk.
+
+    Returns:
+      The number of bytes copied, or None if rsync copied the files.
     """
+    if self._builtin_copy:
+      with tree_copy.TreeCopier(self._ShouldExclude,
+                                self._ignore_hard_links,
+                                manifest=self._file_manifest) as copier:
+        for (src, dest, is_recursive) in self._srcs:
+          if is_recursive:
+            copier.Copy(src, os.path.join(mount_point, dest), recursive=True)
+          else:
+            copier.Copy(src, os.path.join(mount_point,
+                                          dest or os.path.basename(src)),
+                        recursive=False)
+      if self._file_manifest:
+        removed = self._file_manifest.RemoveStale()
+        logging.info('Incremental copy: %d bytes copied, %d bytes reused '
+                     'from the previous image, %d files removed',
+                     self._file_manifest.bytes_copied,
+                     self._file_manifest.bytes_reused, removed)
+      return copier.bytes
     for (src, dest, is_recursive) in self._srcs:
       # Generate a list of files/directories excluded from copying to raw disk.
       # rsync expects them to be relative to src directory so we need to
@@ -244,8 +421,13 @@ class FsRawDisk(fs_copy.FsCopy):
         # Ensure we don't use extended attributes here, so that copying /selinux
         # on Linux doesn't try and fail to preserve the SELinux context. That
         # doesn't work and causes rsync to return a nonzero status code.
-        utils.Rsync(src, os.path.join(mount_point, dest), None,
-                    self._ignore_hard_links, recursive=False, xattrs=False)
+        if self._builtin_copy:
+          with tree_copy.TreeCopier(ignore_hard_links=self._ignore_hard_links,
+                                    xattrs=False) as copier:
+            copier.Copy(src, os.path.join(mount_point, dest), recursive=False)
+        else:
+          utils.Rsync(src, os.path.join(mount_point, dest), None,
+                      self._ignore_hard_links, recursive=False, xattrs=False)
 
   def _ProcessOverwriteList(self, mount_point):
     """Overwrites a set of files/directories requested by platform.
@@ -268,8 +450,13 @@ class FsRawDisk(fs_copy.FsCopy):
           new_file = self._platform.Overwrite(file_path, file_name,
                                               self._scratch_dir)
           logging.info('rawdisk: modifying %s from %s', file_path, new_file)
-          utils.Rsync(new_file, file_path, None, self._ignore_hard_links,
-                      recursive=False, xattrs=True)
+          if self._builtin_copy:
+            with tree_copy.TreeCopier(
+                ignore_hard_links=self._ignore_hard_links) as copier:
+              copier.Copy(new_file, file_path, recursive=False)
+          else:
+            utils.Rsync(new_file, file_path, None, self._ignore_hard_links,
+                        recursive=False, xattrs=True)
 
 
   def _CleanupNetwork(self, mount_point):
@@ -321,6 +508,21 @@ class RootFsRaw(FsRawDisk):
     super(RootFsRaw, self).__init__(fs_size, fs_type)
     self._skip_disk_space_check = skip_disk_space_check
     self._statvfs = statvfs
+    self._disk_usage = None
+
+  def MeasureDiskUsage(self):
+    """Measures the space taken by the files to copy.
+
+    The measure is then used to check the disk space instead of the used
+    space of the whole source file system.
+
+    Returns:
+      A raw disk size, in whole GB, which holds the files with some free
+      space.
+    """
+    self._disk_usage = disk_usage.Measure(
+        self._srcs[0][0], self._ShouldExclude, self._ignore_hard_links)
+    return disk_usage.SuggestedFileSystemSize(self._disk_usage)
 
   def _Verify(self):
     super(RootFsRaw, self)._Verify()
@@ -330,10 +532,46 @@ class RootFsRaw(FsRawDisk):
     # check that destination field is empty.
     if self._srcs[0][1]:
       raise InvalidRawDiskError('Root filesystems must be copied as /')
-    if (not self._skip_disk_space_check and
-        self._srcs[0][0] == '/'):
+    if self._skip_disk_space_check:
+      return
+    if self._disk_usage is not None:
+      self._VerifyMeasuredDiskSpace()
+    elif self._srcs[0][0] == '/':
       self._VerifyDiskSpace()
 
+  def _VerifyMeasuredDiskSpace(self):
+    """Verify the disk space against the measured size of the files to copy."""
+    disk_space_needed = disk_usage.MinimumFileSystemSize(self._disk_usage)
+    # disk.raw only takes the space of what is written in it, and a
+    # compressed archive is assumed to be at most 40% of that, as in
+    # _VerifyDiskSpace. An uncompressed one is as large.
+    archive_ratio = 0.4
+    for codec in [self._codec] + self._benchmark_codecs:
+      if codec and codec.name == compression.NoCompression.name:
+        archive_ratio = 1.0
+    scratch_space_needed = long((1 + archive_ratio) * disk_space_needed)
+    if self._staging_tree:
+      scratch_space_needed += self._disk_usage.allocated
+    scratch_fs = self._statvfs(self._scratch_dir)
+    free_space = scratch_fs.f_bsize * scratch_fs.f_bfree
+    logging.info('Files to copy need a disk of %d bytes and %d bytes of '
+                 'scratch space, %d bytes are free in %s.', disk_space_needed,
+                 scratch_space_needed, free_space, self._scratch_dir)
+    if scratch_space_needed > free_space:
+      raise InvalidRawDiskError(
+          'The operation requires about %d bytes of disk space. However, the '
+          'free disk space for %s is %d bytes.  Please consider freeing more '
+          'disk space.  You may use --skip_disk_space_check to disable this '
+          'check.' % (scratch_space_needed, self._scratch_dir, free_space))
+    if disk_space_needed > self._fs_size:
+      raise InvalidRawDiskError(
+          'The files to be copied need a disk of about %d bytes. However, the '
+          'limit on the image disk file is %d bytes.  Please consider '
+          'deleting unused files from root disk, or increasing the image disk '
+          'file limit with --fssize or --auto_fssize.  You may use '
+          '--skip_disk_space_check to disable this check.'
+          % (disk_space_needed, self._fs_size))
+
   def _VerifyDiskSpace(self):
     """Verify that there is enough free disk space to generate the image file"""
     # We use a very quick and simplistic check, 
@@ -351,6 +589,11 @@ class RootFsRaw(FsRawDisk):
     root_fs = self._statvfs(self._srcs[0][0])
     disk_space_needed = long(1.4 * root_fs.f_bsize * (root_fs.f_blocks -
         root_fs.f_bfree))
+    # A staging tree holds another copy of the files.
+    scratch_space_needed = disk_space_needed
+    if self._staging_tree:
+      scratch_space_needed += root_fs.f_bsize * (root_fs.f_blocks -
+                                                 root_fs.f_bfree)
     logging.info(("Root disk on %s: f_bsize=%d f_blocks=%d f_bfree=%d. "
                   "Estimated space needed is %d (may be overestimated)."), 
                  self._srcs[0][0], 
@@ -366,13 +609,13 @@ class RootFsRaw(FsRawDisk):
                  self._scratch_dir, 
                  free_space)
 
-    if disk_space_needed > free_space:
+    if scratch_space_needed > free_space:
       errorMessage = ("The operation may require up to %d bytes of disk space. "
         "However, the free disk space for %s is %d bytes.  Please consider "
         "freeing more disk space.  Note that the disk space required may "
         "be overestimated because it does not exclude temporary files that "
         "will not be copied.  You may use --skip_disk_space_check to disable "
-        "this check.") % (disk_space_needed, self._scratch_dir, free_space)
+        "this check.") % (scratch_space_needed, self._scratch_dir, free_space)
       raise InvalidRawDiskError(errorMessage)
     if disk_space_needed > self._fs_size:
       errorMessage = ("The root disk files to be copied may require up to %d "
@@ -0,0 +1,218 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Content-addressed block store for disk images.
+
+Files are split into fixed size blocks which are stored, compressed, under
+the SHA256 hash of their content. Blocks already in the store are not
+written again, so images which share most of their blocks only add the
+blocks which changed. A small JSON index lists the blocks of every file so
+that the files can be reassembled. Blocks in holes or filled with zeros are
+not stored at all.
+"""
+
+
+
+import errno
+import hashlib
+import json
+import logging
+import os
+import zlib
+
+from gcimagebundlelib import sparse_tar
+
+# Version of the index file format.
+FORMAT_VERSION = 1
+
+# Default size of the blocks files are split into.
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+
+# Suffix of index files.
+INDEX_SUFFIX = '.index.json'
+
+
+class BlockStoreError(Exception):
+  """Error occurred storing or reading blocks."""
+
+
+def _DataBlocks(extents, block_size):
+  """Returns the set of numbers of the blocks which overlap data extents."""
+  blocks = set()
+  for offset, length in extents:
+    blocks.update(xrange(offset // block_size,
+                         (offset + length - 1) // block_size + 1))
+  return blocks
+
+
+class BlockStore(object):
+  """A directory of blocks named after their content hash.
+
+  Attributes:
+    blocks_written: The number of blocks added to the store.
+    blocks_reused: The number of blocks found already in the store.
+    bytes_written: The compressed size of the blocks added to the store.
+  """
+
+  def __init__(self, directory, block_size=DEFAULT_BLOCK_SIZE):
+    """Initializes BlockStore object.
+
+    Args:
+      directory: The block store directory.
+      block_size: The size of the blocks files are split into.
+    """
+    self._directory = directory
+    self._block_size = block_size
+    self.blocks_written = 0
+    self.blocks_reused = 0
+    self.bytes_written = 0
+
+  def _BlockPath(self, block_hash):
+    return os.path.join(self._directory, block_hash[:2], block_hash)
+
+  def _PutBlock(self, data):
+    """Stores a block unless it is already present.
+
+    Returns:
+      The hex SHA256 digest of the block.
+    """
+    block_hash = hashlib.sha256(data).hexdigest()
+    block_path = self._BlockPath(block_hash)
+    if os.path.exists(block_path):
+      self.blocks_reused += 1
+      return block_hash
+    try:
+      os.mkdir(os.path.dirname(block_path))
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+    compressed = zlib.compress(data)
+    # Blocks are written under a temporary name so that a block in the store
+    # is always complete.
+    temp_path = '%s.%d.tmp' % (block_path, os.getpid())
+    with open(temp_path, 'wb') as block_file:
+      block_file.write(compressed)
+    os.rename(temp_path, block_path)
+    self.blocks_written += 1
+    self.bytes_written += len(compressed)
+    return block_hash
+
+  def _GetBlock(self, block_hash):
+    """Reads a block and checks its content hash.
+
+    Raises:
+      BlockStoreError: If the block is missing or corrupt.
+    """
+    try:
+      with open(self._BlockPath(block_hash), 'rb') as block_file:
+        data = zlib.decompress(block_file.read())
+    except (IOError, zlib.error) as e:
+      raise BlockStoreError('Cannot read block %s: %s' % (block_hash, e))
+    if hashlib.sha256(data).hexdigest() != block_hash:
+      raise BlockStoreError('Block %s is corrupt' % block_hash)
+    return data
+
+  def AddFile(self, file_path):
+    """Stores the blocks of a file.
+
+    Args:
+      file_path: The path of the file.
+
+    Returns:
+      The index entry of the file, a dict with its name, size and the list
+      of the hashes of its blocks, where None stands for a block of zeros.
+
+    Raises:
+      BlockStoreError: If the file is shorter than its size.
+    """
+    blocks = []
+    with open(file_path, 'rb') as src_file:
+      size = os.fstat(src_file.fileno()).st_size
+      data_blocks = _DataBlocks(
+          sparse_tar.DataExtents(src_file.fileno(), size), self._block_size)
+      for offset in xrange(0, size, self._block_size):
+        if offset // self._block_size not in data_blocks:
+          blocks.append(None)
+          continue
+        length = min(self._block_size, size - offset)
+        src_file.seek(offset)
+        data = src_file.read(length)
+        if len(data) != length:
+          raise BlockStoreError('%s ends before offset %d'
+                                % (file_path, offset + length))
+        if data.count('\0') == length:
+          blocks.append(None)
+        else:
+          blocks.append(self._PutBlock(data))
+    return {'name': os.path.basename(file_path), 'size': size,
+            'blocks': blocks}
+
+  def WriteIndex(self, file_paths, index_path, digest=None):
+    """Stores the blocks of files and writes an index to reassemble them.
+
+    Args:
+      file_paths: A list of the files to store.
+      index_path: The path of the index to write.
+      digest: An optional hashlib object updated with the index bytes.
+    """
+    files = [self.AddFile(file_path) for file_path in file_paths]
+    index = json.dumps({'version': FORMAT_VERSION,
+                        'block_size': self._block_size,
+                        'hash': 'sha256', 'compression': 'zlib',
+                        'files': files})
+    with open(index_path, 'wb') as index_file:
+      index_file.write(index)
+    if digest:
+      digest.update(index)
+    logging.info('Stored %d new blocks (%d bytes) in %s, %d blocks were '
+                 'already there', self.blocks_written, self.bytes_written,
+                 self._directory, self.blocks_reused)
+
+  def Restore(self, index_path, dest_dir):
+    """Reassembles the files of an index.
+
+    Blocks of zeros are left as holes.
+
+    Args:
+      index_path: The path of an index written by WriteIndex().
+      dest_dir: The directory the files are written to.
+
+    Returns:
+      A list of the paths of the files written.
+
+    Raises:
+      BlockStoreError: If the index is invalid or a block is missing or
+        corrupt.
+    """
+    try:
+      with open(index_path) as index_file:
+        index = json.load(index_file)
+    except ValueError as e:
+      raise BlockStoreError('%s is not a valid index: %s' % (index_path, e))
+    if index.get('version') != FORMAT_VERSION:
+      raise BlockStoreError('%s has unsupported version %s'
+                            % (index_path, index.get('version')))
+    block_size = index['block_size']
+    file_paths = []
+    for entry in index['files']:
+      file_path = os.path.join(dest_dir, os.path.basename(entry['name']))
+      with open(file_path, 'wb') as dest_file:
+        for number, block_hash in enumerate(entry['blocks']):
+          if block_hash:
+            dest_file.seek(number * block_size)
+            dest_file.write(self._GetBlock(block_hash))
+        dest_file.truncate(entry['size'])
+      file_paths.append(file_path)
+    return file_paths
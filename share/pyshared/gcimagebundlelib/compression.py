@@ -0,0 +1,337 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Compression codecs of image archives.
+
+A codec is named on the command line as name[:level], gzip:9 or xz say.
+gzip is compressed in-process, by several threads with parallel_gzip. xz
+is compressed by the xz command, which has its own threads (-T), as the
+Python 2 standard library has no lzma module. none leaves the tar archive
+uncompressed.
+"""
+
+
+
+import gzip
+import logging
+import os
+import subprocess
+import tempfile
+import threading
+
+from gcimagebundlelib import parallel_gzip
+from gcimagebundlelib import timing
+
+# Size of the reads when decompressing.
+_CHUNK_SIZE = 1024 * 1024
+
+_MEGABYTE = 1024 * 1024
+
+
+class CompressionError(Exception):
+  """Error occurred compressing or decompressing an archive."""
+
+
+class _PlainFile(object):
+  """File-like object writing what is written to it unchanged."""
+
+  def __init__(self, dest_file):
+    self.write = dest_file.write
+
+  def close(self):
+    pass
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, unused_exc_value, unused_exc_tb):
+    pass
+
+
+class _ProcessFile(object):
+  """File-like object filtering what is written to it through a command.
+
+  The output of the command is written to dest_file by a thread, so that
+  the command never waits on a full pipe.
+  """
+
+  def __init__(self, command, dest_file):
+    logging.debug('running %s', command)
+    self._command = command
+    self._dest_file = dest_file
+    try:
+      self._process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE)
+    except OSError as e:
+      raise CompressionError('Could not run %s: %s' % (command[0], e))
+    self._error = None
+    self._thread = threading.Thread(target=self._CopyOutput)
+    self._thread.daemon = True
+    self._thread.start()
+    self.write = self._process.stdin.write
+
+  def _CopyOutput(self):
+    try:
+      for chunk in iter(lambda: self._process.stdout.read(_CHUNK_SIZE), ''):
+        self._dest_file.write(chunk)
+    except Exception as e:
+      # Reported by close(), in the writing thread.
+      self._error = e
+      self._process.kill()
+
+  def close(self):
+    """Waits for the command to write all its output.
+
+    Does not close dest_file.
+
+    Raises:
+      CompressionError: If the command failed.
+    """
+    self._process.stdin.close()
+    self._thread.join()
+    retcode = self._process.wait()
+    if self._error:
+      raise self._error
+    if retcode:
+      raise CompressionError('%s failed with %d' % (' '.join(self._command),
+                                                    retcode))
+
+  def abort(self):
+    """Kills the command and drops its output."""
+    self._process.kill()
+    self._process.wait()
+    self._thread.join()
+    try:
+      self._process.stdin.close()
+    except IOError:
+      pass
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, unused_exc_value, unused_exc_tb):
+    if exc_type is None:
+      self.close()
+    else:
+      self.abort()
+
+
+class Codec(object):
+  """A compression codec.
+
+  Attributes:
+    name: The name of the codec.
+    level: The compression level, or None.
+    suffix: The suffix of the archives, .tar included.
+  """
+
+  name = None
+  suffix = None
+  default_level = None
+  levels = ()
+
+  def __init__(self, level=None):
+    if level is None:
+      level = self.default_level
+    elif level not in self.levels:
+      raise CompressionError('%s has no level %d' % (self.name, level))
+    self.level = level
+
+  def __str__(self):
+    if self.level is None:
+      return self.name
+    return '%s:%d' % (self.name, self.level)
+
+  def Open(self, dest_file, threads=1):
+    """Starts compressing into a file.
+
+    Args:
+      dest_file: A file object the compressed data is written to.
+      threads: The number of compression threads.
+
+    Returns:
+      A file-like object whose close() method writes the rest of the
+      compressed data, without closing dest_file. Used as a context
+      manager, it is closed at the end of the block, or the compression is
+      stopped if the block raises.
+    """
+    raise NotImplementedError
+
+  def Decompress(self, src_file, dest_file, threads=1):
+    """Decompresses a file.
+
+    Args:
+      src_file: A file object of compressed data.
+      dest_file: A file object the decompressed data is written to.
+      threads: The number of decompression threads, where supported.
+    """
+    raise NotImplementedError
+
+
+class GzipCodec(Codec):
+  """gzip, what Compute Engine imports images from."""
+
+  name = 'gzip'
+  suffix = '.tar.gz'
+  default_level = parallel_gzip.DEFAULT_LEVEL
+  levels = range(1, 10)
+
+  def Open(self, dest_file, threads=1):
+    if threads > 1:
+      return parallel_gzip.ParallelGzipWriter(dest_file, threads,
+                                              level=self.level)
+    return gzip.GzipFile(fileobj=dest_file, mode='wb',
+                         compresslevel=self.level)
+
+  def Decompress(self, src_file, dest_file, threads=1):
+    # gzip reads every member of a parallel_gzip archive.
+    gzip_file = gzip.GzipFile(fileobj=src_file, mode='rb')
+    for chunk in iter(lambda: gzip_file.read(_CHUNK_SIZE), ''):
+      dest_file.write(chunk)
+
+
+class XzCodec(Codec):
+  """xz, smaller than gzip but slower to compress."""
+
+  name = 'xz'
+  suffix = '.tar.xz'
+  default_level = 6
+  levels = range(0, 10)
+
+  def Open(self, dest_file, threads=1):
+    return _ProcessFile(['xz', '-%d' % self.level, '-T', str(threads), '-c'],
+                        dest_file)
+
+  def Decompress(self, src_file, dest_file, threads=1):
+    process_file = _ProcessFile(['xz', '-d', '-T', str(threads), '-c'],
+                                dest_file)
+    for chunk in iter(lambda: src_file.read(_CHUNK_SIZE), ''):
+      process_file.write(chunk)
+    process_file.close()
+
+
+class NoCompression(Codec):
+  """The tar archive, uncompressed."""
+
+  name = 'none'
+  suffix = '.tar'
+
+  def Open(self, dest_file, threads=1):
+    return _PlainFile(dest_file)
+
+  def Decompress(self, src_file, dest_file, threads=1):
+    for chunk in iter(lambda: src_file.read(_CHUNK_SIZE), ''):
+      dest_file.write(chunk)
+
+
+CODECS = dict((codec.name, codec)
+              for codec in (GzipCodec, XzCodec, NoCompression))
+
+
+def ParseCodec(spec):
+  """Returns the codec named by a name[:level] string.
+
+  Raises:
+    CompressionError: If the codec or the level is unknown.
+  """
+  name, _, level = spec.partition(':')
+  if name not in CODECS:
+    raise CompressionError('Unknown compression %s, expected one of %s'
+                           % (name, ', '.join(sorted(CODECS))))
+  if not level:
+    return CODECS[name]()
+  if not level.isdigit():
+    raise CompressionError('Invalid compression level %s' % level)
+  return CODECS[name](int(level))
+
+
+class _CountingFile(object):
+  """File-like object counting and dropping what is written to it."""
+
+  def __init__(self):
+    self.bytes_written = 0
+
+  def write(self, data):
+    self.bytes_written += len(data)
+
+
+class BenchmarkResult(object):
+  """How a codec did on an archive.
+
+  Attributes:
+    codec: The codec.
+    size: The size of the uncompressed archive.
+    compressed_size: The size of the compressed archive.
+    compress_seconds: The time taken to write the compressed archive.
+    decompress_seconds: The time taken to decompress it.
+  """
+
+  def __init__(self, codec, size, compressed_size, compress_seconds,
+               decompress_seconds):
+    self.codec = codec
+    self.size = size
+    self.compressed_size = compressed_size
+    self.compress_seconds = compress_seconds
+    self.decompress_seconds = decompress_seconds
+
+  def __str__(self):
+    return ('%-8s compressed %d MB to %d MB (ratio %.2f) in %.1f seconds '
+            '(%.1f MB/s), decompressed at %.1f MB/s' % (
+                self.codec, self.size // _MEGABYTE,
+                self.compressed_size // _MEGABYTE,
+                float(self.size) / (self.compressed_size or 1),
+                self.compress_seconds,
+                self.size / float(_MEGABYTE) / (self.compress_seconds or 1),
+                self.size / float(_MEGABYTE) /
+                (self.decompress_seconds or 1)))
+
+
+def Benchmark(write_archive, codecs, scratch_dir, threads=1):
+  """Compresses and decompresses an archive with several codecs.
+
+  Every compressed archive is written to scratch_dir, decompressed and
+  removed before the next codec is tried. The results are logged and the
+  compressions and decompressions are recorded as stages of the timing
+  report.
+
+  Args:
+    write_archive: A function taking a codec and a file object, which
+      writes the archive compressed with the codec to the file.
+    codecs: The codecs to try.
+    scratch_dir: The directory the compressed archives are written to.
+    threads: The number of compression and decompression threads.
+
+  Returns:
+    A list of BenchmarkResult objects, in the order of codecs.
+  """
+  report = timing.GetReport()
+  results = []
+  for codec in codecs:
+    with tempfile.NamedTemporaryFile(dir=scratch_dir,
+                                     suffix=codec.suffix) as archive_file:
+      with report.Stage('compress %s' % codec) as stage:
+        write_archive(codec, archive_file)
+        archive_file.flush()
+        stage.bytes = os.fstat(archive_file.fileno()).st_size
+      archive_file.seek(0)
+      counting_file = _CountingFile()
+      with report.Stage('decompress %s' % codec) as decompress_stage:
+        codec.Decompress(archive_file, counting_file, threads)
+        decompress_stage.bytes = counting_file.bytes_written
+    result = BenchmarkResult(codec, counting_file.bytes_written, stage.bytes,
+                             stage.seconds, decompress_stage.seconds)
+    logging.info('Compression benchmark: %s', result)
+    results.append(result)
+  return results
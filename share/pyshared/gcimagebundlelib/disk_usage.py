@@ -0,0 +1,161 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Measures the disk space taken by the files of an image.
+
+The tree is walked the way it is copied, skipping excluded files and
+counting hard linked files once, and the blocks allocated to the files are
+summed. Directories are listed by several threads, as walking a tree mostly
+waits on the disk.
+"""
+
+
+
+import errno
+import logging
+import math
+from multiprocessing import pool
+import os
+import stat
+import time
+
+from gcimagebundlelib import tree_copy
+
+# Listing directories is I/O bound, so more threads than CPUs help.
+DEFAULT_THREADS = 8
+
+_GIGABYTE = 1024 * 1024 * 1024
+
+# ext4 metadata besides the journal: inode tables, bitmaps and group
+# descriptors, as a share of the file system size.
+_METADATA_RATIO = 0.02
+# Size of the journal mke2fs makes for file systems of a few GB and more.
+_JOURNAL_SIZE = 128 * 1024 * 1024
+# Bytes per inode used by mke2fs by default.
+_INODE_RATIO = 16384
+# Space before the first partition.
+_PARTITION_START = 1024 * 1024
+# Share of the file system left free when its size is chosen.
+_FREE_SPACE_RATIO = 0.2
+
+
+class DiskUsage(object):
+  """The space taken by a tree of files.
+
+  Attributes:
+    allocated: The bytes allocated to the files and directories.
+    files: The number of files and directories, hard links counted once.
+  """
+
+  def __init__(self, allocated=0, files=0):
+    self.allocated = allocated
+    self.files = files
+
+
+def _ScanDirectory(args):
+  """Lists a directory for Measure.
+
+  Args:
+    args: A tuple of the directory path and the should_exclude callable.
+
+  Returns:
+    A tuple of the subdirectories, the bytes allocated to the entries which
+    are not hard linked files, their number and the (inode, allocated bytes)
+    of the hard linked files.
+  """
+  path, should_exclude = args
+  subdirs = []
+  allocated = 0
+  files = 0
+  linked = []
+  try:
+    entries = tree_copy.ListDir(path)
+  except OSError as e:
+    if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+      raise
+    logging.debug('%s vanished before it was measured', path)
+    entries = []
+  for name, file_stat in entries:
+    file_path = os.path.join(path, name)
+    if should_exclude and should_exclude(file_path, file_stat):
+      continue
+    if stat.S_ISDIR(file_stat.st_mode):
+      subdirs.append(file_path)
+    elif stat.S_ISREG(file_stat.st_mode) and file_stat.st_nlink > 1:
+      linked.append(((file_stat.st_dev, file_stat.st_ino),
+                     file_stat.st_blocks * 512))
+      continue
+    allocated += file_stat.st_blocks * 512
+    files += 1
+  return subdirs, allocated, files, linked
+
+
+def Measure(root, should_exclude=None, ignore_hard_links=False,
+            threads=DEFAULT_THREADS):
+  """Measures the space taken by the files which would be copied from root.
+
+  Args:
+    root: The directory to measure.
+    should_exclude: A callable taking a path and its lstat result, and
+      returning True for files and directories which are not copied.
+    ignore_hard_links: If True hard links are counted as separate files,
+      as they are copied.
+    threads: The number of threads listing directories.
+
+  Returns:
+    A DiskUsage object.
+  """
+  start_time = time.time()
+  usage = DiskUsage(os.lstat(root).st_blocks * 512, 1)
+  inodes = set()
+  level = [root]
+  worker_pool = pool.ThreadPool(threads)
+  try:
+    # Directories are listed one level of the tree at a time.
+    while level:
+      next_level = []
+      for subdirs, allocated, files, linked in worker_pool.imap_unordered(
+          _ScanDirectory, [(path, should_exclude) for path in level]):
+        next_level.extend(subdirs)
+        usage.allocated += allocated
+        usage.files += files
+        for inode, allocated in linked:
+          if ignore_hard_links or inode not in inodes:
+            inodes.add(inode)
+            usage.allocated += allocated
+            usage.files += 1
+      level = next_level
+  finally:
+    worker_pool.close()
+    worker_pool.join()
+  logging.info('%s holds %d bytes in %d files to copy (measured in %.1f '
+               'seconds)', root, usage.allocated, usage.files,
+               time.time() - start_time)
+  return usage
+
+
+def MinimumFileSystemSize(usage):
+  """Returns the smallest disk which can hold the files, for an ext4 disk."""
+  size = (usage.allocated + _JOURNAL_SIZE) / (1 - _METADATA_RATIO)
+  return long(max(size, usage.files * _INODE_RATIO) + _PARTITION_START)
+
+
+def SuggestedFileSystemSize(usage):
+  """Returns a disk size which holds the files with some free space.
+
+  The size is a whole number of GB, as Compute Engine disks are.
+  """
+  size = MinimumFileSystemSize(usage) / (1 - _FREE_SPACE_RATIO)
+  return long(math.ceil(size / _GIGABYTE)) * _GIGABYTE
@@ -19,6 +19,18 @@
 
 import logging
 import os
+import stat
+
+
+def _Components(path):
+  return [c for c in os.path.normpath(path).split('/') if c]
+
+
+def _IsUnder(filename, path):
+  """Returns whether filename is path or inside it, comparing components."""
+  filename = os.path.normpath(filename)
+  path = os.path.normpath(path)
+  return filename == path or filename.startswith(path.rstrip('/') + '/')
 
 
 class ExcludeSpec(object):
@@ -37,8 +49,7 @@ class ExcludeSpec(object):
       self.preserve_subdir = True
 
   def ShouldExclude(self, filename):
-    prefix = os.path.commonprefix([filename, self.path])
-    if prefix == self.path:
+    if _IsUnder(filename, self.path):
       if ((self.preserve_dir and filename == self.path) or
           (self.preserve_subdir and os.path.isdir(filename)) or
           (self.preserve_file and os.path.isfile(filename))):
@@ -80,3 +91,64 @@ class ExcludeSpec(object):
         spec += '- %s\n' % relative_path
       spec += '- %s\n' % os.path.join(relative_path, '**')
     return spec
+
+
+class ExcludeIndex(object):
+  """Decides exclusion for many ExcludeSpecs at once.
+
+  The spec paths are stored in a trie of path components, so a decision
+  walks the components of the path once instead of testing every spec, and
+  the path is stat'ed at most once however many specs apply to it.
+  """
+
+  def __init__(self, specs):
+    """Initializes ExcludeIndex object.
+
+    Args:
+      specs: A list of ExcludeSpec objects.
+    """
+    self.spec_count = len(specs)
+    # Every node is a pair of a dict of children by component and the list
+    # of specs whose path ends at the node.
+    self._root = ({}, [])
+    for spec in specs:
+      node = self._root
+      for component in _Components(spec.path):
+        node = node[0].setdefault(component, ({}, []))
+      node[1].append(spec)
+
+  def ShouldExclude(self, filename, file_stat=None):
+    """Checks if a file/directory is excluded by any spec.
+
+    Args:
+      filename: An absolute file/directory path.
+      file_stat: The os.stat() result for filename, if the caller has it.
+
+    Returns:
+      True if filename shouldn't be copied, False otherwise.
+    """
+    components = _Components(filename)
+    node = self._root
+    depth = 0
+    while True:
+      for spec in node[1]:
+        if depth == len(components) and spec.preserve_dir:
+          continue
+        if spec.preserve_subdir or spec.preserve_file:
+          if file_stat is None:
+            try:
+              file_stat = os.stat(filename)
+            except OSError:
+              file_stat = False
+          if file_stat and (
+              (spec.preserve_subdir and stat.S_ISDIR(file_stat.st_mode)) or
+              (spec.preserve_file and stat.S_ISREG(file_stat.st_mode))):
+            logging.warning('preserving %s', filename)
+            continue
+        return True
+      if depth == len(components):
+        return False
+      node = node[0].get(components[depth])
+      if node is None:
+        return False
+      depth += 1
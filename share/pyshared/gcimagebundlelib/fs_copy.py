@@ -21,6 +21,7 @@ import logging
 import os
 import re
 
+from gcimagebundlelib import exclude_spec
 from gcimagebundlelib import manifest
 from gcimagebundlelib import utils
 
@@ -41,6 +42,7 @@ class FsCopy(object):
     self._output_tarfile = None
     self._srcs = []
     self._excludes = []
+    self._exclude_index = None
     self._key = None
     self._recursive = True
     self._fs_size = 0
@@ -49,6 +51,15 @@ class FsCopy(object):
     self._overwrite_list = []
     self._scratch_dir = '/tmp'
     self._disk = None
+    self._compress_threads = 1
+    self._builtin_tar = False
+    self._staging_tree = False
+    self._builtin_copy = False
+    self._incremental_dir = None
+    self._block_store_dir = None
+    self._uploader = None
+    self._codec = None
+    self._benchmark_codecs = []
     self._manifest = manifest.ImageManifest(is_gce_instance=utils.IsRunningOnGCE())
 
   def SetTarfile(self, tar_file):
@@ -128,6 +139,88 @@ class FsCopy(object):
     """
     self._scratch_dir = directory
 
+  def SetCompressThreads(self, threads):
+    """Sets the number of threads used to gzip the archive.
+
+    Args:
+      threads: number of compression threads. 1 lets tar compress the
+        archive.
+    """
+    self._compress_threads = threads
+
+  def UseBuiltinTar(self):
+    """Requests that the archive is written by sparse_tar instead of tar."""
+    self._builtin_tar = True
+
+  def UseStagingTree(self):
+    """Requests that the file system is made from a staging directory.
+
+    The file system is then written by mke2fs -d instead of being mounted
+    through device-mapper, which only works for ext2, ext3 and ext4.
+    """
+    self._staging_tree = True
+
+  def UseBuiltinCopy(self):
+    """Requests that files are copied by tree_copy instead of rsync."""
+    self._builtin_copy = True
+
+  def SetIncrementalDirectory(self, directory):
+    """Sets a directory keeping the image between runs.
+
+    The disk image and a manifest of its files are kept there, and the next
+    image is built on top of them, copying only the files which changed.
+    This needs the files to be copied by tree_copy.
+
+    Args:
+      directory: incremental state directory path.
+    """
+    self._incremental_dir = directory
+    self._builtin_copy = True
+    self._excludes.append(exclude_spec.ExcludeSpec(directory))
+
+  def SetUploader(self, image_uploader):
+    """Requests that the archive is streamed to a destination as it is written.
+
+    The archive is then not written to the scratch directory, and the tar
+    file name is its name at the destination.
+
+    Args:
+      image_uploader: An uploader.Uploader object.
+    """
+    self._uploader = image_uploader
+
+  def SetCompression(self, codec):
+    """Sets the codec compressing the archive.
+
+    Args:
+      codec: A compression.Codec object. Without one the archive is gzipped.
+    """
+    self._codec = codec
+
+  def SetCompressionBenchmark(self, codecs):
+    """Requests that the image is compressed with several codecs first.
+
+    Each codec compresses and decompresses the image in the scratch
+    directory before the archive is written, and the compression time,
+    ratio and decompression speed are logged.
+
+    Args:
+      codecs: A list of compression.Codec objects.
+    """
+    self._benchmark_codecs = codecs
+
+  def SetBlockStore(self, directory):
+    """Requests that the image is stored in a block store instead of a tar.
+
+    The output file is then a block_store index of the image, and only the
+    blocks of the image which are not in the store yet are written to it.
+
+    Args:
+      directory: block store directory path.
+    """
+    self._block_store_dir = directory
+    self._excludes.append(exclude_spec.ExcludeSpec(directory))
+
   def IgnoreHardLinks(self):
     """Requests that hard links should not be copied as hard links."""
 
@@ -164,17 +257,22 @@ class FsCopy(object):
       if not os.path.exists(src):
         raise FsCopyError('%s does not exists' % src)
 
-  def _ShouldExclude(self, filename):
+  def _ShouldExclude(self, filename, file_stat=None):
     """"Checks if a file/directory are excluded from a copy.
 
     Args:
       filename: a file/directory path.
+      file_stat: the os.stat() result for filename, if already known.
 
     Returns:
       True if a file/directory shouldn't be copied, False otherwise.
     """
-    for spec in self._excludes:
-      if spec.ShouldExclude(filename):
-        logging.info('tarfile: Excluded %s', filename)
-        return True
+    # Excludes are only ever appended, so the index is current as long as it
+    # holds as many specs as there are.
+    if (self._exclude_index is None or
+        self._exclude_index.spec_count != len(self._excludes)):
+      self._exclude_index = exclude_spec.ExcludeIndex(self._excludes)
+    if self._exclude_index.ShouldExclude(filename, file_stat):
+      logging.info('tarfile: Excluded %s', filename)
+      return True
     return False
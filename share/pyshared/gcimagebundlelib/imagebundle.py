@@ -30,8 +30,14 @@ import tempfile
 import time
 
 from gcimagebundlelib import block_disk
+from gcimagebundlelib import block_store
+from gcimagebundlelib import compression
 from gcimagebundlelib import exclude_spec
+from gcimagebundlelib import multipart_upload
 from gcimagebundlelib import platform_factory
+from gcimagebundlelib import timing
+from gcimagebundlelib import tree_copy
+from gcimagebundlelib import uploader
 from gcimagebundlelib import utils
 
 def SetupArgsParser():
@@ -73,11 +79,71 @@ def SetupArgsParser():
   #TODO(user): Get dehumanize.
   parser.add_option('--fssize', dest='fs_size', default=10*1024*1024*1024,
                     type='int', help='File system size in bytes')
+  parser.add_option('--auto_fssize', dest='auto_fssize', default=False,
+                    action='store_true',
+                    help='Choose the file system size from the size of the'
+                    ' files to copy, in whole GB, instead of using --fssize.')
   parser.add_option('-b', '--bucket', dest='bucket',
-                    help='Destination storage bucket')
+                    help='Destination storage bucket. The image is uploaded'
+                    ' while it is compressed, without a local copy. An'
+                    ' http:// URL or a file:// directory may be given'
+                    ' instead.')
   parser.add_option('-f', '--filesystem', dest='file_system',
                     default=None,
                     help='File system type for the image.')
+  parser.add_option('--compress_threads', dest='compress_threads', default=1,
+                    type='int',
+                    help='Number of threads used to compress the image. With'
+                    ' more than one thread a gzipped image is compressed in'
+                    ' parallel blocks.')
+  parser.add_option('--compression', dest='compression', default=None,
+                    help='Compression of the image archive, as name[:level]:'
+                    ' gzip (levels 1-9, default 6), xz (levels 0-9, default'
+                    ' 6, needs the xz command) or none. Compute Engine'
+                    ' imports gzip archives. Defaults to gzip.')
+  parser.add_option('--compression_benchmark', dest='compression_benchmark',
+                    default=None,
+                    help='Comma separated codecs, as for --compression, each'
+                    ' of which compresses and decompresses the disk file in'
+                    ' the scratch directory before the archive is written.'
+                    ' The compression time, ratio and decompression speed of'
+                    ' each are logged and saved in the timing report.')
+  parser.add_option('--builtin_tar', dest='builtin_tar', default=False,
+                    action='store_true',
+                    help='Write the image archive in-process, reading only the'
+                    ' allocated parts of the disk file, instead of with tar.')
+  parser.add_option('--staging_tree', dest='staging_tree', default=False,
+                    action='store_true',
+                    help='Copy the files to a staging directory and write the'
+                    ' file system into the disk file with mke2fs -d, without'
+                    ' device-mapper or mounts. Needs e2fsprogs 1.43 or later'
+                    ' and an ext2, ext3 or ext4 file system.')
+  parser.add_option('--builtin_copy', dest='builtin_copy', default=False,
+                    action='store_true',
+                    help='Copy the files in-process with several threads'
+                    ' instead of with rsync. Needs the pyxattr module to'
+                    ' preserve extended attributes and ACLs.')
+  parser.add_option('--incremental_dir', dest='incremental_dir', default=None,
+                    help='Directory keeping the disk image and a manifest of'
+                    ' its files between runs. If it holds a previous image of'
+                    ' the same size, only the files which changed since are'
+                    ' copied. Implies --builtin_copy.')
+  parser.add_option('--block_store', dest='block_store', default=None,
+                    help='Block store directory. The image is split into'
+                    ' blocks stored there under their content hash, only'
+                    ' adding the blocks not already stored, and the output'
+                    ' is an index of the blocks instead of a tar.gz'
+                    ' archive.')
+  parser.add_option('--multipart_upload', dest='multipart_upload',
+                    default=False, action='store_true',
+                    help='Write the image to the scratch directory, then'
+                    ' upload it to the bucket in parts uploaded concurrently'
+                    ' with the Cloud Storage XML API instead of streaming it'
+                    ' with gsutil. If the upload fails, the image is kept and'
+                    ' running the tool again uploads its missing parts'
+                    ' without bundling the image again. Remove'
+                    ' upload_state.json from the output directory to bundle'
+                    ' a new image instead.')
   parser.add_option('--skip_disk_space_check', dest='skip_disk_space_check',
                     default=False, action='store_true',
                     help='Skip the disk space requirement check.')
@@ -91,6 +157,37 @@ def VerifyArgs(parser, options):
     parser.error('output bundle directory must be specified.')
   if not os.path.exists(options.output_directory):
     parser.error('output bundle directory does not exist.')
+  if options.compress_threads < 1:
+    parser.error('--compress_threads must be at least 1.')
+  try:
+    for spec in filter(None, [options.compression] +
+                       (options.compression_benchmark or '').split(',')):
+      compression.ParseCodec(spec)
+  except compression.CompressionError as e:
+    parser.error(str(e))
+  if options.block_store and (options.compression or
+                              options.compression_benchmark):
+    parser.error('--block_store cannot be used with --compression or '
+                 '--compression_benchmark.')
+  if ((options.builtin_copy or options.incremental_dir) and
+      not tree_copy.XATTRS_SUPPORTED):
+    parser.error('--builtin_copy needs the pyxattr module.')
+  if options.incremental_dir:
+    if options.staging_tree:
+      parser.error('--incremental_dir cannot be used with --staging_tree.')
+    if not os.path.isdir(options.incremental_dir):
+      parser.error('incremental directory does not exist.')
+  if options.block_store:
+    if options.bucket:
+      parser.error('--block_store cannot be used with --bucket.')
+    if not os.path.isdir(options.block_store):
+      parser.error('block store directory does not exist.')
+  if options.multipart_upload:
+    if not options.bucket:
+      parser.error('--multipart_upload needs --bucket.')
+    if not isinstance(uploader.ForUrl(options.bucket),
+                      uploader.GsutilUploader):
+      parser.error('--multipart_upload needs a Cloud Storage bucket.')
 
   # TODO(user): add more verification as needed
 
@@ -124,6 +221,9 @@ def SetupLogging(options, log_dir='/tmp'):
   Args:
     options: collection of command line options.
     log_dir: directory used to generate log files.
+
+  Returns:
+    The path of the log file.
   """
   if options.log_file:
     logfile = options.log_file
@@ -138,6 +238,7 @@ def SetupLogging(options, log_dir='/tmp'):
   console = logging.StreamHandler()
   console.setLevel(GetLogLevel(options))
   logging.getLogger().addHandler(console)
+  return logfile
 
 
 def PrintVersionInfo():
@@ -162,7 +263,48 @@ def main():
   VerifyArgs(parser, options)
 
   scratch_dir = tempfile.mkdtemp(dir=options.output_directory)
-  SetupLogging(options, scratch_dir)
+  logfile = SetupLogging(options, scratch_dir)
+  # The timing report is saved whether bundling succeeded or not, next to
+  # the log if one was given, otherwise in the output directory, so that it
+  # outlives the scratch directory.
+  if options.log_file:
+    report_path = options.log_file + '.json'
+  else:
+    report_path = os.path.join(options.output_directory,
+                               os.path.basename(logfile) + '.json')
+  try:
+    status = BundleImage(options, scratch_dir)
+  finally:
+    timing.GetReport().Save(report_path)
+  if status:
+    return status
+
+  if options.cleanup:
+    shutil.rmtree(scratch_dir)
+
+
+def BundleImage(options, scratch_dir):
+  """Bundles the image and publishes it.
+
+  Args:
+    options: collection of command line options.
+    scratch_dir: directory for temporary files.
+
+  Returns:
+    0 on success, -1 on failure.
+  """
+  if options.multipart_upload:
+    image_uploader = multipart_upload.MultipartUploader(
+        options.bucket, os.path.join(options.output_directory,
+                                     'upload_state.json'))
+    # The image of a failed upload is uploaded rather than bundled again.
+    pending_upload = image_uploader.PendingUpload()
+    if pending_upload:
+      archive_path, output_name = pending_upload
+      logging.info('Resuming the upload of %s to %s', archive_path,
+                   image_uploader.Url(output_name))
+      return UploadArchive(image_uploader, archive_path, output_name)
+
   try:
     guest_platform = platform_factory.PlatformFactory(
         options.root_directory).GetPlatform()
@@ -171,7 +313,12 @@ def main():
                      ' Platform rules can be added to platform_factory.py.')
     return -1
 
-  temp_file_name = tempfile.mktemp(dir=scratch_dir, suffix='.tar.gz')
+  codec = compression.ParseCodec(options.compression or 'gzip')
+  if options.block_store:
+    output_suffix = block_store.INDEX_SUFFIX
+  else:
+    output_suffix = codec.suffix
+  temp_file_name = tempfile.mktemp(dir=scratch_dir, suffix=output_suffix)
 
   file_system = GetTargetFilesystem(options, guest_platform)
   logging.info('File System: %s', file_system)
@@ -179,6 +326,29 @@ def main():
   bundle = block_disk.RootFsRaw(
       options.fs_size, file_system, options.skip_disk_space_check)
   bundle.SetTarfile(temp_file_name)
+  bundle.SetCompressThreads(options.compress_threads)
+  bundle.SetCompression(codec)
+  if options.compression_benchmark:
+    bundle.SetCompressionBenchmark(
+        [compression.ParseCodec(spec)
+         for spec in options.compression_benchmark.split(',')])
+  if options.builtin_tar:
+    bundle.UseBuiltinTar()
+  if options.staging_tree:
+    bundle.UseStagingTree()
+  if options.builtin_copy:
+    bundle.UseBuiltinCopy()
+  if options.incremental_dir:
+    bundle.SetIncrementalDirectory(os.path.abspath(options.incremental_dir))
+  if options.block_store:
+    bundle.SetBlockStore(os.path.abspath(options.block_store))
+  if options.bucket:
+    # /usr/local/bin not in redhat root PATH by default
+    if '/usr/local/bin' not in os.environ['PATH']:
+      os.environ['PATH'] += ':/usr/local/bin'
+    if not options.multipart_upload:
+      image_uploader = uploader.ForUrl(options.bucket)
+      bundle.SetUploader(image_uploader)
   if options.disk:
     readlink_command = ['readlink', '-f', options.disk]
     final_path = utils.RunCommand(readlink_command).strip()
@@ -206,9 +376,26 @@ def main():
                            in utils.GetMounts(options.root_directory)])
   bundle.SetPlatform(guest_platform)
 
+  # Measure the files to copy, once all the excludes are known, to check the
+  # disk space and choose the disk size.
+  if options.auto_fssize or not options.skip_disk_space_check:
+    with timing.GetReport().Stage('measure'):
+      suggested_fs_size = bundle.MeasureDiskUsage()
+    if options.auto_fssize:
+      options.fs_size = suggested_fs_size
+      bundle.SetFsSize(options.fs_size)
+      logging.info('Disk Size chosen: %s bytes', options.fs_size)
+
   # Verify that bundle attributes are correct and create tar bundle.
   bundle.Verify()
-  (fs_size, digest) = bundle.Bundleup()
+  try:
+    (fs_size, digest) = bundle.Bundleup()
+  except uploader.UploadError as e:
+    logging.critical('Failed to upload image: %s', e)
+    return -1
+  except compression.CompressionError as e:
+    logging.critical('Failed to compress image: %s', e)
+    return -1
   if not digest:
     logging.critical('Could not get digest for the bundle.'
                      ' The bundle may not be created correctly')
@@ -219,41 +406,54 @@ def main():
     return -1
 
   if options.output_file_name:
-    output_file = os.path.join(
-        options.output_directory, options.output_file_name)
+    output_name = options.output_file_name
   else:
-    output_file = os.path.join(
-        options.output_directory, '%s.image.tar.gz' % digest)
+    output_name = '%s.image%s' % (digest, output_suffix)
+
+  if options.multipart_upload:
+    return UploadArchive(image_uploader, temp_file_name, output_name)
+  elif options.bucket:
+    # The archive was uploaded as it was written, under its temporary name.
+    try:
+      with timing.GetReport().Stage('publish'):
+        image_uploader.Rename(os.path.basename(temp_file_name), output_name)
+    except (EnvironmentError, subprocess.CalledProcessError,
+            uploader.UploadError) as e:
+      logging.critical('Failed to rename uploaded image %s to %s: %s',
+                       image_uploader.Url(os.path.basename(temp_file_name)),
+                       output_name, e)
+      return -1
+    logging.info('Uploaded image to %s', image_uploader.Url(output_name))
+  else:
+    output_file = os.path.join(options.output_directory, output_name)
+    os.rename(temp_file_name, output_file)
+    logging.info('Created %s file at %s' % (output_suffix[1:], output_file))
+  return 0
 
-  os.rename(temp_file_name, output_file)
-  logging.info('Created tar.gz file at %s' % output_file)
 
-  if options.bucket:
-    bucket = options.bucket
-    if bucket.startswith('gs://'):
-      output_bucket = '%s/%s' % (
-          bucket, os.path.basename(output_file))
-    else:
-      output_bucket = 'gs://%s/%s' % (
-          bucket, os.path.basename(output_file))
+def UploadArchive(image_uploader, archive_path, output_name):
+  """Uploads an archive with a multipart_upload.MultipartUploader.
 
-    # /usr/local/bin not in redhat root PATH by default
-    if '/usr/local/bin' not in os.environ['PATH']:
-      os.environ['PATH'] += ':/usr/local/bin'
-
-    # TODO: Consider using boto library directly.
-    cmd = ['gsutil', 'cp', output_file, output_bucket]
-    retcode = subprocess.call(cmd)
-    if retcode != 0:
-      logging.critical('Failed to copy image to bucket. '
-                       'gsutil returned %d. To retry, run the command: %s',
-                       retcode, ' '.join(cmd))
+  The archive is removed once it is uploaded, and kept to resume the upload
+  if it fails.
 
-      return -1
-    logging.info('Uploaded image to %s', output_bucket)
-
-    # If we've uploaded, then we can remove the local file.
-    os.remove(output_file)
+  Args:
+    image_uploader: The multipart_upload.MultipartUploader.
+    archive_path: The path of the archive.
+    output_name: The object name of the image.
 
-  if options.cleanup:
-    shutil.rmtree(scratch_dir)
+  Returns:
+    0 on success, -1 on failure.
+  """
+  try:
+    with timing.GetReport().Stage('publish') as stage:
+      stage.bytes = os.path.getsize(archive_path)
+      image_uploader.UploadFile(archive_path, output_name)
+  except uploader.UploadError as e:
+    logging.critical('Failed to upload image %s to %s: %s. Run the tool '
+                     'again to resume the upload.', archive_path,
+                     image_uploader.Url(output_name), e)
+    return -1
+  os.remove(archive_path)
+  logging.info('Uploaded image to %s', image_uploader.Url(output_name))
+  return 0
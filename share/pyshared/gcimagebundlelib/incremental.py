@@ -0,0 +1,190 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Per-file manifest of a disk image, for incremental bundling.
+
+The manifest records the path, type, size, times, inode and content hash of
+every file copied into the image. When the next image is built on top of
+the previous disk.raw, files whose record still matches are not copied
+again, files whose content hash still matches only get their metadata
+updated, and files no longer present are removed.
+"""
+
+
+
+import json
+import logging
+import os
+import shutil
+import stat
+
+# Version of the manifest file format.
+FORMAT_VERSION = 1
+
+# Names of the files kept in an incremental state directory.
+DISK_FILE_NAME = 'disk.raw'
+MANIFEST_FILE_NAME = 'files.json'
+
+_TYPE_CHARS = ((stat.S_ISDIR, 'd'), (stat.S_ISREG, 'f'), (stat.S_ISLNK, 'l'),
+               (stat.S_ISCHR, 'c'), (stat.S_ISBLK, 'b'))
+
+
+class ManifestError(Exception):
+  """Error occurred reading a file manifest."""
+
+
+def _Type(file_stat):
+  for test, type_char in _TYPE_CHARS:
+    if test(file_stat.st_mode):
+      return type_char
+  return '?'
+
+
+def _Signature(file_stat):
+  """Returns what must not change for a file to be reused as is.
+
+  The change time is part of it so that changes of ownership, permissions
+  and extended attributes are noticed as well.
+  """
+  return [_Type(file_stat), file_stat.st_size, file_stat.st_mtime,
+          file_stat.st_ctime, file_stat.st_ino]
+
+
+class FileManifest(object):
+  """Records of the files of a disk image, compared with a previous image.
+
+  Attributes:
+    uuid: The UUID of the file system of the image.
+    fs_size: The size of the disk image.
+    bytes_reused: The size of the files found unchanged.
+    bytes_copied: The size of the files copied.
+  """
+
+  def __init__(self, root, previous=None, uuid=None, fs_size=None):
+    """Initializes FileManifest object.
+
+    Args:
+      root: The path the image is populated under, a mount point for
+        instance. Files are recorded relative to it.
+      previous: The records of the previous image, as returned by Load().
+      uuid: The UUID of the file system of the image.
+      fs_size: The size of the disk image.
+    """
+    self._root = root
+    self._previous = previous or {}
+    self._records = {}
+    self.uuid = uuid
+    self.fs_size = fs_size
+    self.bytes_reused = 0
+    self.bytes_copied = 0
+
+  def _Key(self, dest_path):
+    return os.path.relpath(dest_path, self._root)
+
+  def Unchanged(self, dest_path, file_stat):
+    """Checks if a file is the same as in the previous image.
+
+    If it is, it is recorded as is.
+
+    Args:
+      dest_path: The path of the file in the image.
+      file_stat: The lstat result of the source of the file.
+
+    Returns:
+      True if the file need not be copied again.
+    """
+    key = self._Key(dest_path)
+    previous = self._previous.get(key)
+    if previous and previous[:5] == _Signature(file_stat):
+      self._records[key] = previous
+      self.bytes_reused += file_stat.st_size
+      return True
+    return False
+
+  def PreviousDigest(self, dest_path, file_stat):
+    """Returns the content hash of a file of the same size, or None.
+
+    Args:
+      dest_path: The path of the file in the image.
+      file_stat: The lstat result of the source of the file.
+    """
+    previous = self._previous.get(self._Key(dest_path))
+    if (previous and previous[0] == 'f' and
+        previous[1] == file_stat.st_size):
+      return previous[5]
+    return None
+
+  def Add(self, dest_path, file_stat, digest=None, reused=False):
+    """Records a file copied, or updated, in the image.
+
+    Args:
+      dest_path: The path of the file in the image.
+      file_stat: The lstat result of the source of the file.
+      digest: The content hash of a regular file.
+      reused: True if only the metadata of the file had to be updated.
+    """
+    self._records[self._Key(dest_path)] = _Signature(file_stat) + [digest]
+    if reused:
+      self.bytes_reused += file_stat.st_size
+    elif stat.S_ISREG(file_stat.st_mode):
+      self.bytes_copied += file_stat.st_size
+
+  def RemoveStale(self):
+    """Removes the files of the previous image which were not recorded.
+
+    Returns:
+      The number of files and directories removed.
+    """
+    stale = sorted(set(self._previous) - set(self._records), reverse=True)
+    for key in stale:
+      path = os.path.join(self._root, key)
+      if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+      elif os.path.lexists(path):
+        os.unlink(path)
+    return len(stale)
+
+  def Save(self, file_path):
+    """Writes the manifest to a file."""
+    with open(file_path + '.tmp', 'w') as manifest_file:
+      json.dump({'version': FORMAT_VERSION, 'uuid': self.uuid,
+                 'fs_size': self.fs_size, 'files': self._records},
+                manifest_file)
+    os.rename(file_path + '.tmp', file_path)
+
+  @staticmethod
+  def Load(file_path):
+    """Reads a manifest written by Save().
+
+    Args:
+      file_path: The path of the manifest.
+
+    Returns:
+      A tuple of the records, the file system UUID and the disk size.
+
+    Raises:
+      ManifestError: If the file is not a manifest of a known version.
+    """
+    try:
+      with open(file_path) as manifest_file:
+        manifest = json.load(manifest_file)
+    except ValueError as e:
+      raise ManifestError('%s is not a valid manifest: %s' % (file_path, e))
+    if manifest.get('version') != FORMAT_VERSION:
+      raise ManifestError('%s has unsupported version %s'
+                          % (file_path, manifest.get('version')))
+    logging.debug('Loaded %d file records from %s', len(manifest['files']),
+                  file_path)
+    return manifest['files'], manifest['uuid'], manifest['fs_size']
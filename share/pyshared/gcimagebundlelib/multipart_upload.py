@@ -0,0 +1,483 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Resumable multipart uploads to Cloud Storage.
+
+The archive is written to the scratch directory, then cut into parts which
+are uploaded concurrently with the multipart upload XML API, each thread
+keeping its own connection open. Failed requests are retried. The archive,
+the upload and the parts uploaded are recorded in a state file, and the
+archive is kept until the upload completes, so that when the tool is run
+again after a failed upload it uploads the missing parts of the same
+archive instead of bundling the image again. A new bundle would not share
+any part with the previous one, as compressed data differs from the first
+changed byte onwards. Every part is checked by its MD5, and the object by
+the MD5 of the part MD5s.
+"""
+
+
+
+import base64
+import hashlib
+import httplib
+import json
+import logging
+import math
+from multiprocessing import pool
+import os
+import socket
+import threading
+import time
+import urllib
+import urlparse
+from xml.etree import ElementTree
+
+from gcimagebundlelib import uploader
+from gcimagebundlelib import utils
+
+# The Cloud Storage XML API.
+GCS_ENDPOINT = 'https://storage.googleapis.com'
+
+# Size of the parts, all but the last one must be at least 5MB.
+PART_SIZE = 16 * 1024 * 1024
+
+# Number of parts uploaded at once.
+DEFAULT_THREADS = 4
+
+# Number of attempts of a request, and the delay before the first retry,
+# which doubles after every attempt.
+ATTEMPTS = 5
+RETRY_DELAY = 1
+
+# Seconds before its expiry an access token is renewed.
+_TOKEN_MARGIN = 60
+
+
+class MultipartUploadError(uploader.UploadError):
+  """Error occurred in a multipart upload."""
+
+
+class _RetriableError(Exception):
+  """A request failed in a way which may not happen again."""
+
+
+def _MetadataToken():
+  """Returns an access token of the instance service account.
+
+  Returns:
+    A tuple of the token and the number of seconds it is valid for.
+  """
+  response = utils.Http().GetMetadata(
+      'instance/service-accounts/default/token')
+  token = json.loads(response)
+  return token['access_token'], token['expires_in']
+
+
+def _FindText(element, name):
+  """Returns the text of a descendant, ignoring XML namespaces."""
+  for child in element.iter():
+    if child.tag == name or child.tag.endswith('}' + name):
+      return child.text
+  return None
+
+
+class ObjectStore(object):
+  """Client of the multipart upload API of a bucket."""
+
+  def __init__(self, bucket, endpoint=GCS_ENDPOINT, token_source=None,
+               retry_delay=RETRY_DELAY):
+    """Initializes ObjectStore object.
+
+    Args:
+      bucket: The bucket name, with or without a gs:// prefix.
+      endpoint: The URL of the XML API.
+      token_source: A callable returning an OAuth2 access token and the
+        seconds it is valid for, or None to send requests without
+        authorization. The token is kept until it is about to expire.
+      retry_delay: The delay in seconds before a failed request is retried.
+    """
+    if bucket.startswith('gs://'):
+      bucket = bucket[len('gs://'):]
+    self.bucket = bucket.strip('/')
+    self._endpoint = urlparse.urlsplit(endpoint)
+    self._token_source = token_source
+    self._token = None
+    self._token_expiry = 0
+    self._token_lock = threading.Lock()
+    self._retry_delay = retry_delay
+    # Every thread keeps its own connection.
+    self._local = threading.local()
+
+  def _Connection(self):
+    connection = getattr(self._local, 'connection', None)
+    if connection is None:
+      if self._endpoint.scheme == 'https':
+        connection = httplib.HTTPSConnection(self._endpoint.netloc)
+      else:
+        connection = httplib.HTTPConnection(self._endpoint.netloc)
+      self._local.connection = connection
+    return connection
+
+  def _Token(self):
+    with self._token_lock:
+      if self._token is None or time.time() >= self._token_expiry:
+        self._token, expires_in = self._token_source()
+        self._token_expiry = time.time() + expires_in - _TOKEN_MARGIN
+      return self._token
+
+  def _ExpireToken(self, token):
+    with self._token_lock:
+      # Another thread may have renewed it already.
+      if self._token == token:
+        self._token = None
+
+  def _CloseConnection(self):
+    connection = getattr(self._local, 'connection', None)
+    if connection:
+      connection.close()
+      self._local.connection = None
+
+  def Path(self, name, query=None):
+    """Returns the request path of an object."""
+    path = '%s/%s/%s' % (self._endpoint.path.rstrip('/'), self.bucket,
+                         urllib.quote(name))
+    if query:
+      path += '?' + urllib.urlencode(query)
+    return path
+
+  def Url(self, name):
+    return 'gs://%s/%s' % (self.bucket, name)
+
+  def _Request(self, method, name, query=None, body=None, headers=None):
+    """Sends a request, retrying it if it fails transiently.
+
+    Returns:
+      A tuple of the response headers, as a dict with lowercase names, and
+      the response body.
+
+    Raises:
+      MultipartUploadError: If the request fails.
+    """
+    headers = dict(headers or {})
+    path = self.Path(name, query)
+    delay = self._retry_delay
+    for attempt in xrange(1, ATTEMPTS + 1):
+      try:
+        token = None
+        if self._token_source:
+          token = self._Token()
+          headers['Authorization'] = 'Bearer %s' % token
+        connection = self._Connection()
+        connection.request(method, path, body, headers)
+        response = connection.getresponse()
+        response_body = response.read()
+        if response.status == 401 and token:
+          # The token was revoked or expired early.
+          self._ExpireToken(token)
+          raise _RetriableError('%d %s' % (response.status, response.reason))
+        if response.status >= 500 or response.status == 429:
+          raise _RetriableError('%d %s' % (response.status, response.reason))
+        if response.status // 100 != 2:
+          raise MultipartUploadError('%s %s returned %d %s: %s'
+                                     % (method, path, response.status,
+                                        response.reason, response_body))
+        return dict(response.getheaders()), response_body
+      except (_RetriableError, socket.error, httplib.HTTPException) as e:
+        self._CloseConnection()
+        if attempt == ATTEMPTS:
+          raise MultipartUploadError('%s %s failed %d times: %s'
+                                     % (method, path, ATTEMPTS, e))
+        logging.warning('%s %s failed (%s), retrying in %d seconds', method,
+                        path, e, delay)
+        time.sleep(delay)
+        delay *= 2
+
+  def Initiate(self, name):
+    """Starts a multipart upload and returns its ID."""
+    _, body = self._Request('POST', name, {'uploads': ''},
+                            headers={'Content-Length': '0'})
+    return _FindText(ElementTree.fromstring(body), 'UploadId')
+
+  def UploadPart(self, name, upload_id, number, data, md5):
+    """Uploads a part and returns its ETag.
+
+    Args:
+      name: The object name.
+      upload_id: The ID of the multipart upload.
+      number: The part number, starting at 1.
+      data: The content of the part.
+      md5: The MD5 digest of data, checked by the server.
+    """
+    headers, _ = self._Request(
+        'PUT', name, [('partNumber', number), ('uploadId', upload_id)], data,
+        {'Content-MD5': base64.b64encode(md5)})
+    return headers.get('etag', '').strip('"')
+
+  def ListParts(self, name, upload_id):
+    """Returns the ETags of the uploaded parts by part number."""
+    _, body = self._Request('GET', name, {'uploadId': upload_id})
+    parts = {}
+    for element in ElementTree.fromstring(body).iter():
+      if element.tag == 'Part' or element.tag.endswith('}Part'):
+        parts[int(_FindText(element, 'PartNumber'))] = (
+            _FindText(element, 'ETag').strip('"'))
+    return parts
+
+  def Complete(self, name, upload_id, etags):
+    """Assembles the parts into the object and returns its ETag.
+
+    Args:
+      name: The object name.
+      upload_id: The ID of the multipart upload.
+      etags: The ETags of the parts, in order.
+    """
+    body = ''.join('<Part><PartNumber>%d</PartNumber><ETag>"%s"</ETag></Part>'
+                   % (number, etag) for number, etag
+                   in enumerate(etags, 1))
+    body = ('<CompleteMultipartUpload>%s</CompleteMultipartUpload>' % body)
+    _, response_body = self._Request('POST', name, {'uploadId': upload_id},
+                                     body)
+    return (_FindText(ElementTree.fromstring(response_body), 'ETag')
+            or '').strip('"')
+
+
+class _State(object):
+  """Progress of the upload of an archive, kept in a file to resume it."""
+
+  def __init__(self, path):
+    self._path = path
+    self.archive = None
+    self.size = None
+    self.mtime = None
+    self.name = None
+    self.part_size = None
+    self.upload_id = None
+    # Part numbers, as strings, to hex MD5 digests.
+    self.parts = {}
+
+  def Load(self):
+    """Loads the state of a previous upload, if any."""
+    if not self._path or not os.path.exists(self._path):
+      return
+    try:
+      with open(self._path) as state_file:
+        state = json.load(state_file)
+    except ValueError as e:
+      logging.warning('Ignoring upload state %s: %s', self._path, e)
+      return
+    # json returns unicode, which httplib cannot mix with binary bodies.
+    self.archive = state['archive'].encode('utf-8')
+    self.size = state['size']
+    self.mtime = state['mtime']
+    self.name = state['name'].encode('utf-8')
+    self.part_size = state['part_size']
+    self.upload_id = state['upload_id'].encode('utf-8')
+    self.parts = dict((str(number), str(md5))
+                      for number, md5 in state['parts'].iteritems())
+
+  def IsArchiveUnchanged(self):
+    """Checks that the archive of the upload is still there, as it was."""
+    try:
+      archive_stat = os.stat(self.archive)
+    except (OSError, TypeError):
+      return False
+    return (archive_stat.st_size == self.size and
+            archive_stat.st_mtime == self.mtime)
+
+  def Save(self):
+    if not self._path:
+      return
+    with open(self._path + '.tmp', 'w') as state_file:
+      json.dump({'archive': self.archive, 'size': self.size,
+                 'mtime': self.mtime, 'name': self.name,
+                 'part_size': self.part_size, 'upload_id': self.upload_id,
+                 'parts': self.parts}, state_file)
+    os.rename(self._path + '.tmp', self._path)
+
+  def Remove(self):
+    if self._path and os.path.exists(self._path):
+      os.remove(self._path)
+
+
+class MultipartUploader(object):
+  """Uploads archives to a bucket with resumable multipart uploads."""
+
+  def __init__(self, bucket, state_path=None, endpoint=GCS_ENDPOINT,
+               token_source=_MetadataToken, part_size=PART_SIZE,
+               threads=DEFAULT_THREADS, retry_delay=RETRY_DELAY):
+    """Initializes MultipartUploader object.
+
+    Args:
+      bucket: The bucket, with or without a gs:// prefix.
+      state_path: The file the progress of the upload is kept in, or None
+        for uploads which cannot be resumed.
+      endpoint: The URL of the XML API.
+      token_source: A callable returning an OAuth2 access token and the
+        seconds it is valid for, the token of the instance service account
+        by default.
+      part_size: The size of the parts.
+      threads: The number of parts uploaded at once.
+      retry_delay: The delay in seconds before a failed request is retried.
+    """
+    self._store = ObjectStore(bucket, endpoint, token_source, retry_delay)
+    self._state_path = state_path
+    self._part_size = part_size
+    self._threads = threads
+    self._lock = threading.Lock()
+
+  def Url(self, name):
+    """Returns the URL of an object of the bucket."""
+    return self._store.Url(name)
+
+  def PendingUpload(self):
+    """Returns the upload which failed in a previous run, if it can resume.
+
+    Returns:
+      A tuple of the path of the archive and its object name, or None if
+      there is no upload to resume or its archive changed.
+    """
+    state = _State(self._state_path)
+    state.Load()
+    if state.upload_id is None:
+      return None
+    if not state.IsArchiveUnchanged():
+      logging.warning('Not resuming the upload of %s, its archive %s changed '
+                      'or was removed', self.Url(state.name), state.archive)
+      state.Remove()
+      return None
+    return state.archive, state.name
+
+  def _StartUpload(self, file_path, name):
+    """Returns the state of the upload, resumed if it can be.
+
+    Returns:
+      A tuple of the state and the ETags of the parts the server has, by
+      part number.
+    """
+    file_stat = os.stat(file_path)
+    state = _State(self._state_path)
+    state.Load()
+    uploaded = {}
+    if (state.upload_id and state.archive == file_path and
+        state.name == name and state.part_size == self._part_size and
+        state.IsArchiveUnchanged()):
+      try:
+        uploaded = self._store.ListParts(name, state.upload_id)
+        logging.info('Resuming upload of %s, %d parts were uploaded',
+                     self.Url(name), len(uploaded))
+        return state, uploaded
+      except MultipartUploadError as e:
+        logging.warning('Cannot resume upload of %s: %s', self.Url(name), e)
+    state.archive = file_path
+    state.size = file_stat.st_size
+    state.mtime = file_stat.st_mtime
+    state.name = name
+    state.part_size = self._part_size
+    state.upload_id = self._store.Initiate(name)
+    state.parts = {}
+    state.Save()
+    return state, uploaded
+
+  def _UploadPart(self, state, uploaded, number, failures):
+    """Uploads a part of the archive unless the server has it already.
+
+    Args:
+      state: The state of the upload.
+      uploaded: The ETags of the parts the server has, by part number.
+      number: The number of the part.
+      failures: The errors of the parts which failed, shared by the parts.
+        A part is not started once another one failed.
+
+    Returns:
+      A tuple of the MD5 digest of the part and the number of bytes which
+      did not need to be uploaded, or None if the part was not started.
+    """
+    if failures:
+      return None
+    try:
+      return self._UploadPartData(state, uploaded, number)
+    except Exception as e:
+      with self._lock:
+        failures.append(e)
+      raise
+
+  def _UploadPartData(self, state, uploaded, number):
+    try:
+      with open(state.archive, 'rb') as archive_file:
+        archive_file.seek((number - 1) * self._part_size)
+        data = archive_file.read(self._part_size)
+    except IOError as e:
+      raise MultipartUploadError('Cannot read part %d of %s: %s'
+                                 % (number, state.archive, e))
+    md5 = hashlib.md5(data).digest()
+    key = str(number)
+    if (uploaded.get(number) == md5.encode('hex') and
+        state.parts.get(key) == md5.encode('hex')):
+      return md5, len(data)
+    etag = self._store.UploadPart(state.name, state.upload_id, number, data,
+                                  md5)
+    if etag and etag != md5.encode('hex'):
+      raise MultipartUploadError('Part %d of %s has ETag %s instead of its '
+                                 'MD5 %s' % (number, state.name, etag,
+                                             md5.encode('hex')))
+    with self._lock:
+      state.parts[key] = md5.encode('hex')
+      state.Save()
+    return md5, 0
+
+  def UploadFile(self, file_path, name):
+    """Uploads an archive, resuming its previous upload if there is one.
+
+    If the upload fails, its state is kept so that the parts uploaded are
+    not uploaded again by the next call for the same, unchanged, archive.
+
+    Args:
+      file_path: The path of the archive.
+      name: The object name.
+
+    Raises:
+      MultipartUploadError: If a part could not be uploaded or the object
+        does not have the expected checksum.
+    """
+    state, uploaded = self._StartUpload(os.path.abspath(file_path), name)
+    part_count = max(1, int(math.ceil(state.size / float(self._part_size))))
+    thread_pool = pool.ThreadPool(self._threads)
+    failures = []
+    try:
+      results = [thread_pool.apply_async(self._UploadPart,
+                                         (state, uploaded, number, failures))
+                 for number in xrange(1, part_count + 1)]
+      # A failed part fails the upload once the parts being uploaded are
+      # done, the parts which were not started are not.
+      parts = [result.get() for result in results]
+    finally:
+      thread_pool.close()
+      thread_pool.join()
+    md5s = [md5 for md5, _ in parts]
+    etag = self._store.Complete(name, state.upload_id,
+                                [md5.encode('hex') for md5 in md5s])
+    # The ETag of a multipart object is the MD5 of the part MD5s followed by
+    # the number of parts.
+    expected = '%s-%d' % (hashlib.md5(''.join(md5s)).hexdigest(), len(md5s))
+    if '-' not in etag:
+      logging.warning('%s has ETag %s, which is not a composite checksum, '
+                      'its checksum was not verified', self.Url(name), etag)
+    elif etag != expected:
+      raise MultipartUploadError('%s has ETag %s instead of %s'
+                                 % (self.Url(name), etag, expected))
+    state.Remove()
+    logging.info('Uploaded %s in %d parts, %d bytes were already uploaded',
+                 self.Url(name), len(md5s),
+                 sum(skipped for _, skipped in parts))
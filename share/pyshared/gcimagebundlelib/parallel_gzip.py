@@ -0,0 +1,119 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Multi-threaded gzip compression.
+
+The input is split in blocks which are compressed independently by a pool
+of threads (zlib releases the GIL while compressing). Every block becomes
+a complete gzip member and the members are written in order; a sequence of
+gzip members is a valid gzip file which gunzip, tar and Python's gzip
+module decompress as one stream.
+"""
+
+
+
+import collections
+from multiprocessing.pool import ThreadPool
+import zlib
+
+# Size of the uncompressed blocks compressed by each thread.
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+
+# Compression level used by gzip when none is specified.
+DEFAULT_LEVEL = 6
+
+
+def CompressBlock(data, level=DEFAULT_LEVEL):
+  """Compresses data into a complete gzip member.
+
+  Args:
+    data: The bytes to compress.
+    level: The zlib compression level.
+
+  Returns:
+    The gzip member holding data.
+  """
+  # wbits 16 + 15 makes zlib write the gzip header and trailer.
+  compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+  return compressor.compress(data) + compressor.flush()
+
+
+class ParallelGzipWriter(object):
+  """File-like object gzipping what is written to it with several threads."""
+
+  def __init__(self, dest_file, threads, block_size=DEFAULT_BLOCK_SIZE,
+               level=DEFAULT_LEVEL):
+    """Initializes ParallelGzipWriter object.
+
+    Args:
+      dest_file: A file object the compressed data is written to.
+      threads: The number of compression threads.
+      block_size: The size of the blocks compressed independently.
+      level: The zlib compression level.
+    """
+    self._dest_file = dest_file
+    self._block_size = block_size
+    self._level = level
+    self._pool = ThreadPool(threads)
+    # Blocks being compressed, oldest first. At most two blocks per thread
+    # are in flight to bound the memory used.
+    self._pending = collections.deque()
+    self._max_pending = 2 * threads
+    self._buffer = []
+    self._buffered = 0
+    self._submitted = 0
+
+  def write(self, data):
+    self._buffer.append(data)
+    self._buffered += len(data)
+    if self._buffered >= self._block_size:
+      data = ''.join(self._buffer)
+      for start in xrange(0, len(data) - self._block_size + 1,
+                          self._block_size):
+        self._Submit(data[start:start + self._block_size])
+      remainder = data[start + self._block_size:]
+      self._buffer = [remainder]
+      self._buffered = len(remainder)
+
+  def _Submit(self, block):
+    while len(self._pending) >= self._max_pending:
+      self._dest_file.write(self._pending.popleft().get())
+    self._pending.append(
+        self._pool.apply_async(CompressBlock, (block, self._level)))
+    self._submitted += 1
+
+  def close(self):
+    """Compresses the buffered data and waits for all blocks to be written.
+
+    Does not close dest_file.
+    """
+    if self._buffered or not self._submitted:
+      # An empty input still produces one (empty) gzip member.
+      self._Submit(''.join(self._buffer))
+      self._buffer = []
+      self._buffered = 0
+    while self._pending:
+      self._dest_file.write(self._pending.popleft().get())
+    self._pool.close()
+    self._pool.join()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, unused_exc_value, unused_exc_tb):
+    if exc_type is None:
+      self.close()
+    else:
+      self._pool.terminate()
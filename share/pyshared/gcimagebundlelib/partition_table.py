@@ -0,0 +1,366 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Reads and writes MBR (msdos) and GPT partition tables.
+
+Works on disk image files and on disk devices alike, without parted, so
+that bundling needs no subprocess to lay out disk.raw and the code can be
+tested on plain files. Sectors are assumed to be 512 bytes.
+
+Partitions are numbered like parted and the kernel do: MBR primary
+partitions are 1-4 by slot and logical partitions 5 and up, GPT partitions
+are numbered by their entry index.
+"""
+
+
+
+import binascii
+import os
+import struct
+import uuid
+
+SECTOR_SIZE = 512
+
+MSDOS = 'msdos'
+GPT = 'gpt'
+
+# MBR partition types.
+LINUX_PARTITION_TYPE = 0x83
+GPT_PROTECTIVE_PARTITION_TYPE = 0xee
+EXTENDED_PARTITION_TYPES = (0x05, 0x0f, 0x85)
+
+LINUX_FILESYSTEM_GUID = '0fc63daf-8483-4772-8e79-3d69d8477de4'
+
+_MBR_ENTRIES_OFFSET = 446
+_MBR_DISK_SIGNATURE_OFFSET = 440
+_MBR_BOOT_SIGNATURE = '\x55\xaa'
+_MBR_ENTRY = struct.Struct('<B3sB3sII')
+
+_GPT_SIGNATURE = 'EFI PART'
+_GPT_REVISION = 0x00010000
+_GPT_HEADER = struct.Struct('<8sIIIIQQQQ16sQIII')
+_GPT_ENTRY = struct.Struct('<16s16sQQQ72s')
+_GPT_ENTRY_COUNT = 128
+# Sectors taken by the partition entries array.
+_GPT_ENTRIES_SECTORS = _GPT_ENTRY_COUNT * _GPT_ENTRY.size // SECTOR_SIZE
+
+
+class PartitionTableError(Exception):
+  """Error occurred reading or writing a partition table."""
+
+
+class Partition(object):
+  """A partition of a disk.
+
+  Attributes:
+    number: The partition number, 1 based.
+    start: The offset of the partition in bytes.
+    size: The size of the partition in bytes.
+    type_id: The MBR partition type (an int) or the GPT partition type GUID
+      (a string).
+  """
+
+  def __init__(self, number, start, size, type_id):
+    self.number = number
+    self.start = start
+    self.size = size
+    self.type_id = type_id
+
+  @property
+  def end(self):
+    """The offset of the first byte after the partition."""
+    return self.start + self.size
+
+  def __repr__(self):
+    return 'Partition(%d, start=%d, size=%d, type=%r)' % (
+        self.number, self.start, self.size, self.type_id)
+
+
+def _Chs(lba):
+  """Encodes a sector address in the legacy CHS format of MBR entries."""
+  cylinder, rest = divmod(lba, 255 * 63)
+  head, sector = divmod(rest, 63)
+  if cylinder > 1023:
+    cylinder, head, sector = 1023, 254, 62
+  return struct.pack('<BBB', head, (sector + 1) | ((cylinder >> 2) & 0xc0),
+                     cylinder & 0xff)
+
+
+def _Crc32(data):
+  return binascii.crc32(data) & 0xffffffff
+
+
+class PartitionTable(object):
+  """The partition table of a disk image or device.
+
+  Changes are made in memory and saved with Write().
+  """
+
+  def __init__(self, path):
+    """Reads the partition table of a disk.
+
+    Args:
+      path: The path to a disk image or disk device.
+
+    Raises:
+      PartitionTableError: If the disk has no partition table.
+    """
+    self._path = path
+    with open(path, 'rb') as disk:
+      disk.seek(0, os.SEEK_END)
+      self.disk_size = disk.tell()
+      disk.seek(0)
+      mbr = disk.read(SECTOR_SIZE)
+      if len(mbr) < SECTOR_SIZE or mbr[510:512] != _MBR_BOOT_SIGNATURE:
+        raise PartitionTableError('%s has no partition table' % path)
+      self._mbr = mbr
+      entries = self._MbrEntries(mbr)
+      if any(entry[2] == GPT_PROTECTIVE_PARTITION_TYPE for entry in entries):
+        self.label = GPT
+        self._ReadGpt(disk)
+      else:
+        self.label = MSDOS
+        self._ReadMbr(disk, entries)
+
+  @staticmethod
+  def _MbrEntries(sector):
+    entries = []
+    for i in range(4):
+      offset = _MBR_ENTRIES_OFFSET + i * _MBR_ENTRY.size
+      entries.append(_MBR_ENTRY.unpack(sector[offset:offset + _MBR_ENTRY.size]))
+    return entries
+
+  def _ReadMbr(self, disk, entries):
+    self._partitions = []
+    for i, (_, _, type_id, _, first_lba, sectors) in enumerate(entries):
+      if type_id and sectors:
+        self._partitions.append(Partition(i + 1, first_lba * SECTOR_SIZE,
+                                          sectors * SECTOR_SIZE, type_id))
+    # Logical partitions are chained through extended boot records in the
+    # extended partition.
+    extended = [p for p in self._partitions
+                if p.type_id in EXTENDED_PARTITION_TYPES]
+    if extended:
+      extended_lba = extended[0].start // SECTOR_SIZE
+      ebr_lba = extended_lba
+      number = 5
+      while number < 5 + 128:
+        disk.seek(ebr_lba * SECTOR_SIZE)
+        ebr = disk.read(SECTOR_SIZE)
+        if len(ebr) < SECTOR_SIZE or ebr[510:512] != _MBR_BOOT_SIGNATURE:
+          break
+        logical, next_ebr = self._MbrEntries(ebr)[:2]
+        if logical[2] and logical[5]:
+          self._partitions.append(Partition(
+              number, (ebr_lba + logical[4]) * SECTOR_SIZE,
+              logical[5] * SECTOR_SIZE, logical[2]))
+          number += 1
+        if not next_ebr[2] or not next_ebr[5]:
+          break
+        ebr_lba = extended_lba + next_ebr[4]
+
+  def _ReadGpt(self, disk):
+    disk.seek(SECTOR_SIZE)
+    header = _GPT_HEADER.unpack(disk.read(_GPT_HEADER.size))
+    (signature, _, header_size, _, _, _, _, self._first_usable_lba, _,
+     self._disk_guid, entries_lba, entry_count, entry_size, _) = header
+    if signature != _GPT_SIGNATURE:
+      raise PartitionTableError('%s has a protective MBR but no GPT header'
+                                % self._path)
+    if entry_size != _GPT_ENTRY.size or header_size != _GPT_HEADER.size:
+      raise PartitionTableError('%s: unsupported GPT layout' % self._path)
+    disk.seek(entries_lba * SECTOR_SIZE)
+    data = disk.read(entry_count * entry_size)
+    self._gpt_entries = []
+    self._partitions = []
+    for i in range(min(entry_count, _GPT_ENTRY_COUNT)):
+      entry = _GPT_ENTRY.unpack(data[i * entry_size:(i + 1) * entry_size])
+      self._gpt_entries.append(entry)
+      if entry[0] != '\0' * 16:
+        self._partitions.append(Partition(
+            i + 1, entry[2] * SECTOR_SIZE,
+            (entry[3] - entry[2] + 1) * SECTOR_SIZE,
+            str(uuid.UUID(bytes_le=entry[0]))))
+    empty = ('\0' * 16, '\0' * 16, 0, 0, 0, '\0' * 72)
+    self._gpt_entries += [empty] * (_GPT_ENTRY_COUNT - len(self._gpt_entries))
+
+  def Partitions(self):
+    """Returns the list of partitions, ordered by number."""
+    return list(self._partitions)
+
+  def GetPartition(self, number):
+    """Returns the partition with the given number.
+
+    Raises:
+      IndexError: If there is no such partition.
+    """
+    for partition in self._partitions:
+      if partition.number == number:
+        return partition
+    raise IndexError('%s has no partition %d' % (self._path, number))
+
+  def RemovePartition(self, number):
+    """Removes a partition.
+
+    Raises:
+      IndexError: If there is no such partition.
+      PartitionTableError: For a logical MBR partition, which is not supported.
+    """
+    partition = self.GetPartition(number)
+    if self.label == MSDOS and number > 4:
+      raise PartitionTableError('removing logical partitions is not supported')
+    self._partitions.remove(partition)
+    if self.label == GPT:
+      self._gpt_entries[number - 1] = ('\0' * 16, '\0' * 16, 0, 0, 0,
+                                       '\0' * 72)
+
+  def AddPartition(self, start, end, name=''):
+    """Adds a Linux partition in the first free slot.
+
+    Args:
+      start: Start offset of the partition in bytes.
+      end: Offset of the last byte of the partition (as in parted).
+      name: The GPT partition name.
+
+    Returns:
+      The new Partition.
+
+    Raises:
+      PartitionTableError: If the partition does not fit on the disk,
+        overlaps another one or there is no free slot.
+    """
+    first_lba = start // SECTOR_SIZE
+    last_lba = end // SECTOR_SIZE
+    if self.label == GPT:
+      lowest, highest = self._first_usable_lba, self._LastUsableLba()
+    else:
+      lowest, highest = 1, self.disk_size // SECTOR_SIZE - 1
+    if first_lba < lowest or last_lba > highest or last_lba < first_lba:
+      raise PartitionTableError('partition %d-%d does not fit on %s'
+                                % (start, end, self._path))
+    for other in self._partitions:
+      if (first_lba * SECTOR_SIZE < other.end and
+          other.start <= last_lba * SECTOR_SIZE):
+        raise PartitionTableError('partition %d-%d overlaps %r'
+                                  % (start, end, other))
+    slots = 4 if self.label == MSDOS else _GPT_ENTRY_COUNT
+    used = set(p.number for p in self._partitions)
+    free = [n for n in range(1, slots + 1) if n not in used]
+    if not free:
+      raise PartitionTableError('no free partition slot on %s' % self._path)
+    number = free[0]
+    if self.label == GPT:
+      type_id = LINUX_FILESYSTEM_GUID
+      self._gpt_entries[number - 1] = (
+          uuid.UUID(type_id).bytes_le, uuid.uuid4().bytes_le, first_lba,
+          last_lba, 0, name.encode('utf-16-le').ljust(72, '\0')[:72])
+    else:
+      type_id = LINUX_PARTITION_TYPE
+    partition = Partition(number, first_lba * SECTOR_SIZE,
+                          (last_lba - first_lba + 1) * SECTOR_SIZE, type_id)
+    self._partitions.append(partition)
+    self._partitions.sort(key=lambda p: p.number)
+    return partition
+
+  def _LastUsableLba(self):
+    return self.disk_size // SECTOR_SIZE - 2 - _GPT_ENTRIES_SECTORS
+
+  def Write(self):
+    """Writes the partition table back to the disk."""
+    with open(self._path, 'r+b') as disk:
+      if self.label == GPT:
+        self._WriteGpt(disk)
+      else:
+        self._WriteMbr(disk)
+
+  def _MbrSector(self, entries):
+    """Returns the MBR with the given (first LBA, sectors, type) entries."""
+    table = ''
+    for entry in (list(entries) + [None] * 4)[:4]:
+      if entry:
+        first_lba, sectors, type_id = entry
+        table += _MBR_ENTRY.pack(0, _Chs(first_lba), type_id,
+                                 _Chs(first_lba + sectors - 1), first_lba,
+                                 sectors)
+      else:
+        table += '\0' * _MBR_ENTRY.size
+    return self._mbr[:_MBR_ENTRIES_OFFSET] + table + _MBR_BOOT_SIGNATURE
+
+  def _WriteMbr(self, disk):
+    # Boot code and the disk signature are kept; logical partitions live in
+    # the extended partition and are not rewritten.
+    entries = [None] * 4
+    for p in self._partitions:
+      if p.number <= 4:
+        entries[p.number - 1] = (p.start // SECTOR_SIZE,
+                                 p.size // SECTOR_SIZE, p.type_id)
+    disk.seek(0)
+    disk.write(self._MbrSector(entries))
+
+  def _WriteGpt(self, disk):
+    total_lba = self.disk_size // SECTOR_SIZE
+    last_lba = total_lba - 1
+    entries = ''.join(_GPT_ENTRY.pack(*entry) for entry in self._gpt_entries)
+    entries_crc = _Crc32(entries)
+    backup_entries_lba = last_lba - _GPT_ENTRIES_SECTORS
+    for current, backup, entries_lba in ((1, last_lba, 2),
+                                         (last_lba, 1, backup_entries_lba)):
+      fields = [_GPT_SIGNATURE, _GPT_REVISION, _GPT_HEADER.size, 0, 0,
+                current, backup, self._first_usable_lba,
+                self._LastUsableLba(), self._disk_guid, entries_lba,
+                _GPT_ENTRY_COUNT, _GPT_ENTRY.size, entries_crc]
+      fields[3] = _Crc32(_GPT_HEADER.pack(*fields))
+      disk.seek(entries_lba * SECTOR_SIZE)
+      disk.write(entries)
+      disk.seek(current * SECTOR_SIZE)
+      disk.write(_GPT_HEADER.pack(*fields).ljust(SECTOR_SIZE, '\0'))
+    # Protective MBR covering the whole disk.
+    disk.seek(0)
+    disk.write(self._MbrSector([(1, min(last_lba, 0xffffffff),
+                                 GPT_PROTECTIVE_PARTITION_TYPE)]))
+
+
+def MakePartitionTable(path, label=MSDOS):
+  """Writes an empty partition table to a disk.
+
+  Args:
+    path: The path to a disk image or disk device.
+    label: MSDOS or GPT.
+  """
+  with open(path, 'r+b') as disk:
+    disk.seek(0, os.SEEK_END)
+    disk_size = disk.tell()
+    if disk_size < 64 * SECTOR_SIZE:
+      raise PartitionTableError('%s is too small for a partition table' % path)
+    # Clear any previous GPT header so the new table is not mistaken for it.
+    disk.seek(0)
+    disk.write('\0' * (34 * SECTOR_SIZE))
+    signature = struct.pack('<I', uuid.uuid4().int & 0xffffffff)
+    disk.seek(_MBR_DISK_SIGNATURE_OFFSET)
+    disk.write(signature + '\0' * 2 + '\0' * 64 + _MBR_BOOT_SIGNATURE)
+    if label == GPT:
+      disk.seek(_MBR_ENTRIES_OFFSET)
+      disk.write(_MBR_ENTRY.pack(0, _Chs(1), GPT_PROTECTIVE_PARTITION_TYPE,
+                                 _Chs(1), 1, 1))
+      disk.seek(SECTOR_SIZE)
+      disk.write(_GPT_HEADER.pack(
+          _GPT_SIGNATURE, _GPT_REVISION, _GPT_HEADER.size, 0, 0, 1,
+          disk_size // SECTOR_SIZE - 1, 2 + _GPT_ENTRIES_SECTORS, 0,
+          uuid.uuid4().bytes_le, 2, _GPT_ENTRY_COUNT, _GPT_ENTRY.size, 0))
+    elif label != MSDOS:
+      raise PartitionTableError('unknown partition table type %s' % label)
+  if label == GPT:
+    # Fill in the checksums, the backup table and the protective MBR.
+    PartitionTable(path).Write()
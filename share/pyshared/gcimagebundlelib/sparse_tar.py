@@ -0,0 +1,214 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Sparse-aware tar writer.
+
+Writes archives in the old GNU tar format (what 'tar --format=oldgnu -S'
+produces). Files are stored as GNU sparse entries: the data extents of a
+file are found with lseek(SEEK_DATA)/lseek(SEEK_HOLE) and only those are
+read and written, so archiving a mostly empty disk.raw costs time in
+proportion to the data it holds rather than to its size.
+"""
+
+
+
+import errno
+import logging
+import os
+import stat
+
+BLOCK_SIZE = 512
+# GNU tar pads archives to a multiple of 20 blocks.
+RECORD_SIZE = 20 * BLOCK_SIZE
+
+# Not defined by the os module of Python 2.
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+
+# Sparse map entries in the main header and in each extension header.
+_HEADER_SPARSE_ENTRIES = 4
+_EXTENSION_SPARSE_ENTRIES = 21
+
+_READ_SIZE = 1024 * 1024
+
+
+class SparseTarError(Exception):
+  """Error occurred while writing a sparse tar archive."""
+
+
+def DataExtents(fd, size):
+  """Finds the data extents of a file.
+
+  Args:
+    fd: A file descriptor open for reading.
+    size: The size of the file.
+
+  Returns:
+    A list of (offset, length) tuples covering all the data in the file, in
+    order. If the file system cannot report holes the whole file is one
+    extent.
+  """
+  extents = []
+  offset = 0
+  while offset < size:
+    try:
+      data = os.lseek(fd, offset, SEEK_DATA)
+    except OSError as e:
+      if e.errno == errno.ENXIO:
+        # No data after offset.
+        break
+      if e.errno == errno.EINVAL and not extents:
+        logging.warning('File system does not support SEEK_DATA, archiving '
+                        'the whole file.')
+        return [(0, size)]
+      raise
+    hole = min(os.lseek(fd, data, SEEK_HOLE), size)
+    extents.append((data, hole - data))
+    offset = hole
+  return extents
+
+
+def _Number(value, length):
+  """Formats a header number field, NUL terminated octal or base-256."""
+  if value < 8 ** (length - 1):
+    return '%0*o\0' % (length - 1, value)
+  # GNU extension for values that do not fit in octal.
+  digits = []
+  for _ in xrange(length - 1):
+    digits.append(chr(value & 0xff))
+    value >>= 8
+  if value:
+    raise SparseTarError('number too large for a tar header')
+  return '\x80' + ''.join(reversed(digits))
+
+
+def _SparseMap(entries, count):
+  fields = ''.join(_Number(offset, 12) + _Number(length, 12)
+                   for offset, length in entries)
+  return fields.ljust(count * 24, '\0')
+
+
+class SparseTarWriter(object):
+  """Writes a tar archive to a file object, storing files as sparse files."""
+
+  def __init__(self, dest_file):
+    """Initializes SparseTarWriter object.
+
+    Args:
+      dest_file: A file object the archive is written to. Compression, if any,
+        is up to that object.
+    """
+    self._dest_file = dest_file
+    self._offset = 0
+
+  def _Write(self, data):
+    self._dest_file.write(data)
+    self._offset += len(data)
+
+  def _Pad(self, alignment):
+    remainder = self._offset % alignment
+    if remainder:
+      self._Write('\0' * (alignment - remainder))
+
+  def _Header(self, name, file_stat, type_flag, size, sparse_map='',
+              is_extended=False, real_size=0):
+    if len(name) > 99:
+      raise SparseTarError('file name too long for the archive: %s' % name)
+    header = (name.ljust(100, '\0') +
+              _Number(stat.S_IMODE(file_stat.st_mode), 8) +
+              _Number(file_stat.st_uid, 8) +
+              _Number(file_stat.st_gid, 8) +
+              _Number(size, 12) +
+              _Number(int(file_stat.st_mtime), 12) +
+              ' ' * 8 +
+              type_flag +
+              '\0' * 100 +
+              'ustar  \0' +
+              '\0' * 32 +
+              '\0' * 32 +
+              '\0' * 16 +
+              '\0' * 12 +
+              '\0' * 12 +
+              '\0' * 12 +
+              '\0' * 4 +
+              '\0' +
+              _SparseMap(sparse_map, _HEADER_SPARSE_ENTRIES) +
+              ('\1' if is_extended else '\0') +
+              (_Number(real_size, 12) if real_size else '\0' * 12))
+    header = header.ljust(BLOCK_SIZE, '\0')
+    checksum = sum(ord(c) for c in header)
+    return header[:148] + '%06o\0 ' % checksum + header[156:]
+
+  def _WriteSparseHeaders(self, arcname, file_stat, size, stored, extents):
+    sparse_map = list(extents)
+    # A file ending in a hole is terminated by an empty extent at its end.
+    if not sparse_map or sum(sparse_map[-1]) < size:
+      sparse_map.append((size, 0))
+    head = sparse_map[:_HEADER_SPARSE_ENTRIES]
+    rest = sparse_map[_HEADER_SPARSE_ENTRIES:]
+    self._Write(self._Header(arcname, file_stat, 'S', stored, head,
+                             is_extended=bool(rest), real_size=size))
+    while rest:
+      entries = rest[:_EXTENSION_SPARSE_ENTRIES]
+      rest = rest[_EXTENSION_SPARSE_ENTRIES:]
+      self._Write(_SparseMap(entries, _EXTENSION_SPARSE_ENTRIES) +
+                  ('\1' if rest else '\0') + '\0' * 7)
+
+  def AddFile(self, path, arcname=None):
+    """Adds a regular file to the archive as a sparse file.
+
+    Args:
+      path: The path of the file.
+      arcname: The name of the file in the archive; the base name of path by
+        default.
+
+    Returns:
+      The number of data bytes stored for the file.
+
+    Raises:
+      SparseTarError: If the file changes size while it is archived.
+    """
+    if arcname is None:
+      arcname = os.path.basename(path)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+      file_stat = os.fstat(fd)
+      size = file_stat.st_size
+      extents = DataExtents(fd, size)
+      stored = sum(length for _, length in extents)
+      if not size or extents == [(0, size)]:
+        # No holes, store a regular file.
+        self._Write(self._Header(arcname, file_stat, '0', size))
+      else:
+        self._WriteSparseHeaders(arcname, file_stat, size, stored, extents)
+      for offset, length in extents:
+        os.lseek(fd, offset, os.SEEK_SET)
+        while length:
+          data = os.read(fd, min(length, _READ_SIZE))
+          if not data:
+            raise SparseTarError('%s shrank while being archived' % path)
+          self._Write(data)
+          length -= len(data)
+      self._Pad(BLOCK_SIZE)
+    finally:
+      os.close(fd)
+    logging.debug('Archived %s: %d of %d bytes are data in %d extents',
+                  path, stored, size, len(extents))
+    return stored
+
+  def Close(self):
+    """Writes the end of archive marker. Does not close dest_file."""
+    self._Write('\0' * (2 * BLOCK_SIZE))
+    self._Pad(RECORD_SIZE)
@@ -0,0 +1,96 @@
+#!/usr/bin/python
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unittest for benchmark.py module."""
+
+__pychecker__ = 'no-local'  # for unittest
+
+from distutils import spawn
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+import zlib
+
+from gcimagebundlelib import benchmark
+
+
+class BenchmarkTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def testHardLinkFarm(self):
+    benchmark.MakeHardLinkFarm(self.tmp_dir, scale=0.01)
+    first_path = os.path.join(self.tmp_dir, 'links0', 'file00000')
+    self.assertEqual(10, os.stat(first_path).st_nlink)
+    self.assertEqual(10, len(os.listdir(os.path.join(self.tmp_dir,
+                                                     'links9'))))
+
+  def testContent(self):
+    content = benchmark.Content(seed=1)
+    data = content.Get(3 * 1024 * 1024)
+    self.assertEqual(3 * 1024 * 1024, len(data))
+    # Compressible, but not as much as repeated data.
+    ratio = len(zlib.compress(data)) / float(len(data))
+    self.assertTrue(0.2 < ratio < 0.7, ratio)
+    # The contents only depend on the seed.
+    self.assertEqual(data, benchmark.Content(seed=1).Get(3 * 1024 * 1024))
+
+  def testSparseFiles(self):
+    benchmark.MakeSparseFiles(self.tmp_dir, scale=1.0 / 8)
+    file_stat = os.stat(os.path.join(self.tmp_dir, 'dir0', 'sparse0.img'))
+    self.assertEqual(128 * 1024 * 1024, file_stat.st_size)
+    self.assertTrue(file_stat.st_blocks * 512 < file_stat.st_size)
+
+  def testRun(self):
+    reports = benchmark.Run([name for name, _ in benchmark.TREES],
+                            self.tmp_dir, scale=0.01)
+    self.assertEqual(sorted(name for name, _ in benchmark.TREES),
+                     sorted(reports))
+    # The rsync stage is skipped where rsync is not installed.
+    has_rsync = bool(spawn.find_executable('rsync'))
+    for report in reports.itervalues():
+      stages = dict((stage.name, stage) for stage in report.stages)
+      self.assertEqual(['exclude', 'copy'] + ['rsync'] * has_rsync +
+                       ['archive', 'hash'],
+                       [stage.name for stage in report.stages])
+      self.assertTrue(stages['exclude'].files > 0)
+      # Excluded directories are not copied.
+      self.assertTrue(stages['copy'].files < stages['exclude'].files)
+      if has_rsync:
+        self.assertEqual(stages['copy'].files, stages['rsync'].files)
+      self.assertEqual(stages['archive'].bytes, stages['hash'].bytes)
+    small_files = dict((stage.name, stage)
+                       for stage in reports['small_files'].stages)
+    # 200 files in 100 directories, the first of every ten excluded.
+    self.assertEqual(300, small_files['exclude'].files)
+    self.assertEqual(180, small_files['copy'].files)
+    self.assertTrue('small_files' in benchmark.FormatReports(reports))
+    # The trees are removed.
+    self.assertEqual([], os.listdir(self.tmp_dir))
+
+
+def main():
+  logging.basicConfig(level=logging.DEBUG)
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
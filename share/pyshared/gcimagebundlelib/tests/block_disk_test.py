@@ -30,8 +30,12 @@ import unittest
 import urllib2
 
 from gcimagebundlelib import block_disk
+from gcimagebundlelib import block_store
+from gcimagebundlelib import compression
 from gcimagebundlelib import exclude_spec
 from gcimagebundlelib.tests import image_bundle_test_base
+from gcimagebundlelib import timing
+from gcimagebundlelib import uploader
 from gcimagebundlelib import utils
 
 
@@ -168,6 +172,118 @@ class FsRawDiskTest(image_bundle_test_base.ImageBundleTest):
     self._VerifyNumberOfHardLinksInRawDisk(self._tar_path, 'test1', 2)
     self._VerifyNumberOfHardLinksInRawDisk(self._tar_path, 'test2', 2)
 
+  def testRawDiskWithStagingTree(self):
+    """Tests making the file system from a staging tree with mke2fs."""
+    self._bundle.AddSource(self.tmp_path)
+    self._bundle.UseStagingTree()
+    self._bundle.Verify()
+    (_, digest) = self._bundle.Bundleup()
+    if not digest:
+      self.fail('raw disk failed')
+    self._VerifyTarHas(self._tar_path, ['disk.raw'])
+    self._VerifyImageHas(self._tar_path,
+                         ['lost+found', 'test1', 'test2', 'dir1/',
+                          '/dir1/dir11/', '/dir1/sl1', '/dir1/hl2', 'dir2/',
+                          '/dir2/dir1', '/dir2/sl2', '/dir2/hl1'])
+    self._VerifyNumberOfHardLinksInRawDisk(self._tar_path, 'test1', 2)
+
+  def testRawDiskWithBuiltinCopy(self):
+    """Tests copying the files with tree_copy instead of rsync."""
+    self._bundle.AddSource(self.tmp_path)
+    self._bundle.AppendExcludes(
+        [exclude_spec.ExcludeSpec(self.tmp_path + '/dir1',
+                                  preserve_dir=True, preserve_subdir=True)])
+    self._bundle.UseBuiltinCopy()
+    self._bundle.Verify()
+    (_, digest) = self._bundle.Bundleup()
+    if not digest:
+      self.fail('raw disk failed')
+    self._VerifyImageHas(self._tar_path,
+                         ['lost+found', 'test1', 'test2', 'dir1/',
+                          '/dir1/dir11', 'dir2/', '/dir2/dir1',
+                          '/dir2/sl2', '/dir2/hl1'])
+    self._VerifyNumberOfHardLinksInRawDisk(self._tar_path, 'test1', 2)
+
+  def testRawDiskIncremental(self):
+    """Tests updating the image of a previous run."""
+    incremental_dir = tempfile.mkdtemp(dir=self.tmp_root)
+    self._bundle.AddSource(self.tmp_path)
+    self._bundle.SetIncrementalDirectory(incremental_dir)
+    self._bundle.Verify()
+    (_, digest) = self._bundle.Bundleup()
+    if not digest:
+      self.fail('raw disk failed')
+    self.assertTrue(os.path.exists(os.path.join(incremental_dir, 'disk.raw')))
+    self.assertTrue(os.path.exists(os.path.join(incremental_dir,
+                                                'files.json')))
+    os.remove(self.tmp_path + '/dir2/sl2')
+    with open(self.tmp_path + '/test3', 'w') as f:
+      f.write('test3')
+    bundle = block_disk.FsRawDisk(self._fs_size, 'ext4')
+    bundle.SetTarfile(self._tar_path)
+    bundle.AppendExcludes([exclude_spec.ExcludeSpec(self._tar_path)])
+    bundle.SetKey('key')
+    bundle._SetManifest(self._manifest)
+    bundle.AddSource(self.tmp_path)
+    bundle.SetIncrementalDirectory(incremental_dir)
+    bundle.Verify()
+    (_, digest) = bundle.Bundleup()
+    if not digest:
+      self.fail('raw disk failed')
+    self._VerifyImageHas(self._tar_path,
+                         ['lost+found', 'test1', 'test2', 'test3', 'dir1/',
+                          '/dir1/dir11/', '/dir1/sl1', '/dir1/hl2', 'dir2/',
+                          '/dir2/dir1', '/dir2/hl1'])
+    self._VerifyFileInRawDiskEndsWith(self._tar_path, 'test3', 'test3')
+
+  def testRawDiskWithBlockStore(self):
+    """Tests storing the image in a block store instead of a tar."""
+    store_dir = tempfile.mkdtemp(dir=self.tmp_root)
+    self._bundle.AddSource(self.tmp_path)
+    self._bundle.SetBlockStore(store_dir)
+    self._bundle.Verify()
+    (_, digest) = self._bundle.Bundleup()
+    if not digest:
+      self.fail('raw disk failed')
+    restore_dir = tempfile.mkdtemp(dir=self.tmp_root)
+    restored = block_store.BlockStore(store_dir).Restore(self._tar_path,
+                                                          restore_dir)
+    self.assertEqual([os.path.join(restore_dir, 'disk.raw')], restored)
+    self.assertEqual(self._fs_size, os.path.getsize(restored[0]))
+
+  def testRawDiskWithUploader(self):
+    """Tests streaming the archive to an uploader."""
+    upload_dir = tempfile.mkdtemp(dir=self.tmp_root)
+    self._bundle.AddSource(self.tmp_path)
+    self._bundle.SetUploader(uploader.DirectoryUploader(upload_dir))
+    self._bundle.Verify()
+    (_, digest) = self._bundle.Bundleup()
+    if not digest:
+      self.fail('raw disk failed')
+    self.assertFalse(os.path.exists(self._tar_path))
+    self._VerifyImageHas(os.path.join(upload_dir, 'image.tar.gz'),
+                         ['lost+found', 'test1', 'test2', 'dir1/',
+                          '/dir1/dir11/', '/dir1/sl1', '/dir1/hl2', 'dir2/',
+                          '/dir2/dir1', '/dir2/sl2', '/dir2/hl1'])
+
+  def testRawDiskWithCompressionBenchmark(self):
+    """Tests benchmarking codecs before the archive is written."""
+    self._bundle.AddSource(self.tmp_path)
+    self._bundle.SetCompressionBenchmark(
+        [compression.ParseCodec('gzip:1'), compression.ParseCodec('none')])
+    self._bundle.Verify()
+    (_, digest) = self._bundle.Bundleup()
+    if not digest:
+      self.fail('raw disk failed')
+    stages = [stage.name for stage in timing.GetReport().stages]
+    for stage in ('compress gzip:1', 'decompress gzip:1', 'compress none',
+                  'decompress none'):
+      self.assertTrue(stage in stages)
+    self._VerifyImageHas(self._tar_path,
+                         ['lost+found', 'test1', 'test2', 'dir1/',
+                          '/dir1/dir11/', '/dir1/sl1', '/dir1/hl2', 'dir2/',
+                          '/dir2/dir1', '/dir2/sl2', '/dir2/hl1'])
+
   def testRawDiskIgnoresHardlinks(self):
     """Tests if the raw disk ignores hard links if asked."""
     self._bundle.AddSource(self.tmp_path)
@@ -500,6 +616,20 @@ class RootFsRawTest(image_bundle_test_base.ImageBundleTest):
       return
     self.fail()
 
+  def testMeasuredFilesExceedDiskSize(self):
+    """Tests the disk space check with the measured size of the files."""
+    self._statvfs_map = {
+      "/tmp" : image_bundle_test_base.StatvfsResult(1024, 10000000, 9000000)
+      }
+    self._bundle.AddSource(self.tmp_path)
+    self._bundle.SetKey('key')
+    self._bundle.SetScratchDirectory('/tmp')
+    suggested_fs_size = self._bundle.MeasureDiskUsage()
+    # The 10MB disk cannot even hold the journal.
+    self.assertRaises(block_disk.InvalidRawDiskError, self._bundle.Verify)
+    self._bundle.SetFsSize(suggested_fs_size)
+    self._bundle.Verify()
+
   def _MockStatvfs(self, file_path):
       return self._statvfs_map[file_path] 
 
@@ -0,0 +1,108 @@
+#!/usr/bin/python
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unittest for block_store.py module."""
+
+__pychecker__ = 'no-local'  # for unittest
+
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from gcimagebundlelib import block_store
+
+
+class BlockStoreTest(unittest.TestCase):
+
+  _BLOCK_SIZE = 64 * 1024
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.store_dir = os.path.join(self.tmp_dir, 'store')
+    self.restore_dir = os.path.join(self.tmp_dir, 'restore')
+    self.index_path = os.path.join(self.tmp_dir, 'image.index.json')
+    os.mkdir(self.store_dir)
+    os.mkdir(self.restore_dir)
+    self.disk_path = os.path.join(self.tmp_dir, 'disk.raw')
+    with open(self.disk_path, 'wb') as f:
+      f.truncate(20 * self._BLOCK_SIZE + 100)
+      f.write(os.urandom(3 * self._BLOCK_SIZE))
+      f.seek(10 * self._BLOCK_SIZE)
+      f.write('\0' * self._BLOCK_SIZE)
+      f.seek(20 * self._BLOCK_SIZE)
+      f.write('end')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def _Store(self):
+    return block_store.BlockStore(self.store_dir, self._BLOCK_SIZE)
+
+  def _Read(self, path):
+    with open(path, 'rb') as f:
+      return f.read()
+
+  def testWriteAndRestore(self):
+    store = self._Store()
+    digest = hashlib.sha1()
+    store.WriteIndex([self.disk_path], self.index_path, digest)
+    self.assertEqual(hashlib.sha1(self._Read(self.index_path)).hexdigest(),
+                     digest.hexdigest())
+    # Three random blocks and the last one, holes and zeros are not stored.
+    self.assertEqual(4, store.blocks_written)
+    restored = self._Store().Restore(self.index_path, self.restore_dir)
+    self.assertEqual([os.path.join(self.restore_dir, 'disk.raw')], restored)
+    self.assertEqual(self._Read(self.disk_path), self._Read(restored[0]))
+    self.assertTrue(os.stat(restored[0]).st_blocks * 512 <
+                    10 * self._BLOCK_SIZE)
+
+  def testOnlyChangedBlocksAreWritten(self):
+    self._Store().WriteIndex([self.disk_path], self.index_path)
+    with open(self.disk_path, 'r+b') as f:
+      f.seek(self._BLOCK_SIZE + 10)
+      f.write('changed')
+    store = self._Store()
+    store.WriteIndex([self.disk_path], self.index_path)
+    self.assertEqual(1, store.blocks_written)
+    self.assertEqual(3, store.blocks_reused)
+    restored = store.Restore(self.index_path, self.restore_dir)
+    self.assertEqual(self._Read(self.disk_path), self._Read(restored[0]))
+
+  def testCorruptBlock(self):
+    self._Store().WriteIndex([self.disk_path], self.index_path)
+    for root, _, files in os.walk(self.store_dir):
+      for name in files:
+        with open(os.path.join(root, name), 'wb') as f:
+          f.write('corrupt')
+    self.assertRaises(block_store.BlockStoreError, self._Store().Restore,
+                      self.index_path, self.restore_dir)
+
+  def testInvalidIndex(self):
+    with open(self.index_path, 'w') as f:
+      f.write('{"version": 0}')
+    self.assertRaises(block_store.BlockStoreError, self._Store().Restore,
+                      self.index_path, self.restore_dir)
+
+
+def main():
+  logging.basicConfig(level=logging.DEBUG)
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,101 @@
+#!/usr/bin/python
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unittest for compression.py module."""
+
+__pychecker__ = 'no-local'  # for unittest
+
+import logging
+import os
+import shutil
+import StringIO
+import tempfile
+import unittest
+
+from gcimagebundlelib import compression
+
+
+class CompressionTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    # Half random, half zeros, so that every codec but none compresses it.
+    self.data = os.urandom(512 * 1024) + '\0' * 512 * 1024
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def _RoundTrip(self, codec, threads):
+    compressed = StringIO.StringIO()
+    compressing_file = codec.Open(compressed, threads)
+    for offset in xrange(0, len(self.data), 100000):
+      compressing_file.write(self.data[offset:offset + 100000])
+    compressing_file.close()
+    decompressed = StringIO.StringIO()
+    codec.Decompress(StringIO.StringIO(compressed.getvalue()), decompressed,
+                     threads)
+    self.assertEqual(self.data, decompressed.getvalue())
+    return len(compressed.getvalue())
+
+  def testRoundTrip(self):
+    for spec in ('gzip', 'gzip:1', 'xz', 'xz:0', 'none'):
+      for threads in (1, 3):
+        size = self._RoundTrip(compression.ParseCodec(spec), threads)
+        if spec == 'none':
+          self.assertEqual(len(self.data), size)
+        else:
+          self.assertTrue(size < 0.6 * len(self.data))
+
+  def testParseCodec(self):
+    codec = compression.ParseCodec('gzip')
+    self.assertTrue(isinstance(codec, compression.GzipCodec))
+    self.assertEqual(6, codec.level)
+    self.assertEqual('.tar.gz', codec.suffix)
+    self.assertEqual('xz:9', str(compression.ParseCodec('xz:9')))
+    self.assertEqual('none', str(compression.ParseCodec('none')))
+    for spec in ('bzip2', 'gzip:0', 'gzip:x', 'xz:10', 'none:1'):
+      self.assertRaises(compression.CompressionError,
+                        compression.ParseCodec, spec)
+
+  def testXzFailure(self):
+    codec = compression.XzCodec()
+    self.assertRaises(compression.CompressionError, codec.Decompress,
+                      StringIO.StringIO('not xz data'), StringIO.StringIO())
+
+  def testBenchmark(self):
+    def WriteArchive(codec, archive_file):
+      compressing_file = codec.Open(archive_file)
+      compressing_file.write(self.data)
+      compressing_file.close()
+
+    codecs = [compression.ParseCodec(spec) for spec in ('gzip:1', 'none')]
+    results = compression.Benchmark(WriteArchive, codecs, self.tmp_dir)
+    self.assertEqual(codecs, [result.codec for result in results])
+    for result in results:
+      self.assertEqual(len(self.data), result.size)
+    self.assertTrue(results[0].compressed_size < 0.6 * len(self.data))
+    self.assertEqual(len(self.data), results[1].compressed_size)
+    self.assertTrue('ratio 1.00' in str(results[1]))
+    # The compressed archives are removed.
+    self.assertEqual([], os.listdir(self.tmp_dir))
+
+
+def main():
+  logging.basicConfig(level=logging.DEBUG)
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,103 @@
+#!/usr/bin/python
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unittest for disk_usage.py module."""
+
+__pychecker__ = 'no-local'  # for unittest
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from gcimagebundlelib import disk_usage
+from gcimagebundlelib import exclude_spec
+
+
+class DiskUsageTest(unittest.TestCase):
+
+  _MEGABYTE = 1024 * 1024
+  _GIGABYTE = 1024 * _MEGABYTE
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    for directory in ('dir1/dir11', 'dir2', 'tmp'):
+      os.makedirs(self._Path(directory))
+    for file_name, size in (('file1', 100000), ('dir1/file2', 20000),
+                            ('dir1/dir11/file3', 3000), ('tmp/big', 500000)):
+      with open(self._Path(file_name), 'wb') as f:
+        f.write(os.urandom(size))
+    os.link(self._Path('file1'), self._Path('dir2/hl1'))
+    os.symlink('../file1', self._Path('dir2/sl1'))
+    with open(self._Path('sparse'), 'wb') as f:
+      f.truncate(8 * self._MEGABYTE)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def _Path(self, relative_path):
+    return os.path.join(self.tmp_dir, relative_path)
+
+  def _Allocated(self, *relative_paths):
+    return sum(os.lstat(self._Path(path)).st_blocks * 512
+               for path in relative_paths)
+
+  def testMeasure(self):
+    usage = disk_usage.Measure(self.tmp_dir, threads=3)
+    # The hard link is counted once.
+    self.assertEqual(11, usage.files)
+    self.assertEqual(
+        self._Allocated('', 'dir1', 'dir1/dir11', 'dir2', 'tmp', 'file1',
+                        'dir1/file2', 'dir1/dir11/file3', 'tmp/big',
+                        'dir2/sl1', 'sparse'),
+        usage.allocated)
+
+  def testIgnoreHardLinks(self):
+    usage = disk_usage.Measure(self.tmp_dir, ignore_hard_links=True)
+    self.assertEqual(12, usage.files)
+    self.assertEqual(self._Allocated('file1'),
+                     usage.allocated -
+                     disk_usage.Measure(self.tmp_dir).allocated)
+
+  def testExcludes(self):
+    index = exclude_spec.ExcludeIndex([
+        exclude_spec.ExcludeSpec(self._Path('tmp'), preserve_dir=True)])
+    usage = disk_usage.Measure(self.tmp_dir, index.ShouldExclude)
+    self.assertEqual(10, usage.files)
+    self.assertEqual(self._Allocated('tmp/big'),
+                     disk_usage.Measure(self.tmp_dir).allocated -
+                     usage.allocated)
+
+  def testFileSystemSize(self):
+    usage = disk_usage.DiskUsage(3 * self._GIGABYTE, 1000)
+    minimum = disk_usage.MinimumFileSystemSize(usage)
+    self.assertTrue(3 * self._GIGABYTE < minimum < 4 * self._GIGABYTE)
+    suggested = disk_usage.SuggestedFileSystemSize(usage)
+    self.assertEqual(0, suggested % self._GIGABYTE)
+    self.assertTrue(suggested > minimum)
+    # Many small files need inodes more than blocks.
+    usage = disk_usage.DiskUsage(self._MEGABYTE, 1000000)
+    self.assertTrue(disk_usage.MinimumFileSystemSize(usage) >
+                    1000000 * 16384)
+
+
+def main():
+  logging.basicConfig(level=logging.DEBUG)
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
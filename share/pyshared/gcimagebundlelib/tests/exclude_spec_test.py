@@ -0,0 +1,99 @@
+#!/usr/bin/python
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unittest for exclude_spec.py module."""
+
+__pychecker__ = 'no-local'  # for unittest
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from gcimagebundlelib import exclude_spec
+
+
+class ExcludeSpecTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    for directory in ('tmp/sub/deeper', 'tmpfoo', 'var/log/apt', 'var/run',
+                      'etc'):
+      os.makedirs(os.path.join(self.tmp_dir, directory))
+    for file_name in ('tmp/a', 'tmp/sub/b', 'tmpfoo/c', 'var/log/syslog',
+                      'var/log/apt/history.log', 'var/run/pid', 'etc/fstab'):
+      with open(os.path.join(self.tmp_dir, file_name), 'w') as f:
+        f.write(file_name)
+    self.specs = [
+        exclude_spec.ExcludeSpec(self._Path('tmp'), preserve_dir=True),
+        exclude_spec.ExcludeSpec(self._Path('var/log'), preserve_dir=True,
+                                 preserve_subdir=True),
+        exclude_spec.ExcludeSpec(self._Path('var/run'), preserve_dir=True,
+                                 preserve_file=True),
+        exclude_spec.ExcludeSpec(self._Path('var/log/apt')),
+        exclude_spec.ExcludeSpec(self._Path('etc/fstab'))]
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def _Path(self, relative_path):
+    return os.path.join(self.tmp_dir, relative_path)
+
+  def _AllPaths(self):
+    paths = [self.tmp_dir]
+    for root, dirs, files in os.walk(self.tmp_dir):
+      paths.extend(os.path.join(root, name) for name in dirs + files)
+    return paths
+
+  def testIndexMatchesSpecs(self):
+    index = exclude_spec.ExcludeIndex(self.specs)
+    for path in self._AllPaths():
+      expected = any(spec.ShouldExclude(path) for spec in self.specs)
+      self.assertEqual(expected, index.ShouldExclude(path), path)
+      self.assertEqual(expected,
+                       index.ShouldExclude(path, os.stat(path)), path)
+
+  def testExcludedPaths(self):
+    index = exclude_spec.ExcludeIndex(self.specs)
+    excluded = set(os.path.relpath(path, self.tmp_dir)
+                   for path in self._AllPaths() if index.ShouldExclude(path))
+    self.assertEqual(set(['tmp/a', 'tmp/sub', 'tmp/sub/b', 'tmp/sub/deeper',
+                          'var/log/syslog', 'var/log/apt',
+                          'var/log/apt/history.log', 'etc/fstab']),
+                     excluded)
+
+  def testMatchesWholeComponents(self):
+    spec = exclude_spec.ExcludeSpec(self._Path('tmp'))
+    self.assertTrue(spec.ShouldExclude(self._Path('tmp/a')))
+    self.assertFalse(spec.ShouldExclude(self._Path('tmpfoo/c')))
+    index = exclude_spec.ExcludeIndex([spec])
+    self.assertTrue(index.ShouldExclude(self._Path('tmp')))
+    self.assertFalse(index.ShouldExclude(self._Path('tmpfoo')))
+    self.assertFalse(index.ShouldExclude(self.tmp_dir))
+
+  def testEmptyIndex(self):
+    index = exclude_spec.ExcludeIndex([])
+    self.assertEqual(0, index.spec_count)
+    self.assertFalse(index.ShouldExclude(self._Path('tmp/a')))
+
+
+def main():
+  logging.basicConfig(level=logging.DEBUG)
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
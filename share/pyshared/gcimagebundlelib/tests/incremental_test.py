@@ -0,0 +1,159 @@
+#!/usr/bin/python
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unittest for incremental.py module."""
+
+__pychecker__ = 'no-local'  # for unittest
+
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from gcimagebundlelib import incremental
+from gcimagebundlelib import tree_copy
+
+
+class IncrementalTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.src = os.path.join(self.tmp_dir, 'src')
+    self.dest = os.path.join(self.tmp_dir, 'dest')
+    self.manifest_path = os.path.join(self.tmp_dir,
+                                      incremental.MANIFEST_FILE_NAME)
+    os.makedirs(os.path.join(self.src, 'dir1', 'dir11'))
+    os.makedirs(self.dest)
+    self._WriteFile('test1', 'test1 data')
+    self._WriteFile('dir1/test2', 'test2 data')
+    self._WriteFile('dir1/dir11/test3', 'test3 data')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def _Src(self, relative_path):
+    return os.path.join(self.src, relative_path)
+
+  def _Dest(self, relative_path):
+    return os.path.join(self.dest, relative_path)
+
+  def _WriteFile(self, relative_path, data):
+    with open(self._Src(relative_path), 'w') as f:
+      f.write(data)
+
+  def _Read(self, path):
+    with open(path, 'rb') as f:
+      return f.read()
+
+  def _Copy(self):
+    """Copies src to dest on top of the previous copy, if any."""
+    previous = None
+    if os.path.exists(self.manifest_path):
+      previous, _, _ = incremental.FileManifest.Load(self.manifest_path)
+    file_manifest = incremental.FileManifest(self.dest, previous, 'uuid', 42)
+    with tree_copy.TreeCopier(xattrs=False, manifest=file_manifest) as copier:
+      copier.Copy(self.src, self.dest)
+    removed = file_manifest.RemoveStale()
+    file_manifest.Save(self.manifest_path)
+    return copier, file_manifest, removed
+
+  def testFirstCopy(self):
+    copier, file_manifest, removed = self._Copy()
+    self.assertEqual(3, copier.files)
+    self.assertEqual(30, file_manifest.bytes_copied)
+    self.assertEqual(0, file_manifest.bytes_reused)
+    self.assertEqual(0, removed)
+    self.assertEqual('test3 data', self._Read(self._Dest('dir1/dir11/test3')))
+
+  def testUnchangedFilesAreNotCopied(self):
+    self._Copy()
+    # A file only present in the image shows that it is not copied again.
+    with open(self._Dest('test1'), 'w') as f:
+      f.write('in the image')
+    copier, file_manifest, removed = self._Copy()
+    self.assertEqual(0, copier.files)
+    self.assertEqual(0, file_manifest.bytes_copied)
+    self.assertEqual(30, file_manifest.bytes_reused)
+    self.assertEqual(0, removed)
+    self.assertEqual('in the image', self._Read(self._Dest('test1')))
+
+  def testChangedFilesAreCopied(self):
+    self._Copy()
+    self._WriteFile('dir1/test2', 'new test2 data')
+    self._WriteFile('test4', 'test4')
+    copier, file_manifest, _ = self._Copy()
+    self.assertEqual(2, copier.files)
+    self.assertEqual(19, file_manifest.bytes_copied)
+    self.assertEqual(20, file_manifest.bytes_reused)
+    self.assertEqual('new test2 data', self._Read(self._Dest('dir1/test2')))
+    self.assertEqual('test4', self._Read(self._Dest('test4')))
+
+  def testSameContentIsReused(self):
+    self._Copy()
+    # Touching the file changes its times but not its content hash.
+    os.utime(self._Src('test1'), (1000000000, 1000000000))
+    copier, file_manifest, _ = self._Copy()
+    self.assertEqual(0, copier.files)
+    self.assertEqual(30, file_manifest.bytes_reused)
+    self.assertEqual(1000000000, int(os.stat(self._Dest('test1')).st_mtime))
+
+  def testRemovedFilesAreRemoved(self):
+    self._Copy()
+    shutil.rmtree(self._Src('dir1/dir11'))
+    os.remove(self._Src('test1'))
+    _, _, removed = self._Copy()
+    self.assertEqual(3, removed)
+    self.assertFalse(os.path.lexists(self._Dest('test1')))
+    self.assertFalse(os.path.lexists(self._Dest('dir1/dir11')))
+    self.assertTrue(os.path.exists(self._Dest('dir1/test2')))
+
+  def testTypeChanges(self):
+    self._Copy()
+    shutil.rmtree(self._Src('dir1/dir11'))
+    self._WriteFile('dir1/dir11', 'now a file')
+    os.remove(self._Src('test1'))
+    os.mkdir(self._Src('test1'))
+    self._Copy()
+    self.assertEqual('now a file', self._Read(self._Dest('dir1/dir11')))
+    self.assertTrue(os.path.isdir(self._Dest('test1')))
+
+  def testSaveAndLoad(self):
+    _, file_manifest, _ = self._Copy()
+    records, uuid, fs_size = incremental.FileManifest.Load(self.manifest_path)
+    self.assertEqual('uuid', uuid)
+    self.assertEqual(42, fs_size)
+    self.assertEqual(set(['.', 'test1', 'dir1', 'dir1/test2', 'dir1/dir11',
+                          'dir1/dir11/test3']), set(records))
+    self.assertEqual(file_manifest.fs_size, fs_size)
+
+  def testLoadInvalidManifest(self):
+    with open(self.manifest_path, 'w') as f:
+      f.write('not json')
+    self.assertRaises(incremental.ManifestError,
+                      incremental.FileManifest.Load, self.manifest_path)
+    with open(self.manifest_path, 'w') as f:
+      f.write('{"version": 0}')
+    self.assertRaises(incremental.ManifestError,
+                      incremental.FileManifest.Load, self.manifest_path)
+
+
+def main():
+  logging.basicConfig(level=logging.DEBUG)
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
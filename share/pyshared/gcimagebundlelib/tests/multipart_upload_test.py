@@ -0,0 +1,267 @@
+#!/usr/bin/python
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unittest for multipart_upload.py module."""
+
+__pychecker__ = 'no-local'  # for unittest
+
+import base64
+import BaseHTTPServer
+import hashlib
+import logging
+import os
+import re
+import shutil
+import SocketServer
+import tempfile
+import threading
+import unittest
+import urllib
+import urlparse
+
+from gcimagebundlelib import multipart_upload
+from gcimagebundlelib import uploader
+
+
+class _ObjectStoreHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """A small subset of the Cloud Storage XML API."""
+
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, *args):
+    pass
+
+  def _Reply(self, status, body='', headers=None):
+    self.send_response(status)
+    for name, value in (headers or {}).iteritems():
+      self.send_header(name, value)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def _Parse(self):
+    parts = urlparse.urlsplit(self.path)
+    query = dict(urlparse.parse_qsl(parts.query, keep_blank_values=True))
+    body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+    return urllib.unquote(parts.path), query, body
+
+  def do_POST(self):
+    path, query, body = self._Parse()
+    store = self.server.store
+    if 'uploads' in query:
+      store.upload_count += 1
+      upload_id = 'upload%d' % store.upload_count
+      store.uploads[upload_id] = {}
+      self._Reply(200, '<InitiateMultipartUploadResult><UploadId>%s'
+                  '</UploadId></InitiateMultipartUploadResult>' % upload_id)
+      return
+    parts = store.uploads.pop(query['uploadId'])
+    numbers = [int(n) for n in re.findall(r'<PartNumber>(\d+)<', body)]
+    data = ''.join(parts[n][0] for n in numbers)
+    md5s = ''.join(hashlib.md5(parts[n][0]).digest() for n in numbers)
+    etag = '%s-%d' % (hashlib.md5(md5s).hexdigest(), len(numbers))
+    store.objects[path] = data
+    self._Reply(200, '<CompleteMultipartUploadResult><ETag>"%s"</ETag>'
+                '</CompleteMultipartUploadResult>' % etag)
+
+  def _Authorized(self):
+    store = self.server.store
+    store.tokens.append(self.headers.get('Authorization'))
+    if self.headers.get('Authorization') in store.revoked_tokens:
+      self._Reply(401)
+      return False
+    return True
+
+  def do_PUT(self):
+    path, query, body = self._Parse()
+    store = self.server.store
+    if not self._Authorized():
+      return
+    number = int(query['partNumber'])
+    store.requested_parts.append(number)
+    if number in store.fail_parts:
+      store.fail_parts.remove(number)
+      self._Reply(503)
+      return
+    md5 = hashlib.md5(body)
+    if base64.b64decode(self.headers['Content-MD5']) != md5.digest():
+      self._Reply(400, 'BadDigest')
+      return
+    store.parts_uploaded += 1
+    store.uploads[query['uploadId']][number] = (body, md5.hexdigest())
+    self._Reply(200, headers={'ETag': '"%s"' % md5.hexdigest()})
+
+  def do_GET(self):
+    _, query, _ = self._Parse()
+    parts = self.server.store.uploads.get(query['uploadId'])
+    if parts is None:
+      self._Reply(404)
+      return
+    self._Reply(200, '<ListPartsResult>%s</ListPartsResult>' % ''.join(
+        '<Part><PartNumber>%d</PartNumber><ETag>"%s"</ETag></Part>'
+        % (number, etag) for number, (_, etag) in parts.iteritems()))
+
+
+class _ObjectStore(object):
+
+  def __init__(self):
+    self.uploads = {}
+    self.objects = {}
+    self.upload_count = 0
+    self.parts_uploaded = 0
+    self.fail_parts = set()
+    self.requested_parts = []
+    self.tokens = []
+    self.revoked_tokens = set()
+
+
+class _ThreadedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+
+class MultipartUploadTest(unittest.TestCase):
+
+  _PART_SIZE = 256 * 1024
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.state_path = os.path.join(self.tmp_dir, 'upload.json')
+    self.server = _ThreadedServer(('127.0.0.1', 0), _ObjectStoreHandler)
+    self.server.store = _ObjectStore()
+    server_thread = threading.Thread(target=self.server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    self.data = os.urandom(10 * self._PART_SIZE + 1000)
+    self.archive_path = self._WriteArchive('image.tar.gz', self.data)
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    shutil.rmtree(self.tmp_dir)
+
+  def _WriteArchive(self, name, data):
+    archive_path = os.path.join(self.tmp_dir, name)
+    with open(archive_path, 'wb') as archive_file:
+      archive_file.write(data)
+    return archive_path
+
+  def _Uploader(self, token_source=None, threads=3):
+    return multipart_upload.MultipartUploader(
+        'gs://bucket', self.state_path,
+        endpoint='http://127.0.0.1:%d' % self.server.server_port,
+        token_source=token_source, part_size=self._PART_SIZE,
+        threads=threads, retry_delay=0)
+
+  def _FailedUpload(self, fail_parts, threads=3):
+    """Uploads the archive with parts which fail every attempt."""
+    self.server.store.fail_parts = set(fail_parts)
+    multipart_upload.ATTEMPTS, attempts = 1, multipart_upload.ATTEMPTS
+    try:
+      self.assertRaises(uploader.UploadError,
+                        self._Uploader(threads=threads).UploadFile,
+                        self.archive_path, 'final.tar.gz')
+    finally:
+      multipart_upload.ATTEMPTS = attempts
+
+  def testUpload(self):
+    image_uploader = self._Uploader()
+    image_uploader.UploadFile(self.archive_path, 'final.tar.gz')
+    self.assertEqual({'/bucket/final.tar.gz': self.data},
+                     self.server.store.objects)
+    self.assertEqual(11, self.server.store.parts_uploaded)
+    self.assertFalse(os.path.exists(self.state_path))
+    self.assertEqual(None, image_uploader.PendingUpload())
+    self.assertEqual('gs://bucket/final.tar.gz',
+                     image_uploader.Url('final.tar.gz'))
+
+  def testEmptyUpload(self):
+    empty_path = self._WriteArchive('empty', '')
+    self._Uploader().UploadFile(empty_path, 'empty')
+    self.assertEqual({'/bucket/empty': ''}, self.server.store.objects)
+
+  def testRetriesFailedParts(self):
+    self.server.store.fail_parts = set([2, 5])
+    self._Uploader().UploadFile(self.archive_path, 'final.tar.gz')
+    self.assertEqual(self.data,
+                     self.server.store.objects['/bucket/final.tar.gz'])
+
+  def testFailedPartStopsUpload(self):
+    self._FailedUpload([2], threads=1)
+    # The parts after the failed one are not requested.
+    self.assertEqual([1, 2], self.server.store.requested_parts)
+    self.assertEqual({}, self.server.store.objects)
+
+  def testUnreadableArchive(self):
+    os.remove(self.archive_path)
+    os.mkdir(self.archive_path)
+    self.assertRaises(multipart_upload.MultipartUploadError,
+                      self._Uploader().UploadFile, self.archive_path,
+                      'final.tar.gz')
+
+  def testResume(self):
+    # The last part is only started once the others are, so they are all
+    # uploaded.
+    self._FailedUpload([11])
+    self.assertEqual({}, self.server.store.objects)
+    self.assertEqual(10, self.server.store.parts_uploaded)
+    self.server.store.parts_uploaded = 0
+    # The next run finds the archive and only uploads the missing parts.
+    image_uploader = self._Uploader()
+    self.assertEqual((self.archive_path, 'final.tar.gz'),
+                     image_uploader.PendingUpload())
+    image_uploader.UploadFile(self.archive_path, 'final.tar.gz')
+    self.assertEqual(self.data,
+                     self.server.store.objects['/bucket/final.tar.gz'])
+    self.assertEqual(1, self.server.store.upload_count)
+    self.assertEqual(1, self.server.store.parts_uploaded)
+    self.assertFalse(os.path.exists(self.state_path))
+
+  def testChangedArchiveIsNotResumed(self):
+    self._FailedUpload([3])
+    self.archive_path = self._WriteArchive('image.tar.gz', 'x' + self.data)
+    image_uploader = self._Uploader()
+    self.assertEqual(None, image_uploader.PendingUpload())
+    self.server.store.parts_uploaded = 0
+    image_uploader.UploadFile(self.archive_path, 'final.tar.gz')
+    self.assertEqual('x' + self.data,
+                     self.server.store.objects['/bucket/final.tar.gz'])
+    self.assertEqual(2, self.server.store.upload_count)
+    self.assertEqual(11, self.server.store.parts_uploaded)
+
+  def testTokenIsCached(self):
+    tokens = ['first', 'second']
+    def TokenSource():
+      return tokens.pop(0), 3600
+
+    # The first token is revoked, the second one is then used throughout.
+    self.server.store.revoked_tokens.add('Bearer first')
+    self._Uploader(TokenSource).UploadFile(self.archive_path, 'final.tar.gz')
+    self.assertEqual(self.data,
+                     self.server.store.objects['/bucket/final.tar.gz'])
+    self.assertEqual([], tokens)
+    self.assertEqual('Bearer second', self.server.store.tokens[-1])
+
+  def testFailsAfterRetries(self):
+    self._FailedUpload([1])
+    self.assertTrue(os.path.exists(self.state_path))
+
+
+def main():
+  logging.basicConfig(level=logging.DEBUG)
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,69 @@
+#!/usr/bin/python
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unittest for parallel_gzip.py module."""
+
+__pychecker__ = 'no-local'  # for unittest
+
+import gzip
+import logging
+import os
+import random
+import StringIO
+import unittest
+
+from gcimagebundlelib import parallel_gzip
+
+
+class ParallelGzipTest(unittest.TestCase):
+
+  def _Compress(self, chunks, threads=3, block_size=1000):
+    output = StringIO.StringIO()
+    with parallel_gzip.ParallelGzipWriter(output, threads,
+                                          block_size=block_size) as writer:
+      for chunk in chunks:
+        writer.write(chunk)
+    return output.getvalue()
+
+  def _Decompress(self, data):
+    return gzip.GzipFile(fileobj=StringIO.StringIO(data)).read()
+
+  def testRoundTrip(self):
+    """Verify the members decompress to the input, in order."""
+    chunks = [os.urandom(random.randint(0, 3000)) for _ in range(50)]
+    chunks.append('a' * 5000)
+    data = self._Compress(chunks)
+    self.assertEqual(self._Decompress(data), ''.join(chunks))
+
+  def testBlockBoundaries(self):
+    """Verify inputs that are exact multiples of the block size."""
+    for size in (0, 1, 999, 1000, 1001, 3000):
+      data = self._Compress(['x' * size])
+      self.assertEqual(self._Decompress(data), 'x' * size)
+
+  def testCompressBlock(self):
+    """Verify a single block is a complete gzip member."""
+    member = parallel_gzip.CompressBlock('hello' * 100)
+    self.assertEqual(member[:2], '\x1f\x8b')
+    self.assertEqual(self._Decompress(member), 'hello' * 100)
+
+
+def main():
+  logging.basicConfig(level=logging.DEBUG)
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,129 @@
+#!/usr/bin/python
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unittest for partition_table.py module."""
+
+__pychecker__ = 'no-local'  # for unittest
+
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+
+from gcimagebundlelib import partition_table
+from gcimagebundlelib import utils
+
+
+class PartitionTableTest(unittest.TestCase):
+
+  _MEGABYTE = 1024 * 1024
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.disk_path = os.path.join(self.tmp_dir, 'disk.raw')
+    with open(self.disk_path, 'wb') as f:
+      f.truncate(64 * self._MEGABYTE)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def _AddPartition(self, label):
+    partition_table.MakePartitionTable(self.disk_path, label)
+    table = partition_table.PartitionTable(self.disk_path)
+    table.AddPartition(self._MEGABYTE, 32 * self._MEGABYTE - 1)
+    table.Write()
+    return partition_table.PartitionTable(self.disk_path)
+
+  def testMsdos(self):
+    table = self._AddPartition(partition_table.MSDOS)
+    self.assertEqual(partition_table.MSDOS, table.label)
+    partitions = table.Partitions()
+    self.assertEqual(1, len(partitions))
+    self.assertEqual(1, partitions[0].number)
+    self.assertEqual(self._MEGABYTE, partitions[0].start)
+    self.assertEqual(31 * self._MEGABYTE, partitions[0].size)
+    self.assertEqual(partition_table.LINUX_PARTITION_TYPE,
+                     partitions[0].type_id)
+
+  def testGpt(self):
+    table = self._AddPartition(partition_table.GPT)
+    self.assertEqual(partition_table.GPT, table.label)
+    partition = table.GetPartition(1)
+    self.assertEqual(self._MEGABYTE, partition.start)
+    self.assertEqual(31 * self._MEGABYTE, partition.size)
+    self.assertEqual(partition_table.LINUX_FILESYSTEM_GUID, partition.type_id)
+    # Both headers must carry valid checksums.
+    with open(self.disk_path, 'rb') as f:
+      data = f.read()
+    for lba in (1, len(data) // 512 - 1):
+      header = data[lba * 512:lba * 512 + 92]
+      fields = struct.unpack('<8sIIIIQQQQ16sQIII', header)
+      self.assertEqual('EFI PART', fields[0])
+      self.assertEqual(lba, fields[5])
+      unsummed = header[:16] + '\0' * 4 + header[20:]
+      self.assertEqual(fields[3], zlib.crc32(unsummed) & 0xffffffff)
+      entries = data[fields[10] * 512:fields[10] * 512 + 128 * 128]
+      self.assertEqual(fields[13], zlib.crc32(entries) & 0xffffffff)
+
+  def testRemovePartition(self):
+    for label in (partition_table.MSDOS, partition_table.GPT):
+      table = self._AddPartition(label)
+      table.RemovePartition(1)
+      table.Write()
+      table = partition_table.PartitionTable(self.disk_path)
+      self.assertEqual([], table.Partitions())
+      self.assertRaises(IndexError, table.GetPartition, 1)
+
+  def testOverlappingPartition(self):
+    table = self._AddPartition(partition_table.MSDOS)
+    self.assertRaises(partition_table.PartitionTableError,
+                      table.AddPartition, 16 * self._MEGABYTE,
+                      48 * self._MEGABYTE - 1)
+    partition = table.AddPartition(32 * self._MEGABYTE,
+                                   48 * self._MEGABYTE - 1)
+    self.assertEqual(2, partition.number)
+
+  def testPartitionDoesNotFit(self):
+    for label in (partition_table.MSDOS, partition_table.GPT):
+      partition_table.MakePartitionTable(self.disk_path, label)
+      table = partition_table.PartitionTable(self.disk_path)
+      self.assertRaises(partition_table.PartitionTableError,
+                        table.AddPartition, self._MEGABYTE,
+                        64 * self._MEGABYTE)
+
+  def testNoPartitionTable(self):
+    self.assertRaises(partition_table.PartitionTableError,
+                      partition_table.PartitionTable, self.disk_path)
+
+  def testUtilsHelpers(self):
+    utils.MakePartitionTable(self.disk_path)
+    utils.MakePartition(self.disk_path, 'primary', 'ext2', 2 * self._MEGABYTE,
+                        64 * self._MEGABYTE - 1)
+    self.assertEqual(2 * self._MEGABYTE,
+                     utils.GetPartitionStart(self.disk_path, 1))
+    utils.RemovePartition(self.disk_path, 1)
+    self.assertRaises(IndexError, utils.GetPartitionStart, self.disk_path, 1)
+
+
+def main():
+  logging.basicConfig(level=logging.DEBUG)
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
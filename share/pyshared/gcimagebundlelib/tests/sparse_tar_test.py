@@ -0,0 +1,113 @@
+#!/usr/bin/python
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unittest for sparse_tar.py module."""
+
+__pychecker__ = 'no-local'  # for unittest
+
+import logging
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import unittest
+
+from gcimagebundlelib import sparse_tar
+
+
+class SparseTarTest(unittest.TestCase):
+
+  _MEGABYTE = 1024 * 1024
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def _CreateFile(self, name, size, chunks):
+    """Creates a sparse file holding data at the given offsets."""
+    path = os.path.join(self.tmp_dir, name)
+    with open(path, 'wb') as f:
+      f.truncate(size)
+      for offset, data in chunks:
+        f.seek(offset)
+        f.write(data)
+    return path
+
+  def _Archive(self, paths):
+    tar_path = os.path.join(self.tmp_dir, 'archive.tar')
+    with open(tar_path, 'wb') as tar_file:
+      writer = sparse_tar.SparseTarWriter(tar_file)
+      for path in paths:
+        writer.AddFile(path)
+      writer.Close()
+    return tar_path
+
+  def testDataExtents(self):
+    """Verify the extents cover the data and skip most of the holes."""
+    path = self._CreateFile(
+        'disk.raw', 16 * self._MEGABYTE,
+        [(self._MEGABYTE, 'a' * 100), (8 * self._MEGABYTE, 'b' * 100)])
+    fd = os.open(path, os.O_RDONLY)
+    try:
+      extents = sparse_tar.DataExtents(fd, 16 * self._MEGABYTE)
+    finally:
+      os.close(fd)
+    for offset in (self._MEGABYTE, 8 * self._MEGABYTE):
+      self.assertTrue([e for e in extents if e[0] <= offset < sum(e)])
+    self.assertTrue(sum(length for _, length in extents) <
+                    16 * self._MEGABYTE)
+
+  def testRoundTrip(self):
+    """Verify sparse, dense, empty and all-hole files are restored."""
+    # More extents than fit in the main header.
+    chunks = [(i * 2 * self._MEGABYTE, os.urandom(1000 + i)) for i in range(30)]
+    paths = [self._CreateFile('disk.raw', 64 * self._MEGABYTE, chunks),
+             self._CreateFile('manifest.json', 0, [(0, '{"licenses": []}')]),
+             self._CreateFile('empty', 0, []),
+             self._CreateFile('hole', 5 * self._MEGABYTE, [])]
+    tar_path = self._Archive(paths)
+    self.assertTrue(os.path.getsize(tar_path) < 2 * self._MEGABYTE)
+    self.assertEqual(os.path.getsize(tar_path) % sparse_tar.RECORD_SIZE, 0)
+    tar = tarfile.open(tar_path)
+    self.assertEqual(tar.getnames(),
+                     ['disk.raw', 'manifest.json', 'empty', 'hole'])
+    for path in paths:
+      with open(path, 'rb') as f:
+        self.assertEqual(tar.extractfile(os.path.basename(path)).read(),
+                         f.read())
+
+  def testGnuTarExtracts(self):
+    """Verify GNU tar restores a sparse file."""
+    path = self._CreateFile('disk.raw', 32 * self._MEGABYTE,
+                            [(3 * self._MEGABYTE, 'data' * 1000)])
+    tar_path = self._Archive([path])
+    extract_dir = os.path.join(self.tmp_dir, 'extract')
+    os.mkdir(extract_dir)
+    subprocess.check_call(['tar', 'xf', tar_path, '-C', extract_dir])
+    with open(path, 'rb') as f:
+      with open(os.path.join(extract_dir, 'disk.raw'), 'rb') as extracted:
+        self.assertEqual(extracted.read(), f.read())
+
+
+def main():
+  logging.basicConfig(level=logging.DEBUG)
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
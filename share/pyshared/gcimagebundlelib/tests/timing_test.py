@@ -0,0 +1,111 @@
+#!/usr/bin/python
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unittest for timing.py module."""
+
+__pychecker__ = 'no-local'  # for unittest
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from gcimagebundlelib import timing
+from gcimagebundlelib import utils
+
+
+class TimingTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def testStage(self):
+    report = timing.Report()
+    with report.Stage('copy') as stage:
+      time.sleep(0.05)
+      stage.bytes = 1024
+    with report.Stage('mkfs'):
+      pass
+    self.assertEqual(['copy', 'mkfs'], [s.name for s in report.stages])
+    self.assertTrue(report.stages[0].seconds >= 0.05)
+    self.assertEqual(1024, report.stages[0].bytes)
+    self.assertEqual(None, report.stages[1].bytes)
+
+  def testStageIsRecordedOnFailure(self):
+    report = timing.Report()
+    try:
+      with report.Stage('archive'):
+        raise ValueError('disk full')
+    except ValueError:
+      pass
+    self.assertEqual(['archive'], [s.name for s in report.stages])
+
+  def testSave(self):
+    report = timing.Report()
+    with report.Stage('copy') as stage:
+      stage.bytes = 10
+    report.AddCommand(['mkfs', '-t', 'ext4'], 1.5, 0)
+    report_path = os.path.join(self.tmp_dir, 'log.json')
+    report.Save(report_path)
+    with open(report_path) as report_file:
+      saved = json.load(report_file)
+    self.assertEqual([{'name': 'copy', 'seconds': saved['stages'][0]['seconds'],
+                       'bytes': 10, 'files': None}], saved['stages'])
+    self.assertEqual([{'command': 'mkfs -t ext4', 'seconds': 1.5,
+                       'returncode': 0}], saved['commands'])
+    self.assertTrue(saved['seconds'] >= 0)
+
+  def testRunCommandIsReported(self):
+    commands = timing.GetReport().commands
+    count = len(commands)
+    utils.RunCommand(['true'])
+    self.assertEqual(count + 1, len(commands))
+    self.assertEqual('true', commands[-1]['command'])
+    self.assertEqual(0, commands[-1]['returncode'])
+
+  def testProgressIsThrottled(self):
+    progress = timing.Progress('Copying', interval=3600)
+    logger = logging.getLogger()
+    messages = []
+    handler = logging.Handler()
+    handler.emit = messages.append
+    logger.addHandler(handler)
+    level = logger.level
+    logger.setLevel(logging.INFO)
+    try:
+      progress.Update(100)
+      self.assertEqual([], messages)
+      progress = timing.Progress('Copying', interval=0)
+      progress.Update(3 * 1024 * 1024)
+      self.assertEqual(1, len(messages))
+      self.assertTrue(messages[0].getMessage().startswith('Copying: 3 MB'))
+    finally:
+      logger.setLevel(level)
+      logger.removeHandler(handler)
+
+
+def main():
+  logging.basicConfig(level=logging.DEBUG)
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,151 @@
+#!/usr/bin/python
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unittest for tree_copy.py module."""
+
+__pychecker__ = 'no-local'  # for unittest
+
+import logging
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from gcimagebundlelib import exclude_spec
+from gcimagebundlelib import tree_copy
+
+
+class TreeCopyTest(unittest.TestCase):
+
+  _MEGABYTE = 1024 * 1024
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.src = os.path.join(self.tmp_dir, 'src')
+    self.dest = os.path.join(self.tmp_dir, 'dest')
+    os.makedirs(os.path.join(self.src, 'dir1', 'dir11'))
+    os.makedirs(os.path.join(self.src, 'empty'))
+    os.makedirs(self.dest)
+    self._WriteFile('test1', 'test1 data')
+    self._WriteFile('dir1/test2', 'test2 data')
+    os.link(self._Src('test1'), self._Src('dir1/hl1'))
+    os.symlink('../test1', self._Src('dir1/sl1'))
+    with open(self._Src('sparse'), 'wb') as f:
+      f.truncate(8 * self._MEGABYTE)
+      f.seek(4 * self._MEGABYTE)
+      f.write('data in the middle')
+    os.chmod(self._Src('dir1/test2'), 0o751)
+    os.utime(self._Src('dir1'), (1000000000, 1000000000))
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def _Src(self, relative_path):
+    return os.path.join(self.src, relative_path)
+
+  def _Dest(self, relative_path):
+    return os.path.join(self.dest, relative_path)
+
+  def _WriteFile(self, relative_path, data):
+    with open(self._Src(relative_path), 'w') as f:
+      f.write(data)
+
+  def _Read(self, path):
+    with open(path, 'rb') as f:
+      return f.read()
+
+  def _Copy(self, should_exclude=None, ignore_hard_links=False):
+    with tree_copy.TreeCopier(should_exclude, ignore_hard_links,
+                              xattrs=False, threads=4) as copier:
+      copier.Copy(self.src, self.dest)
+    return copier
+
+  def testCopiesTree(self):
+    copier = self._Copy()
+    for name in ('test1', 'dir1/test2', 'dir1/hl1', 'sparse'):
+      self.assertEqual(self._Read(self._Src(name)),
+                       self._Read(self._Dest(name)))
+    self.assertTrue(os.path.isdir(self._Dest('dir1/dir11')))
+    self.assertTrue(os.path.isdir(self._Dest('empty')))
+    self.assertEqual('../test1', os.readlink(self._Dest('dir1/sl1')))
+    # The hard link is not copied again.
+    self.assertEqual(3, copier.files)
+
+  def testPreservesMetadata(self):
+    self._Copy()
+    self.assertEqual(0o751,
+                     stat.S_IMODE(os.stat(self._Dest('dir1/test2')).st_mode))
+    self.assertEqual(1000000000, int(os.stat(self._Dest('dir1')).st_mtime))
+    self.assertEqual(int(os.stat(self._Src('test1')).st_mtime),
+                     int(os.stat(self._Dest('test1')).st_mtime))
+
+  def testKeepsHoles(self):
+    self._Copy()
+    self.assertTrue(os.stat(self._Dest('sparse')).st_blocks * 512 <
+                    self._MEGABYTE)
+
+  def testHardLinks(self):
+    self._Copy()
+    self.assertEqual(os.stat(self._Dest('test1')).st_ino,
+                     os.stat(self._Dest('dir1/hl1')).st_ino)
+
+  def testIgnoreHardLinks(self):
+    self._Copy(ignore_hard_links=True)
+    self.assertNotEqual(os.stat(self._Dest('test1')).st_ino,
+                        os.stat(self._Dest('dir1/hl1')).st_ino)
+
+  def testExcludes(self):
+    index = exclude_spec.ExcludeIndex([
+        exclude_spec.ExcludeSpec(self._Src('dir1'), preserve_dir=True,
+                                 preserve_subdir=True),
+        exclude_spec.ExcludeSpec(self._Src('sparse'))])
+    self._Copy(index.ShouldExclude)
+    self.assertTrue(os.path.isdir(self._Dest('dir1/dir11')))
+    self.assertFalse(os.path.lexists(self._Dest('dir1/test2')))
+    self.assertFalse(os.path.lexists(self._Dest('dir1/hl1')))
+    self.assertFalse(os.path.lexists(self._Dest('sparse')))
+    self.assertTrue(os.path.exists(self._Dest('test1')))
+
+  def testNonRecursive(self):
+    with tree_copy.TreeCopier(xattrs=False) as copier:
+      copier.Copy(self._Src('dir1/test2'), self._Dest('renamed'),
+                  recursive=False)
+      copier.Copy(self._Src('dir1'), self._Dest('dir1'), recursive=False)
+    self.assertEqual('test2 data', self._Read(self._Dest('renamed')))
+    self.assertTrue(os.path.isdir(self._Dest('dir1/dir11')))
+    self.assertEqual([], os.listdir(self._Dest('dir1/dir11')))
+
+  def testReplacesExistingFiles(self):
+    with open(self._Dest('test1'), 'w') as f:
+      f.write('old contents which are longer')
+    self._Copy()
+    self.assertEqual('test1 data', self._Read(self._Dest('test1')))
+
+  def testXattrsNeedSupport(self):
+    if tree_copy.XATTRS_SUPPORTED:
+      tree_copy.TreeCopier(xattrs=True).Close()
+    else:
+      self.assertRaises(tree_copy.TreeCopyError, tree_copy.TreeCopier,
+                        xattrs=True)
+
+
+def main():
+  logging.basicConfig(level=logging.DEBUG)
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
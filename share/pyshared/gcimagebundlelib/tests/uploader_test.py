@@ -0,0 +1,239 @@
+#!/usr/bin/python
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unittest for uploader.py module."""
+
+__pychecker__ = 'no-local'  # for unittest
+
+import BaseHTTPServer
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import urlparse
+
+from gcimagebundlelib import uploader
+
+
+class _DavHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Stores PUT bodies in the server's objects and renames them on MOVE."""
+
+  def log_message(self, *args):
+    pass
+
+  def _ReadChunkedBody(self):
+    chunks = []
+    while True:
+      size = int(self.rfile.readline().strip(), 16)
+      if not size:
+        self.rfile.readline()
+        return ''.join(chunks)
+      chunks.append(self.rfile.read(size))
+      self.rfile.readline()
+
+  def do_PUT(self):
+    if self.headers.get('Transfer-Encoding') == 'chunked':
+      body = self._ReadChunkedBody()
+    else:
+      body = self.rfile.read(int(self.headers['Content-Length']))
+    self.server.objects[self.path] = body
+    self.send_response(201)
+    self.send_header('Content-Length', '0')
+    self.end_headers()
+
+  def do_MOVE(self):
+    dest = urlparse.urlsplit(self.headers['Destination']).path
+    if self.path not in self.server.objects:
+      self.send_response(404)
+    else:
+      self.server.objects[dest] = self.server.objects.pop(self.path)
+      self.send_response(201)
+    self.send_header('Content-Length', '0')
+    self.end_headers()
+
+
+class _BlockingSink(object):
+  """Sink which receives nothing until it is released."""
+
+  def __init__(self):
+    self.released = threading.Event()
+    self.data = []
+
+  def write(self, data):
+    self.released.wait()
+    self.data.append(data)
+
+  def close(self):
+    pass
+
+  def abort(self):
+    pass
+
+
+class _StalledSink(_BlockingSink):
+  """Sink whose writes hang until it is aborted, like a stalled upload."""
+
+  def write(self, data):
+    self.released.wait()
+    raise IOError('connection closed')
+
+  def abort(self):
+    self.released.set()
+
+
+class _FailingSink(_BlockingSink):
+
+  def write(self, data):
+    raise IOError('disk full')
+
+
+class _FinalChunkFailingSink(uploader._FileSink):
+  """File sink whose write of the last, partial, chunk fails."""
+
+  def __init__(self, path):
+    uploader._FileSink.__init__(self, path)
+    self.aborted = False
+    self._file_write = self.write
+    self.write = self._Write
+
+  def _Write(self, data):
+    if len(data) < uploader.CHUNK_SIZE:
+      raise IOError('disk full')
+    self._file_write(data)
+
+  def abort(self):
+    self.aborted = True
+    uploader._FileSink.abort(self)
+
+
+class UploaderTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.data = [os.urandom(uploader.CHUNK_SIZE // 3) for _ in xrange(10)]
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def _Upload(self, image_uploader, name):
+    with image_uploader.Open(name) as stream:
+      for data in self.data:
+        stream.write(data)
+    return stream
+
+  def testDirectoryUploader(self):
+    image_uploader = uploader.ForUrl('file://' + self.tmp_dir)
+    stream = self._Upload(image_uploader, 'tmp.tar.gz')
+    self.assertEqual(sum(len(data) for data in self.data),
+                     stream.bytes_written)
+    image_uploader.Rename('tmp.tar.gz', 'final.tar.gz')
+    with open(os.path.join(self.tmp_dir, 'final.tar.gz'), 'rb') as f:
+      self.assertEqual(''.join(self.data), f.read())
+    self.assertEqual(['final.tar.gz'], os.listdir(self.tmp_dir))
+
+  def testAbortRemovesPartialUpload(self):
+    image_uploader = uploader.DirectoryUploader(self.tmp_dir)
+    try:
+      with image_uploader.Open('tmp.tar.gz') as stream:
+        stream.write('partial')
+        raise ValueError('compression failed')
+    except ValueError:
+      pass
+    self.assertEqual([], os.listdir(self.tmp_dir))
+
+  def testHttpUploader(self):
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), _DavHandler)
+    server.objects = {}
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    try:
+      image_uploader = uploader.ForUrl(
+          'http://127.0.0.1:%d/images/' % server.server_port)
+      self._Upload(image_uploader, 'tmp.tar.gz')
+      image_uploader.Rename('tmp.tar.gz', 'final.tar.gz')
+      self.assertEqual({'/images/final.tar.gz': ''.join(self.data)},
+                       server.objects)
+      self.assertRaises(uploader.UploadError, image_uploader.Rename,
+                        'missing.tar.gz', 'final.tar.gz')
+    finally:
+      server.shutdown()
+      server.server_close()
+
+  def testBackpressure(self):
+    sink = _BlockingSink()
+    stream = uploader.UploadStream(sink, 'blocking', max_chunks=2)
+    writer = threading.Thread(
+        target=lambda: [stream.write('x' * uploader.CHUNK_SIZE)
+                        for _ in xrange(10)])
+    writer.start()
+    time.sleep(0.2)
+    # The queue is full and the writer waits for the sink.
+    self.assertTrue(writer.is_alive())
+    sink.released.set()
+    writer.join()
+    stream.close()
+    self.assertEqual(10, len(sink.data))
+
+  def testAbortStalledUpload(self):
+    stream = uploader.UploadStream(_StalledSink(), 'stalled', max_chunks=2)
+    # One chunk is being written and two are queued.
+    for _ in xrange(3):
+      stream.write('x' * uploader.CHUNK_SIZE)
+    aborter = threading.Thread(target=stream.abort)
+    aborter.daemon = True
+    aborter.start()
+    aborter.join(5)
+    self.assertFalse(aborter.is_alive())
+
+  def testSinkErrors(self):
+    stream = uploader.UploadStream(_FailingSink(), 'failing')
+    stream.write('x' * uploader.CHUNK_SIZE)
+    self.assertRaises(uploader.UploadError, stream.close)
+
+  def testFinalChunkErrorAbortsSink(self):
+    sink = _FinalChunkFailingSink(os.path.join(self.tmp_dir, 'tmp.tar.gz'))
+
+    def Upload():
+      with uploader.UploadStream(sink, 'failing') as stream:
+        stream.write('x' * uploader.CHUNK_SIZE)
+        # Only written by the sink when the stream is closed.
+        stream.write('tail')
+
+    self.assertRaises(uploader.UploadError, Upload)
+    self.assertTrue(sink.aborted)
+    self.assertEqual([], os.listdir(self.tmp_dir))
+
+  def testForUrl(self):
+    self.assertTrue(isinstance(uploader.ForUrl('bucket'),
+                               uploader.GsutilUploader))
+    self.assertEqual('gs://bucket/name',
+                     uploader.ForUrl('gs://bucket/').Url('name'))
+    self.assertTrue(isinstance(uploader.ForUrl('/tmp'),
+                               uploader.DirectoryUploader))
+    self.assertTrue(isinstance(uploader.ForUrl('https://host/path'),
+                               uploader.HttpUploader))
+
+
+def main():
+  logging.basicConfig(level=logging.DEBUG)
+  unittest.main()
+
+
+if __name__ == '__main__':
+  main()
@@ -17,11 +17,19 @@
 
 __pychecker__ = 'no-local'  # for unittest
 
+import hashlib
 import logging
+import os
+import shutil
+import StringIO
 import subprocess
+import tarfile
+import tempfile
 import unittest
 import uuid
 
+from gcimagebundlelib import compression
+from gcimagebundlelib import uploader
 from gcimagebundlelib import utils
 
 
@@ -38,6 +46,201 @@ class ImageBundleTest(unittest.TestCase):
       utils.RunCommand(['mkfs', '-t', 'ext4', non_existent_path])
     self.assertRaises(subprocess.CalledProcessError, RunCommandUnderTest)
 
+  def testCopyBytes(self):
+    """Verify an unaligned prefix is copied and the rest of dest is kept."""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+      src_path = os.path.join(tmp_dir, 'disk')
+      dest_path = os.path.join(tmp_dir, 'disk.raw')
+      src_data = os.urandom(3 * 4096 + 123)
+      with open(src_path, 'wb') as src_file:
+        src_file.write(src_data)
+      with open(dest_path, 'wb') as dest_file:
+        dest_file.write('x' * 20000)
+      utils.CopyBytes(src_path, dest_path, 2 * 4096 + 1)
+      with open(dest_path, 'rb') as dest_file:
+        self.assertEqual(dest_file.read(),
+                         src_data[:2 * 4096 + 1] + 'x' * (20000 - 2 * 4096 - 1))
+      self.assertRaises(IOError, utils.CopyBytes, src_path, dest_path,
+                        len(src_data) + 1)
+    finally:
+      shutil.rmtree(tmp_dir)
+
+  def testWaitForDevices(self):
+    """Verify existing devices are found and missing ones time out."""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+      present = os.path.join(tmp_dir, 'present')
+      with open(present, 'wb'):
+        pass
+      utils.WaitForDevices([present], timeout=1)
+      self.assertRaises(utils.LoadDiskImageException, utils.WaitForDevices,
+                        [present, os.path.join(tmp_dir, 'missing')],
+                        timeout=0.2)
+    finally:
+      shutil.rmtree(tmp_dir)
+
+  def testMakeFileSystemFromDirectory(self):
+    """Verify a file system is written at an offset with a directory's files."""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+      src_dir = os.path.join(tmp_dir, 'src')
+      os.makedirs(os.path.join(src_dir, 'etc'))
+      with open(os.path.join(src_dir, 'etc', 'hostname'), 'w') as f:
+        f.write('image\n')
+      disk_path = os.path.join(tmp_dir, 'disk.raw')
+      with open(disk_path, 'wb') as f:
+        f.truncate(16 * 1024 * 1024)
+      fs_uuid = str(uuid.uuid4())
+      self.assertEqual(fs_uuid, utils.MakeFileSystemFromDirectory(
+          disk_path, 1024 * 1024, 15 * 1024 * 1024, 'ext4', src_dir,
+          fs_uuid))
+      image = '%s?offset=%d' % (disk_path, 1024 * 1024)
+      self.assertEqual('image\n', utils.RunCommand(
+          ['debugfs', '-R', 'cat /etc/hostname', image]))
+      self.assertRaises(utils.MakeFileSystemException,
+                        utils.MakeFileSystemFromDirectory, disk_path, 0,
+                        1024 * 1024, 'xfs', src_dir)
+    finally:
+      shutil.rmtree(tmp_dir)
+
+  def testTarAndGzipFileComputesDigest(self):
+    """Verify the digest computed while archiving matches the archive."""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+      src_path = os.path.join(tmp_dir, 'disk.raw')
+      with open(src_path, 'wb') as src_file:
+        src_file.write('some data' * 1000)
+      tar_path = os.path.join(tmp_dir, 'image.tar.gz')
+      digest = hashlib.sha1()
+      utils.TarAndGzipFile([src_path], tar_path, digest)
+      with open(tar_path, 'rb') as tar_file:
+        self.assertEqual(hashlib.sha1(tar_file.read()).hexdigest(),
+                         digest.hexdigest())
+      tar = tarfile.open(tar_path, 'r:gz')
+      self.assertEqual(tar.getnames(), ['disk.raw'])
+      self.assertEqual(tar.extractfile('disk.raw').read(), 'some data' * 1000)
+    finally:
+      shutil.rmtree(tmp_dir)
+
+  def testTarAndGzipFileWithCompressThreads(self):
+    """Verify an archive gzipped in parallel is a valid tar.gz."""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+      src_path = os.path.join(tmp_dir, 'disk.raw')
+      data = os.urandom(1024 * 1024) + '\0' * (9 * 1024 * 1024)
+      with open(src_path, 'wb') as src_file:
+        src_file.write(data)
+      tar_path = os.path.join(tmp_dir, 'image.tar.gz')
+      digest = hashlib.sha1()
+      utils.TarAndGzipFile([src_path], tar_path, digest, compress_threads=4)
+      with open(tar_path, 'rb') as tar_file:
+        self.assertEqual(hashlib.sha1(tar_file.read()).hexdigest(),
+                         digest.hexdigest())
+      tar = tarfile.open(tar_path, 'r:gz')
+      self.assertEqual(tar.extractfile('disk.raw').read(), data)
+    finally:
+      shutil.rmtree(tmp_dir)
+
+  def testTarAndGzipFileWithBuiltinTar(self):
+    """Verify the builtin tar writer produces a valid sparse tar.gz."""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+      src_path = os.path.join(tmp_dir, 'disk.raw')
+      with open(src_path, 'wb') as src_file:
+        src_file.truncate(8 * 1024 * 1024)
+        src_file.seek(4 * 1024 * 1024)
+        src_file.write('some data')
+      with open(src_path, 'rb') as src_file:
+        data = src_file.read()
+      for compress_threads in (1, 2):
+        tar_path = os.path.join(tmp_dir, 'image.tar.gz')
+        digest = hashlib.sha1()
+        utils.TarAndGzipFile([src_path], tar_path, digest, compress_threads,
+                             builtin_tar=True)
+        with open(tar_path, 'rb') as tar_file:
+          self.assertEqual(hashlib.sha1(tar_file.read()).hexdigest(),
+                           digest.hexdigest())
+        tar = tarfile.open(tar_path, 'r:gz')
+        self.assertEqual(tar.extractfile('disk.raw').read(), data)
+    finally:
+      shutil.rmtree(tmp_dir)
+
+  def testTarAndGzipFileToUploadStream(self):
+    """Verify an archive can be streamed to an uploader."""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+      src_path = os.path.join(tmp_dir, 'disk.raw')
+      data = os.urandom(3 * 1024 * 1024)
+      with open(src_path, 'wb') as src_file:
+        src_file.write(data)
+      upload_dir = os.path.join(tmp_dir, 'upload')
+      os.mkdir(upload_dir)
+      digest = hashlib.sha1()
+      with uploader.DirectoryUploader(upload_dir).Open('image.tar.gz') as f:
+        utils.TarAndGzipFile([src_path], 'image.tar.gz', digest,
+                             compress_threads=2, dest_file=f)
+      tar_path = os.path.join(upload_dir, 'image.tar.gz')
+      with open(tar_path, 'rb') as tar_file:
+        self.assertEqual(hashlib.sha1(tar_file.read()).hexdigest(),
+                         digest.hexdigest())
+      tar = tarfile.open(tar_path, 'r:gz')
+      self.assertEqual(tar.extractfile('disk.raw').read(), data)
+    finally:
+      shutil.rmtree(tmp_dir)
+
+  def testTarAndGzipFileWithCodec(self):
+    """Verify archives can be compressed with xz or not at all."""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+      src_path = os.path.join(tmp_dir, 'disk.raw')
+      data = os.urandom(1024 * 1024) + '\0' * 1024 * 1024
+      with open(src_path, 'wb') as src_file:
+        src_file.write(data)
+      for builtin_tar in (False, True):
+        for codec in (compression.XzCodec(1), compression.NoCompression(),
+                      compression.GzipCodec(9)):
+          tar_path = os.path.join(tmp_dir, 'image' + codec.suffix)
+          digest = hashlib.sha1()
+          utils.TarAndGzipFile([src_path], tar_path, digest,
+                               compress_threads=2, builtin_tar=builtin_tar,
+                               codec=codec)
+          tar_data = StringIO.StringIO()
+          with open(tar_path, 'rb') as tar_file:
+            self.assertEqual(hashlib.sha1(tar_file.read()).hexdigest(),
+                             digest.hexdigest())
+            tar_file.seek(0)
+            codec.Decompress(tar_file, tar_data)
+          tar_data.seek(0)
+          tar = tarfile.open(fileobj=tar_data)
+          self.assertEqual(tar.extractfile('disk.raw').read(), data)
+    finally:
+      shutil.rmtree(tmp_dir)
+
+  def testTarAndGzipFileStopsWhenWritingFails(self):
+    """Verify tar and the compression are ended when a write fails."""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+      src_path = os.path.join(tmp_dir, 'disk.raw')
+      with open(src_path, 'wb') as src_file:
+        src_file.write(os.urandom(4 * 1024 * 1024))
+      for codec, compress_threads in ((None, 1),
+                                      (compression.GzipCodec(1), 2),
+                                      (compression.XzCodec(0), 1)):
+        self.assertRaises(IOError, utils.TarAndGzipFile, [src_path],
+                          'image.tar.gz', compress_threads=compress_threads,
+                          dest_file=_FailingFile(), codec=codec)
+        # No child process is left running or unreaped.
+        self.assertRaises(OSError, os.waitpid, -1, os.WNOHANG)
+    finally:
+      shutil.rmtree(tmp_dir)
+
+
+class _FailingFile(object):
+
+  def write(self, data):
+    raise IOError('upload failed')
+
 
 def main():
   logging.basicConfig(level=logging.DEBUG)
@@ -0,0 +1,146 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Timing of the stages of bundling an image.
+
+The stages and the commands run are recorded in a report, which is logged
+as the stages end and saved as JSON, so that the time taken by every stage
+can be compared between images and releases.
+"""
+
+
+
+import contextlib
+import json
+import logging
+import threading
+import time
+
+# Seconds between progress lines.
+PROGRESS_INTERVAL = 10
+
+_MEGABYTE = 1024 * 1024
+
+
+def _Rate(byte_count, seconds):
+  return byte_count / float(_MEGABYTE) / (seconds or 1)
+
+
+class Stage(object):
+  """A stage of bundling.
+
+  Attributes:
+    name: The name of the stage.
+    seconds: How long the stage took.
+    bytes: How many bytes the stage processed, if known.
+    files: How many files the stage processed, if known.
+  """
+
+  def __init__(self, name):
+    self.name = name
+    self.seconds = 0
+    self.bytes = None
+    self.files = None
+
+
+class Report(object):
+  """Durations of the stages and commands of a bundling."""
+
+  def __init__(self):
+    self._start_time = time.time()
+    self._lock = threading.Lock()
+    self.stages = []
+    self.commands = []
+
+  @contextlib.contextmanager
+  def Stage(self, name):
+    """Times a stage.
+
+    Args:
+      name: The name of the stage.
+
+    Yields:
+      A Stage object whose bytes attribute may be set.
+    """
+    stage = Stage(name)
+    start_time = time.time()
+    try:
+      yield stage
+    finally:
+      stage.seconds = time.time() - start_time
+      with self._lock:
+        self.stages.append(stage)
+      if stage.bytes is None:
+        logging.info('Stage %s took %.1f seconds', name, stage.seconds)
+      else:
+        logging.info('Stage %s took %.1f seconds for %d MB (%.1f MB/s)',
+                     name, stage.seconds, stage.bytes // _MEGABYTE,
+                     _Rate(stage.bytes, stage.seconds))
+
+  def AddCommand(self, command, seconds, returncode):
+    """Records a command which was run."""
+    with self._lock:
+      self.commands.append({'command': ' '.join(command),
+                            'seconds': round(seconds, 3),
+                            'returncode': returncode})
+
+  def ToDict(self):
+    with self._lock:
+      return {'seconds': round(time.time() - self._start_time, 3),
+              'stages': [{'name': stage.name,
+                          'seconds': round(stage.seconds, 3),
+                          'bytes': stage.bytes,
+                          'files': stage.files} for stage in self.stages],
+              'commands': list(self.commands)}
+
+  def ToJson(self):
+    return json.dumps(self.ToDict(), indent=2)
+
+  def Save(self, file_path):
+    """Writes the report as JSON."""
+    with open(file_path, 'w') as report_file:
+      report_file.write(self.ToJson())
+    logging.info('Saved timing report to %s', file_path)
+
+
+_report = Report()
+
+
+def GetReport():
+  """Returns the report of the current bundling."""
+  return _report
+
+
+class Progress(object):
+  """Logs the progress of a long stage at most every PROGRESS_INTERVAL."""
+
+  def __init__(self, name, interval=PROGRESS_INTERVAL):
+    self._name = name
+    self._interval = interval
+    self._start_time = time.time()
+    self._next_time = self._start_time + interval
+
+  def Update(self, byte_count):
+    """Logs how many bytes were processed, if it is time to.
+
+    Args:
+      byte_count: The number of bytes processed since the start.
+    """
+    now = time.time()
+    if now < self._next_time:
+      return
+    self._next_time = now + self._interval
+    logging.info('%s: %d MB, %.1f MB/s', self._name, byte_count // _MEGABYTE,
+                 _Rate(byte_count, now - self._start_time))
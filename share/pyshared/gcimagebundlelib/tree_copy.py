@@ -0,0 +1,393 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""In-process parallel copy of directory trees.
+
+An alternative to rsync for populating raw disks. The tree is walked by a
+single thread which creates directories, symbolic links and device nodes
+and hands the regular files to a pool of threads, which copy their data
+extent by extent with copy_file_range (the GIL is released while the
+kernel copies), so holes are preserved. Hard links are recreated, and
+ownership, permissions, times and extended attributes (which hold ACLs)
+are copied like 'rsync -a --hard-links --acls --xattrs --sparse' does.
+"""
+
+
+
+import collections
+import errno
+import hashlib
+import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import shutil
+import stat
+import time
+
+from gcimagebundlelib import sparse_tar
+from gcimagebundlelib import timing
+from gcimagebundlelib import utils
+
+try:
+  _scandir = os.scandir
+except AttributeError:
+  try:
+    from scandir import scandir as _scandir
+  except ImportError:
+    _scandir = None
+
+if hasattr(os, 'listxattr'):
+  XATTRS_SUPPORTED = True
+
+  def _ListXattrs(path):
+    return os.listxattr(path, follow_symlinks=False)
+
+  def _GetXattr(path, name):
+    return os.getxattr(path, name, follow_symlinks=False)
+
+  def _SetXattr(path, name, value):
+    os.setxattr(path, name, value, follow_symlinks=False)
+else:
+  try:
+    # The pyxattr module.
+    import xattr
+  except ImportError:
+    xattr = None
+  XATTRS_SUPPORTED = hasattr(xattr, 'get')
+
+  def _ListXattrs(path):
+    return xattr.list(path, nofollow=True)
+
+  def _GetXattr(path, name):
+    return xattr.get(path, name, nofollow=True)
+
+  def _SetXattr(path, name, value):
+    xattr.set(path, name, value, nofollow=True)
+
+DEFAULT_THREADS = multiprocessing.cpu_count()
+
+# Files are handed to the threads in batches of up to this many files or
+# bytes, handing them over one by one costs more than copying small files.
+BATCH_FILES = 256
+BATCH_BYTES = 16 * 1024 * 1024
+
+_XATTR_UNSUPPORTED_ERRNOS = (errno.ENOTSUP, errno.EOPNOTSUPP)
+
+_READ_SIZE = 1024 * 1024
+
+
+class TreeCopyError(Exception):
+  """Error occurred while copying a tree."""
+
+
+def ListDir(path):
+  """Returns (name, lstat result) for the entries of a directory."""
+  if _scandir:
+    return [(entry.name, entry.stat(follow_symlinks=False))
+            for entry in _scandir(path)]
+  return [(name, os.lstat(os.path.join(path, name)))
+          for name in os.listdir(path)]
+
+
+def _RemoveIfExists(path):
+  """Removes a file or directory so that it can be replaced."""
+  try:
+    os.unlink(path)
+  except OSError as e:
+    if e.errno in (errno.EISDIR, errno.EPERM) and os.path.isdir(path):
+      shutil.rmtree(path)
+    elif e.errno != errno.ENOENT:
+      raise
+
+
+def _HashExtents(src_fd, extents, dest_fd=None):
+  """Hashes the data extents of a file, copying them to dest_fd if given.
+
+  Returns:
+    The hex SHA1 digest of the extents and their data.
+  """
+  digest = hashlib.sha1()
+  for offset, length in extents:
+    digest.update('%d,%d;' % (offset, length))
+    os.lseek(src_fd, offset, os.SEEK_SET)
+    if dest_fd is not None:
+      os.lseek(dest_fd, offset, os.SEEK_SET)
+    while length:
+      data = os.read(src_fd, min(length, _READ_SIZE))
+      if not data:
+        raise IOError('file ends before offset %d' % (offset + length))
+      digest.update(data)
+      written = 0
+      while dest_fd is not None and written < len(data):
+        written += os.write(dest_fd, data[written:])
+      length -= len(data)
+  return digest.hexdigest()
+
+
+class TreeCopier(object):
+  """Copies files and directory trees in parallel."""
+
+  def __init__(self, should_exclude=None, ignore_hard_links=False,
+               xattrs=True, threads=DEFAULT_THREADS, manifest=None):
+    """Initializes TreeCopier object.
+
+    Args:
+      should_exclude: A function taking a source path and its stat result
+        (None for symbolic links, which are decided on what they point to)
+        and returning True if the path must not be copied. Nothing is
+        excluded if None.
+      ignore_hard_links: If True hard links are copied as separate files. If
+        False, hard links are recreated in dest.
+      xattrs: Specifies if extended attributes are preserved or not.
+      threads: The number of threads copying file data.
+      manifest: An incremental.FileManifest. If given, the files it finds
+        unchanged since the previous image are not copied again, and the
+        others are recorded in it with their content hash.
+
+    Raises:
+      TreeCopyError: If xattrs is True but extended attributes cannot be
+        read on this system.
+    """
+    if xattrs and not XATTRS_SUPPORTED:
+      raise TreeCopyError('Copying extended attributes needs the pyxattr '
+                          'module.')
+    self._should_exclude = should_exclude
+    self._ignore_hard_links = ignore_hard_links
+    self._xattrs = xattrs
+    self._set_owner = os.geteuid() == 0
+    self._manifest = manifest
+    self._pool = ThreadPool(threads)
+    # Batches of files being copied, oldest first. Bounded to limit the
+    # memory used by trees with millions of files.
+    self._pending = collections.deque()
+    self._max_pending = 4 * threads
+    self._batch = []
+    self._batch_bytes = 0
+    # Destination path of the first copy of every hard linked inode.
+    self._inodes = {}
+    self.files = 0
+    self.bytes = 0
+    self._progress = timing.Progress('Copying files')
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, unused_exc_value, unused_exc_tb):
+    if exc_type is None:
+      self.Close()
+    else:
+      self._pool.terminate()
+
+  def Close(self):
+    """Stops the copying threads."""
+    self._pool.close()
+    self._pool.join()
+
+  def Copy(self, src, dest, recursive=True):
+    """Copies src to dest.
+
+    Args:
+      src: The path of a file or directory to copy.
+      dest: The path of the copy. If src is a directory and dest exists, the
+        content of src is merged into dest.
+      recursive: Specifies if directories are copied recursively or not.
+    """
+    start_time = time.time()
+    # Directories get their metadata once everything in them is written,
+    # and hard links are made once the file they link to exists.
+    dirs = []
+    links = []
+    to_walk = []
+    entries = [(src, dest, os.lstat(src))]
+    while entries or to_walk:
+      if not entries:
+        src_dir, dest_dir = to_walk.pop()
+        entries = [(os.path.join(src_dir, name), os.path.join(dest_dir, name),
+                    file_stat) for name, file_stat in ListDir(src_dir)]
+        entries = [entry for entry in entries
+                   if not self._ShouldExclude(entry[0], entry[2])]
+        continue
+      src_path, dest_path, file_stat = entries.pop()
+      mode = file_stat.st_mode
+      if stat.S_ISDIR(mode):
+        if not os.path.isdir(dest_path):
+          _RemoveIfExists(dest_path)
+          os.mkdir(dest_path, 0o700)
+        dirs.append((src_path, dest_path, file_stat))
+        if self._manifest:
+          self._manifest.Add(dest_path, file_stat)
+        if recursive or src_path == src:
+          to_walk.append((src_path, dest_path))
+        continue
+      inode = (file_stat.st_dev, file_stat.st_ino)
+      hard_linked = (stat.S_ISREG(mode) and file_stat.st_nlink > 1 and
+                     not self._ignore_hard_links)
+      if hard_linked and inode in self._inodes:
+        links.append((self._inodes[inode], dest_path))
+        if self._manifest:
+          self._manifest.Add(dest_path, file_stat)
+        continue
+      if hard_linked:
+        self._inodes[inode] = dest_path
+      if self._manifest and self._manifest.Unchanged(dest_path, file_stat):
+        continue
+      if stat.S_ISREG(mode):
+        self._Submit(src_path, dest_path, file_stat)
+        continue
+      if stat.S_ISLNK(mode):
+        _RemoveIfExists(dest_path)
+        os.symlink(os.readlink(src_path), dest_path)
+      elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+        _RemoveIfExists(dest_path)
+        os.mknod(dest_path, mode, file_stat.st_rdev)
+      else:
+        # Like rsync without --specials.
+        logging.debug('skipping non-regular file %s', src_path)
+        continue
+      self._SetMetadata(src_path, dest_path, file_stat)
+      if self._manifest:
+        self._manifest.Add(dest_path, file_stat)
+    self._SubmitBatch()
+    while self._pending:
+      self._Collect(self._pending.popleft())
+    for target, dest_path in links:
+      _RemoveIfExists(dest_path)
+      os.link(target, dest_path)
+    for src_dir, dest_dir, dir_stat in reversed(dirs):
+      self._SetMetadata(src_dir, dest_dir, dir_stat)
+    logging.info('Copied %s to %s in %.1f seconds, %d files and %d bytes '
+                 'so far', src, dest, time.time() - start_time, self.files,
+                 self.bytes)
+
+  def _ShouldExclude(self, path, file_stat):
+    if not self._should_exclude:
+      return False
+    if stat.S_ISLNK(file_stat.st_mode):
+      file_stat = None
+    return self._should_exclude(path, file_stat)
+
+  def _Submit(self, src_path, dest_path, file_stat):
+    self._batch.append((src_path, dest_path, file_stat))
+    self._batch_bytes += file_stat.st_size
+    if (len(self._batch) >= BATCH_FILES or
+        self._batch_bytes >= BATCH_BYTES):
+      self._SubmitBatch()
+
+  def _SubmitBatch(self):
+    if not self._batch:
+      return
+    while len(self._pending) >= self._max_pending:
+      self._Collect(self._pending.popleft())
+    self._pending.append(self._pool.apply_async(self._CopyFiles,
+                                                (self._batch,)))
+    self._batch = []
+    self._batch_bytes = 0
+
+  def _Collect(self, result):
+    for dest_path, file_stat, size, digest, reused in result.get():
+      if not reused:
+        self.files += 1
+        self.bytes += size
+      if self._manifest:
+        self._manifest.Add(dest_path, file_stat, digest, reused)
+    self._progress.Update(self.bytes)
+
+  def _CopyFiles(self, batch):
+    """Copies a batch of files.
+
+    Returns:
+      A list of (dest_path, file_stat, size, digest, reused) tuples for the
+      files which did not vanish, as returned by _CopyFile.
+    """
+    copied = []
+    for src_path, dest_path, file_stat in batch:
+      result = self._CopyFile(src_path, dest_path, file_stat)
+      if result:
+        copied.append((dest_path, file_stat) + result)
+    return copied
+
+  def _CopyFile(self, src_path, dest_path, file_stat):
+    """Copies the data and metadata of a regular file, keeping its holes.
+
+    With a manifest, the content of the file is hashed as it is copied, and
+    if the file has the same hash as in the previous image only its
+    metadata is updated.
+
+    Returns:
+      A tuple of the size of the file, its hex SHA1 digest (None without a
+      manifest) and whether the previous copy was reused, or None if the
+      file vanished.
+    """
+    try:
+      src_fd = os.open(src_path, os.O_RDONLY)
+    except OSError as e:
+      if e.errno != errno.ENOENT:
+        raise
+      logging.warning('%s vanished before it was copied', src_path)
+      return None
+    digest = None
+    try:
+      size = os.fstat(src_fd).st_size
+      extents = sparse_tar.DataExtents(src_fd, size)
+      if self._manifest:
+        previous_digest = self._manifest.PreviousDigest(dest_path, file_stat)
+        if previous_digest and os.path.isfile(dest_path):
+          digest = _HashExtents(src_fd, extents)
+          if digest == previous_digest:
+            self._SetMetadata(src_path, dest_path, file_stat)
+            return size, digest, True
+      _RemoveIfExists(dest_path)
+      dest_fd = os.open(dest_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                        0o600)
+      try:
+        if self._manifest:
+          digest = _HashExtents(src_fd, extents, dest_fd)
+        else:
+          copiers = utils.GetCopiers()
+          for offset, length in extents:
+            utils.CopyRange(src_fd, dest_fd, offset, length, copiers)
+        os.ftruncate(dest_fd, size)
+      finally:
+        os.close(dest_fd)
+    finally:
+      os.close(src_fd)
+    self._SetMetadata(src_path, dest_path, file_stat)
+    return size, digest, False
+
+  def _SetMetadata(self, src_path, dest_path, file_stat):
+    """Copies ownership, permissions, extended attributes and times."""
+    is_link = stat.S_ISLNK(file_stat.st_mode)
+    if self._set_owner:
+      os.lchown(dest_path, file_stat.st_uid, file_stat.st_gid)
+    if self._xattrs:
+      self._CopyXattrs(src_path, dest_path)
+    # After chown, which clears the set-user-ID and set-group-ID bits. The
+    # permissions of symbolic links are not used.
+    if not is_link:
+      os.chmod(dest_path, stat.S_IMODE(file_stat.st_mode))
+      os.utime(dest_path, (file_stat.st_atime, file_stat.st_mtime))
+    elif os.utime in getattr(os, 'supports_follow_symlinks', ()):
+      os.utime(dest_path, (file_stat.st_atime, file_stat.st_mtime),
+               follow_symlinks=False)
+
+  def _CopyXattrs(self, src_path, dest_path):
+    try:
+      for name in _ListXattrs(src_path):
+        _SetXattr(dest_path, name, _GetXattr(src_path, name))
+    except (IOError, OSError) as e:
+      if e.errno not in _XATTR_UNSUPPORTED_ERRNOS:
+        raise
+      logging.debug('extended attributes of %s not copied: %s', src_path, e)
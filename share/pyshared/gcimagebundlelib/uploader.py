@@ -0,0 +1,325 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Streams image archives to where they are published.
+
+The archive is written to an UploadStream as it is compressed. A thread
+hands the data to the destination while the archive is still being
+written, through a bounded queue, so that a slow destination holds back the
+compression instead of the data piling up in memory. The archive is
+uploaded under a temporary name and renamed once its digest is known.
+"""
+
+
+
+import httplib
+import logging
+import os
+import Queue
+import socket
+import subprocess
+import threading
+import urlparse
+
+from gcimagebundlelib import utils
+
+# Size of the chunks handed to the destination.
+CHUNK_SIZE = 1024 * 1024
+
+# Number of chunks which may wait for the destination.
+QUEUE_CHUNKS = 16
+
+
+class UploadError(Exception):
+  """Error occurred uploading an archive."""
+
+
+class UploadStream(object):
+  """File-like object uploading what is written to it from another thread."""
+
+  def __init__(self, sink, name, max_chunks=QUEUE_CHUNKS):
+    """Initializes UploadStream object.
+
+    Args:
+      sink: An object with write(), close() and abort() methods which sends
+        data to the destination.
+      name: The name of the destination, for errors.
+      max_chunks: The number of chunks which may wait for the sink before
+        write() blocks.
+    """
+    self._sink = sink
+    self._name = name
+    self._queue = Queue.Queue(max_chunks)
+    self._buffer = []
+    self._buffered = 0
+    self._error = None
+    self.bytes_written = 0
+    self._thread = threading.Thread(target=self._Run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _Run(self):
+    try:
+      while True:
+        data = self._queue.get()
+        if data is None:
+          return
+        self._sink.write(data)
+    except Exception as e:
+      # Reported to the writer, which is still running.
+      self._error = e
+      while self._queue.get() is not None:
+        pass
+
+  def _CheckError(self):
+    if self._error:
+      raise UploadError('Uploading %s failed: %s' % (self._name, self._error))
+
+  def _Flush(self):
+    if self._buffer:
+      self._queue.put(''.join(self._buffer))
+      self._buffer = []
+      self._buffered = 0
+
+  def write(self, data):
+    self._CheckError()
+    self._buffer.append(data)
+    self._buffered += len(data)
+    self.bytes_written += len(data)
+    if self._buffered >= CHUNK_SIZE:
+      self._Flush()
+
+  def close(self):
+    """Waits for all the data to be uploaded and completes the upload.
+
+    Raises:
+      UploadError: If the upload failed.
+    """
+    self._Flush()
+    self._queue.put(None)
+    self._thread.join()
+    if self._error:
+      # Closing would complete a truncated upload.
+      self._sink.abort()
+      self._CheckError()
+    try:
+      self._sink.close()
+    except (EnvironmentError, httplib.HTTPException,
+            subprocess.CalledProcessError) as e:
+      raise UploadError('Uploading %s failed: %s' % (self._name, e))
+
+  def abort(self):
+    """Stops the upload, leaving nothing or a partial upload."""
+    self._buffer = []
+    # The sink is aborted first, as the destination may have stalled. Its
+    # write() then fails and the thread drops the queued chunks.
+    self._sink.abort()
+    self._queue.put(None)
+    self._thread.join()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type:
+      self.abort()
+    else:
+      self.close()
+
+
+class Uploader(object):
+  """A destination archives are streamed to."""
+
+  def Open(self, name):
+    """Starts uploading an archive.
+
+    Args:
+      name: The name of the archive at the destination.
+
+    Returns:
+      An UploadStream the archive is written to.
+    """
+    return UploadStream(self._OpenSink(name), self.Url(name))
+
+  def _OpenSink(self, name):
+    raise NotImplementedError
+
+  def Rename(self, name, new_name):
+    """Renames an uploaded archive."""
+    raise NotImplementedError
+
+  def Url(self, name):
+    """Returns the URL of an archive at the destination."""
+    raise NotImplementedError
+
+
+class _FileSink(object):
+
+  def __init__(self, path):
+    self._path = path
+    self._file = open(path, 'wb')
+    self.write = self._file.write
+
+  def close(self):
+    self._file.close()
+
+  def abort(self):
+    self._file.close()
+    os.remove(self._path)
+
+
+class DirectoryUploader(Uploader):
+  """Uploads archives to a local directory, a mounted file system say."""
+
+  def __init__(self, directory):
+    self._directory = directory
+
+  def _OpenSink(self, name):
+    return _FileSink(self.Url(name))
+
+  def Rename(self, name, new_name):
+    os.rename(self.Url(name), self.Url(new_name))
+
+  def Url(self, name):
+    return os.path.join(self._directory, name)
+
+
+class _ProcessSink(object):
+  """Writes to the standard input of a command."""
+
+  def __init__(self, command):
+    logging.debug('running %s', command)
+    self._command = command
+    self._process = subprocess.Popen(command, stdin=subprocess.PIPE)
+    self.write = self._process.stdin.write
+
+  def close(self):
+    self._process.stdin.close()
+    retcode = self._process.wait()
+    if retcode:
+      raise subprocess.CalledProcessError(retcode, cmd=self._command)
+
+  def abort(self):
+    self._process.kill()
+    self._process.wait()
+
+
+class GsutilUploader(Uploader):
+  """Uploads archives to a Cloud Storage bucket with gsutil."""
+
+  def __init__(self, bucket):
+    """Initializes GsutilUploader object.
+
+    Args:
+      bucket: The bucket, with or without a gs:// prefix.
+    """
+    if not bucket.startswith('gs://'):
+      bucket = 'gs://' + bucket
+    self._bucket = bucket.rstrip('/')
+
+  def _OpenSink(self, name):
+    return _ProcessSink(['gsutil', 'cp', '-', self.Url(name)])
+
+  def Rename(self, name, new_name):
+    utils.RunCommand(['gsutil', 'mv', self.Url(name), self.Url(new_name)])
+
+  def Url(self, name):
+    return '%s/%s' % (self._bucket, name)
+
+
+def _HttpConnection(url):
+  parts = urlparse.urlsplit(url)
+  if parts.scheme == 'https':
+    return httplib.HTTPSConnection(parts.netloc), parts.path
+  return httplib.HTTPConnection(parts.netloc), parts.path
+
+
+def _CheckResponse(response, method, url):
+  response.read()
+  if response.status // 100 != 2:
+    raise UploadError('%s %s returned %d %s' % (method, url, response.status,
+                                                response.reason))
+
+
+class _HttpSink(object):
+  """Sends a PUT request with a chunked body."""
+
+  def __init__(self, url):
+    self._url = url
+    self._connection, path = _HttpConnection(url)
+    self._connection.putrequest('PUT', path)
+    self._connection.putheader('Content-Type', 'application/octet-stream')
+    self._connection.putheader('Transfer-Encoding', 'chunked')
+    self._connection.endheaders()
+
+  def write(self, data):
+    self._connection.send('%x\r\n%s\r\n' % (len(data), data))
+
+  def close(self):
+    try:
+      self._connection.send('0\r\n\r\n')
+      _CheckResponse(self._connection.getresponse(), 'PUT', self._url)
+    finally:
+      self._connection.close()
+
+  def abort(self):
+    # Shutting the socket down wakes up a send blocked in another thread.
+    if self._connection.sock:
+      try:
+        self._connection.sock.shutdown(socket.SHUT_RDWR)
+      except socket.error:
+        pass
+    self._connection.close()
+
+
+class HttpUploader(Uploader):
+  """Uploads archives with HTTP PUT requests under a base URL.
+
+  Archives are renamed with WebDAV MOVE requests.
+  """
+
+  def __init__(self, base_url):
+    self._base_url = base_url.rstrip('/')
+
+  def _OpenSink(self, name):
+    return _HttpSink(self.Url(name))
+
+  def Rename(self, name, new_name):
+    connection, path = _HttpConnection(self.Url(name))
+    try:
+      connection.request('MOVE', path,
+                         headers={'Destination': self.Url(new_name)})
+      _CheckResponse(connection.getresponse(), 'MOVE', self.Url(name))
+    finally:
+      connection.close()
+
+  def Url(self, name):
+    return '%s/%s' % (self._base_url, name)
+
+
+def ForUrl(url):
+  """Returns the uploader for a destination URL.
+
+  Args:
+    url: A Cloud Storage bucket, with or without gs://, an http:// or
+      https:// base URL, or a file:// URL or absolute path of a directory.
+  """
+  if url.startswith('http://') or url.startswith('https://'):
+    return HttpUploader(url)
+  if url.startswith('file://'):
+    return DirectoryUploader(url[len('file://'):])
+  if url.startswith('/'):
+    return DirectoryUploader(url)
+  return GsutilUploader(url)
@@ -15,15 +15,35 @@
 
 """Utilities for image bundling tool."""
 
+import errno
 import logging
 import os
 import subprocess
 import time
 import urllib2
 
+from gcimagebundlelib import compression
+from gcimagebundlelib import partition_table
+from gcimagebundlelib import sparse_tar
+from gcimagebundlelib import timing
+
 METADATA_URL_PREFIX = 'http://169.254.169.254/computeMetadata/'
 METADATA_V1_URL_PREFIX = METADATA_URL_PREFIX + 'v1/'
 
+# Size of the reads when streaming an archive.
+ARCHIVE_CHUNK_SIZE = 1024 * 1024
+
+# Largest copy done by a single system call in CopyBytes.
+COPY_CHUNK_SIZE = 16 * 1024 * 1024
+
+# Errors of copy_file_range and sendfile meaning the files are not supported.
+_UNSUPPORTED_COPY_ERRNOS = (errno.EINVAL, errno.ENOSYS, errno.EXDEV,
+                            errno.EOPNOTSUPP, errno.EBADF)
+
+# Seconds to wait for mapped partition devices to show up.
+DEVICE_TIMEOUT = 30
+_DEVICE_POLL_INTERVAL = 0.05
+
 
 class MakeFileSystemException(Exception):
   """Error occurred in file system creation."""
@@ -33,6 +53,10 @@ class TarAndGzipFileException(Exception):
   """Error occurred in creating the tarball."""
 
 
+class LoadDiskImageException(Exception):
+  """Error occurred mapping a disk image."""
+
+
 class LoadDiskImage(object):
   """Loads raw disk image using kpartx."""
 
@@ -46,10 +70,12 @@ class LoadDiskImage(object):
       A list of devices for every partition found in an image.
     """
     self._file_path = file_path
+    self._devs = []
 
   def __enter__(self):
     """Map disk image as a device."""
-    SyncFileSystem()
+    # Writes to the image go through the page cache the loop device reads
+    # from, so there is no need to sync before mapping.
     kpartx_cmd = ['kpartx', '-a', '-v', '-s', self._file_path]
     output = RunCommand(kpartx_cmd)
     devs = []
@@ -58,7 +84,8 @@ class LoadDiskImage(object):
       if (len(split_line) > 2 and split_line[0] == 'add'
           and split_line[1] == 'map'):
         devs.append('/dev/mapper/' + split_line[2])
-    time.sleep(2)
+    self._devs = devs
+    WaitForDevices(devs)
     return devs
 
   def __exit__(self, unused_exc_type, unused_exc_value, unused_exc_tb):
@@ -69,12 +96,53 @@ class LoadDiskImage(object):
       unused_exc_value: unused.
       unused_exc_tb: unused.
     """
-    SyncFileSystem()
-    time.sleep(2)
+    # Only the mapped devices need flushing, not every file system.
+    for dev in self._devs:
+      FlushDevice(dev)
     kpartx_cmd = ['kpartx', '-d', '-v', '-s', self._file_path]
     RunCommand(kpartx_cmd)
 
 
+def WaitForDevices(dev_paths, timeout=DEVICE_TIMEOUT):
+  """Waits until device nodes exist.
+
+  Lets udev process its queued events and then polls for the nodes, which is
+  typically done in milliseconds rather than after a fixed delay.
+
+  Args:
+    dev_paths: The paths of the devices to wait for.
+    timeout: The number of seconds to wait for.
+
+  Raises:
+    LoadDiskImageException: If a device is missing after timeout seconds.
+  """
+  deadline = time.time() + timeout
+  try:
+    subprocess.call(['udevadm', 'settle', '--timeout=%d' % timeout])
+  except OSError:
+    logging.debug('udevadm is not available, polling for devices')
+  missing = [dev for dev in dev_paths if not os.path.exists(dev)]
+  while missing:
+    if time.time() > deadline:
+      raise LoadDiskImageException(
+          'Timed out waiting for devices %s' % ', '.join(missing))
+    time.sleep(_DEVICE_POLL_INTERVAL)
+    missing = [dev for dev in missing if not os.path.exists(dev)]
+
+
+def FlushDevice(dev_path):
+  """Flushes the buffered writes of a block device.
+
+  Args:
+    dev_path: The path of the device.
+  """
+  fd = os.open(dev_path, os.O_RDONLY)
+  try:
+    os.fsync(fd)
+  finally:
+    os.close(fd)
+
+
 class MountFileSystem(object):
   """Mounts a file system."""
 
@@ -108,9 +176,9 @@ class MountFileSystem(object):
       unused_exc_value: unused.
       unused_exc_tb: unused.
     """
+    # umount writes the file system back to the device.
     umount_cmd = ['umount', self._dir_path]
     RunCommand(umount_cmd)
-    SyncFileSystem()
 
 
 def SyncFileSystem():
@@ -145,7 +213,7 @@ def MakePartitionTable(file_path):
   Args:
     file_path: A path to a file where a partition table will be created.
   """
-  RunCommand(['parted', file_path, 'mklabel', 'msdos'])
+  partition_table.MakePartitionTable(file_path, partition_table.MSDOS)
 
 
 def MakePartition(file_path, partition_type, fs_type, start, end):
@@ -153,15 +221,25 @@ def MakePartition(file_path, partition_type, fs_type, start, end):
 
   Args:
     file_path: A path to a file where a partition will be created.
-    partition_type: A type of a partition to be created. Tested option is msdos.
+    partition_type: A type of a partition to be created. Only primary is
+      supported.
     fs_type: A type of a file system to be created. For example, ext2, ext3,
-      etc.
+      etc. All of them get the Linux partition type.
     start: Start offset of a partition in bytes.
     end: End offset of a partition in bytes.
+
+  Raises:
+    partition_table.PartitionTableError: If partition_type is not primary or
+      the partition does not fit on the disk.
   """
-  parted_cmd = ['parted', file_path, 'unit B', 'mkpart', partition_type,
-                fs_type, str(start), str(end)]
-  RunCommand(parted_cmd)
+  if partition_type != 'primary':
+    raise partition_table.PartitionTableError(
+        'Unsupported partition type %s' % partition_type)
+  table = partition_table.PartitionTable(file_path)
+  partition = table.AddPartition(start, end)
+  table.Write()
+  logging.debug('Created %s partition %r for %s on %s', partition_type,
+                partition, fs_type, file_path)
 
 
 def MakeFileSystem(dev_path, fs_type, uuid=None):
@@ -198,6 +276,46 @@ def MakeFileSystem(dev_path, fs_type, uuid=None):
   return uuid
 
 
+def MakeFileSystemFromDirectory(file_path, offset, size, fs_type, src_dir,
+                                uuid=None):
+  """Create a file system holding the files of a directory in a disk file.
+
+  The file system is written straight into the disk file with mke2fs -d, so
+  no loop device, device-mapper table or mount is needed.
+
+  Args:
+    file_path: A path to a disk file.
+    offset: The offset in bytes in the disk file where the file system
+      starts, usually the start of a partition.
+    size: The size of the file system in bytes.
+    fs_type: A type of a file system to be created. Only ext2, ext3 and ext4
+      are supported.
+    src_dir: A path to the directory to copy into the file system.
+    uuid: The value to use as the UUID for the filesystem. If none, a random
+          UUID will be generated and used.
+
+  Returns:
+    The uuid of the filesystem.
+
+  Raises:
+    MakeFileSystemException: If fs_type is not supported.
+    subprocess.CalledProcessError: If mke2fs fails.
+  """
+  if fs_type not in ('ext2', 'ext3', 'ext4'):
+    raise MakeFileSystemException(
+        'Cannot create a %s file system from a directory' % fs_type)
+  if uuid is None:
+    uuid = RunCommand(['uuidgen']).strip()
+  if not uuid:
+    raise MakeFileSystemException(file_path)
+
+  mkfs_cmd = ['mke2fs', '-F', '-q', '-t', fs_type, '-U', uuid, '-d', src_dir,
+              '-E', 'offset=%d' % offset, file_path, '%dk' % (size // 1024)]
+  RunCommand(mkfs_cmd)
+
+  return uuid
+
+
 def Rsync(src, dest, exclude_file, ignore_hard_links, recursive, xattrs):
   """Copy files from specified directory using rsync.
 
@@ -253,35 +371,105 @@ def GetUUID(partition_path):
   return uuid
 
 
+def _CopyFileRange(src_fd, dest_fd, offset, count):
+  return os.copy_file_range(src_fd, dest_fd, count, offset, offset)
+
+
+def _SendFile(src_fd, dest_fd, offset, count):
+  os.lseek(dest_fd, offset, os.SEEK_SET)
+  return os.sendfile(dest_fd, src_fd, offset, count)
+
+
+def _ReadWrite(src_fd, dest_fd, offset, count):
+  os.lseek(src_fd, offset, os.SEEK_SET)
+  data = os.read(src_fd, count)
+  os.lseek(dest_fd, offset, os.SEEK_SET)
+  written = 0
+  while written < len(data):
+    written += os.write(dest_fd, data[written:])
+  return len(data)
+
+
+def GetCopiers():
+  """Returns the ways to copy bytes between files, most efficient first."""
+  copiers = [_ReadWrite]
+  if hasattr(os, 'sendfile'):
+    copiers.insert(0, _SendFile)
+  if hasattr(os, 'copy_file_range'):
+    copiers.insert(0, _CopyFileRange)
+  return copiers
+
+
+def CopyRange(src_fd, dest_fd, offset, count, copiers=None):
+  """Copies count bytes at offset from src_fd to the same offset in dest_fd.
+
+  The bytes are copied in the kernel with copy_file_range or sendfile where
+  available (neither works with every source, a disk device for instance),
+  and with reads and writes otherwise.
+
+  Args:
+    src_fd: A file descriptor open for reading.
+    dest_fd: A file descriptor open for writing.
+    offset: The offset of the bytes to copy.
+    count: Number of bytes to copy.
+    copiers: A list of copy functions as returned by GetCopiers(). Those that
+      turn out not to work are removed from it, so passing the same list for
+      every range of a file only probes them once.
+
+  Returns:
+    The name of the copy function used last.
+
+  Raises:
+    IOError: If src_fd ends before offset + count.
+  """
+  if copiers is None:
+    copiers = GetCopiers()
+  copied = 0
+  while copied < count:
+    chunk = min(count - copied, COPY_CHUNK_SIZE)
+    try:
+      copied_now = copiers[0](src_fd, dest_fd, offset + copied, chunk)
+    except OSError as e:
+      if len(copiers) == 1 or e.errno not in _UNSUPPORTED_COPY_ERRNOS:
+        raise
+      logging.debug('%s failed (%s), falling back to %s',
+                    copiers[0].__name__, e, copiers[1].__name__)
+      copiers.pop(0)
+      continue
+    if not copied_now:
+      raise IOError('file ends after %d of %d bytes' % (offset + copied,
+                                                        offset + count))
+    copied += copied_now
+  return copiers[0].__name__
+
+
 def CopyBytes(src, dest, count):
   """Copies count bytes from the src to dest file.
 
+  The rest of dest is left as is.
+
   Args:
     src: The source to read bytes from.
     dest: The destination to copy bytes to.
     count: Number of bytes to copy.
+
+  Raises:
+    IOError: If src has less than count bytes.
   """
-  block_size = 4096
-  block_count = count / block_size
-  dd_command = ['dd',
-                'if=%s' % src,
-                'of=%s' % dest,
-                'conv=notrunc',
-                'bs=%s' % block_size,
-                'count=%s' % block_count]
-  RunCommand(dd_command)
-  remaining_bytes = count - block_count * block_size
-  if remaining_bytes:
-    logging.debug('remaining bytes to copy = %s', remaining_bytes)
-    dd_command = ['dd',
-                  'if=%s' % src,
-                  'of=%s' % dest,
-                  'seek=%s' % block_count,
-                  'skip=%s' % block_count,
-                  'conv=notrunc',
-                  'bs=1',
-                  'count=%s' % remaining_bytes]
-    RunCommand(dd_command)
+  src_fd = os.open(src, os.O_RDONLY)
+  try:
+    dest_fd = os.open(dest, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+      try:
+        copier = CopyRange(src_fd, dest_fd, 0, count)
+      except IOError as e:
+        raise IOError('%s: %s' % (src, e))
+    finally:
+      os.close(dest_fd)
+  finally:
+    os.close(src_fd)
+  logging.debug('copied %d bytes from %s to %s with %s', count, src, dest,
+                copier)
 
 
 def GetPartitionStart(disk_path, partition_number):
@@ -295,21 +483,11 @@ def GetPartitionStart(disk_path, partition_number):
     The starting position of the first partition in bytes.
 
   Raises:
-    subprocess.CalledProcessError: If running parted fails.
+    partition_table.PartitionTableError: If the disk has no partition table.
     IndexError: If there is no partition at the given number.
   """
-  parted_cmd = ['parted',
-                disk_path,
-                'unit B',
-                'print']
-  # In case the device is not valid and parted throws the retry/cancel prompt
-  # write c to stdin.
-  output = RunCommand(parted_cmd, input_str='c')
-  for line in output.splitlines():
-    split_line = line.split()
-    if len(split_line) > 4 and split_line[0] == str(partition_number):
-      return int(split_line[1][:-1])
-  raise IndexError()
+  table = partition_table.PartitionTable(disk_path)
+  return table.GetPartition(partition_number).start
 
 
 def RemovePartition(disk_path, partition_number):
@@ -319,13 +497,9 @@ def RemovePartition(disk_path, partition_number):
     disk_path: The disk to remove the partition from.
     partition_number: The partition number to remove.
   """
-  parted_cmd = ['parted',
-                disk_path,
-                'rm',
-                str(partition_number)]
-  # In case the device is not valid and parted throws the retry/cancel prompt
-  # write c to stdin.
-  RunCommand(parted_cmd, input_str='c')
+  table = partition_table.PartitionTable(disk_path)
+  table.RemovePartition(partition_number)
+  table.Write()
 
 
 def GetDiskSize(disk_file):
@@ -358,9 +532,12 @@ def RunCommand(command, input_str=None):
     subprocess.CalledProcessError: if the command fails.
   """
   logging.debug('running %s with input=%s', command, input_str)
+  start_time = time.time()
   p = subprocess.Popen(command, stdin=subprocess.PIPE,
                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
   cmd_output = p.communicate(input_str)
+  timing.GetReport().AddCommand(command, time.time() - start_time,
+                                p.returncode)
   logging.debug('stdout %s', cmd_output[0])
   logging.debug('stderr %s', cmd_output[1])
   logging.debug('returncode %s', p.returncode)
@@ -374,19 +551,125 @@ def RunCommand(command, input_str=None):
   return cmd_output[0]
 
 
-def TarAndGzipFile(src_paths, dest):
-  """Pack file in tar archive and optionally gzip it.
+class HashingFile(object):
+  """File-like object writing to a file and updating a digest."""
+
+  def __init__(self, dest_file, digest=None, progress=None):
+    """Initializes HashingFile object.
+
+    Args:
+      dest_file: A file object to write to.
+      digest: An optional hashlib object updated with everything written.
+      progress: An optional timing.Progress object updated with the number
+        of bytes written.
+    """
+    self._dest_file = dest_file
+    self._digest = digest
+    self._progress = progress
+    self.bytes_written = 0
+
+  def write(self, data):
+    self._dest_file.write(data)
+    if self._digest is not None:
+      self._digest.update(data)
+    self.bytes_written += len(data)
+    if self._progress:
+      self._progress.Update(self.bytes_written)
+
+
+def TarAndGzipFile(src_paths, dest, digest=None, compress_threads=1,
+                   builtin_tar=False, dest_file=None, codec=None):
+  """Pack file in tar archive and optionally compress it.
+
+  The archive is written to dest here, rather than by tar, so that it can be
+  hashed as it is written instead of being read back afterwards.
 
   Args:
     src_paths: A list of files that will be archived.
                (Must be in the same directory.)
-    dest: An archive name. If a file ends with .gz or .tgz an archive is gzipped
-      as well.
+    dest: An archive name. Without a codec, if a file ends with .gz or .tgz
+      an archive is gzipped as well.
+    digest: An optional hashlib object updated with the archive bytes.
+    compress_threads: The number of threads compressing the archive. With
+      more than one thread, or another codec than gzip at its default
+      level, the archive is compressed by the codec, otherwise by tar.
+    builtin_tar: If True the archive is written by sparse_tar instead of
+      tar, reading only the data extents of sparse files, and compressed
+      by the codec.
+    dest_file: An optional file object the archive is written to, an
+      uploader.UploadStream for instance. dest then only names the archive.
+    codec: An optional compression.Codec compressing the archive.
+
+  Returns:
+    The size of the archive.
+
+  Raises:
+    TarAndGzipFileException: If tar encounters an error.
+  """
+  if codec is None:
+    if dest.endswith('.gz') or dest.endswith('.tgz'):
+      codec = compression.GzipCodec()
+    else:
+      codec = compression.NoCompression()
+  # tar gzips the archive itself unless it is written in-process, or is
+  # compressed with several threads or another level.
+  tar_gzip = (codec.name == compression.GzipCodec.name and
+              codec.level == compression.GzipCodec.default_level and
+              not builtin_tar and compress_threads == 1)
+  start_time = time.time()
+  if dest_file is None:
+    with open(dest, 'wb') as dest_file:
+      hashing_file = _WriteArchive(src_paths, dest_file, digest, codec,
+                                   tar_gzip, compress_threads, builtin_tar)
+  else:
+    hashing_file = _WriteArchive(src_paths, dest_file, digest, codec,
+                                 tar_gzip, compress_threads, builtin_tar)
+  elapsed = time.time() - start_time
+  logging.info('Wrote %d bytes to %s in %.1f seconds (%.1f MB/s, %s, %s, %d '
+               'compression threads)', hashing_file.bytes_written, dest,
+               elapsed, hashing_file.bytes_written / (elapsed or 1) / 2**20,
+               'builtin tar' if builtin_tar else 'tar', codec,
+               1 if tar_gzip else compress_threads)
+  return hashing_file.bytes_written
+
+
+def _WriteArchive(src_paths, dest_file, digest, codec, tar_gzip,
+                  compress_threads, builtin_tar):
+  """Writes the archive for TarAndGzipFile.
+
+  Returns:
+    The HashingFile the archive was written through.
+  """
+  hashing_file = HashingFile(dest_file, digest,
+                             timing.Progress('Writing archive'))
+  if tar_gzip:
+    _RunTar(src_paths, hashing_file, True)
+    return hashing_file
+  # The compression is stopped, its threads or process ended, if writing
+  # the archive fails.
+  with codec.Open(hashing_file, compress_threads) as archive_file:
+    if builtin_tar:
+      tar_writer = sparse_tar.SparseTarWriter(archive_file)
+      for src_path in src_paths:
+        tar_writer.AddFile(src_path)
+      tar_writer.Close()
+    else:
+      _RunTar(src_paths, archive_file, False)
+  return hashing_file
+
+
+def _RunTar(src_paths, dest_file, gzipped):
+  """Runs tar and writes the archive to dest_file.
+
+  Args:
+    src_paths: A list of files in the same directory.
+    dest_file: A file object the archive is written to.
+    gzipped: If True tar gzips the archive.
 
   Raises:
     TarAndGzipFileException: If tar encounters an error.
   """
-  if dest.endswith('.gz') or dest.endswith('.tgz'):
+  if gzipped:
     mode = 'czSf'
   else:
     mode = 'cSf'
@@ -394,8 +677,17 @@ def TarAndGzipFile(src_paths, dest):
   # Take the directory of the first file in the list, all files are expected
   # to be in the same directory.
   src_dir = os.path.dirname(src_paths[0])
-  tar_cmd = ['tar', mode, dest, '-C', src_dir] + src_names
-  retcode = subprocess.call(tar_cmd)
+  tar_cmd = ['tar', mode, '-', '-C', src_dir] + src_names
+  tar_process = subprocess.Popen(tar_cmd, stdout=subprocess.PIPE)
+  try:
+    for chunk in iter(lambda: tar_process.stdout.read(ARCHIVE_CHUNK_SIZE), ''):
+      dest_file.write(chunk)
+  except Exception:
+    # tar would otherwise wait forever on the full pipe.
+    tar_process.kill()
+    tar_process.wait()
+    raise
+  retcode = tar_process.wait()
   if retcode:
     raise TarAndGzipFileException(','.join(src_paths))
 